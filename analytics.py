@@ -0,0 +1,331 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, date
+from flask import current_app
+from sqlalchemy import func, case, and_, true, delete
+from sqlalchemy.orm import Session
+from app import db
+from models import Subscriber, Joke, AnalyticsRollup, AnalyticsChange
+from utils.db_utils import dialect_insert, is_postgres
+
+logger = logging.getLogger(__name__)
+
+# Days shown on the subscriber growth chart
+GROWTH_DAYS = 31
+
+# Serializes rollup refreshes across processes (pg_advisory_xact_lock key)
+ROLLUP_LOCK_KEY = 7_242_002
+
+
+def _as_date(value):
+    # func.date() comes back as a date on Postgres and as a string on SQLite
+    return value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _star(rating):
+    # Ratings are bucketed to the nearest star, as [r - 0.5, r + 0.5)
+    if rating is None or not 0.5 <= rating < 5.5:
+        return None
+    return int(rating + 0.5) - 1
+
+
+def record_change(subscribers=0, active_subscribers=0, jokes=0, rating_total=0.0,
+                  ratings=None, categories=None, recount=False):
+    """
+    Queue a change to the analytics totals in the current transaction.
+
+    The caller commits, so the change reaches the rollup exactly when the
+    write it describes becomes visible.
+    """
+    db.session.add(AnalyticsChange(
+        subscribers=subscribers,
+        active_subscribers=active_subscribers,
+        jokes=jokes,
+        rating_total=rating_total,
+        ratings=ratings,
+        categories=categories,
+        recount=recount,
+    ))
+
+
+def subscriber_changed(before, after):
+    """
+    Record a subscriber being created, activated, deactivated or re-preferenced.
+
+    Args:
+        before: (is_active, category names) before the write, or None for a new subscriber.
+        after: (is_active, category names) after the write.
+    """
+    active = 0
+    categories = Counter()
+    for sign, state in ((-1, before), (1, after)):
+        if state is None or not state[0]:
+            continue
+        active += sign
+        for name in state[1]:
+            categories[name] += sign
+    categories = {name: count for name, count in categories.items() if count}
+    subscribers = (after is not None) - (before is not None)
+    if subscribers or active or categories:
+        record_change(subscribers=subscribers, active_subscribers=active, categories=categories or None)
+
+
+def ratings_changed(changes):
+    """
+    Record jokes' average ratings moving.
+
+    Args:
+        changes: (old rating, new rating) pairs as returned by Joke.add_ratings().
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    buckets = [0] * 5
+    total = 0.0
+    for old, new in changes:
+        total += new - old
+        for sign, rating in ((-1, old), (1, new)):
+            star = _star(rating)
+            if star is not None:
+                buckets[star] += sign
+    record_change(rating_total=total, ratings=buckets)
+
+
+def compute_snapshot(session=None):
+    """
+    Compute the analytics figures from scratch with three aggregate queries.
+
+    Only used when the rollup has nothing to start from, once a day to
+    correct any drift, and after writes that could not say what they changed.
+
+    Args:
+        session: Session to read through (defaults to db.session).
+
+    Returns:
+        dict: Subscriber totals, rating totals and buckets and category preference counts.
+    """
+    session = session or db.session
+    total_subscribers, active_subscribers = session.query(
+        func.count(Subscriber.id),
+        func.coalesce(func.sum(case((Subscriber.is_active == True, 1), else_=0)), 0)
+    ).one()
+
+    # Ratings are bucketed to the nearest star, as [r - 0.5, r + 0.5)
+    buckets = [
+        func.coalesce(func.sum(case(
+            (and_(Joke.rating >= star - 0.5, Joke.rating < star + 0.5), 1), else_=0
+        )), 0)
+        for star in range(1, 6)
+    ]
+    joke_stats = session.query(
+        func.count(Joke.rating), func.coalesce(func.sum(Joke.rating), 0), *buckets
+    ).one()
+
+    elements = Subscriber.category_elements()
+    preferences = session.query(
+        elements.c.value, func.count()
+    ).select_from(Subscriber).join(elements, true()).filter(
+        Subscriber.is_active == True
+    ).group_by(elements.c.value).order_by(func.count().desc()).all()
+
+    return {
+        'total_subscribers': total_subscribers,
+        'active_subscribers': int(active_subscribers),
+        'joke_count': joke_stats[0],
+        'rating_total': float(joke_stats[1]),
+        'ratings_distribution': [int(count) for count in joke_stats[2:]],
+        'category_preferences': {name: count for name, count in preferences},
+    }
+
+
+def _pending_changes(session):
+    """Sum the queued changes; returns the sum and the highest id it covers."""
+    rows = session.query(
+        AnalyticsChange.id,
+        AnalyticsChange.subscribers,
+        AnalyticsChange.active_subscribers,
+        AnalyticsChange.jokes,
+        AnalyticsChange.rating_total,
+        AnalyticsChange.ratings,
+        AnalyticsChange.categories,
+        AnalyticsChange.recount,
+    ).all()
+    changes = {
+        'count': len(rows), 'subscribers': 0, 'active_subscribers': 0, 'jokes': 0,
+        'rating_total': 0.0, 'ratings': [0] * 5, 'categories': Counter(), 'recount': False,
+    }
+    for _, subscribers, active, jokes, rating_total, ratings, categories, recount in rows:
+        changes['subscribers'] += subscribers
+        changes['active_subscribers'] += active
+        changes['jokes'] += jokes
+        changes['rating_total'] += rating_total
+        for star, count in enumerate(ratings or ()):
+            changes['ratings'][star] += count
+        changes['categories'].update(categories or {})
+        changes['recount'] = changes['recount'] or recount
+    return changes, max((row[0] for row in rows), default=None)
+
+
+def _fold(base, changes):
+    """Today's figures: the latest rollup totals plus the queued changes."""
+    preferences = Counter(base.category_preferences or {})
+    preferences.update(changes['categories'])
+    return {
+        'total_subscribers': base.total_subscribers + changes['subscribers'],
+        'active_subscribers': base.active_subscribers + changes['active_subscribers'],
+        'joke_count': base.joke_count + changes['jokes'],
+        'rating_total': base.rating_total + changes['rating_total'],
+        'ratings_distribution': [
+            count + change for count, change in zip(base.ratings_distribution or [0] * 5, changes['ratings'])
+        ],
+        'category_preferences': {
+            name: count for name, count in preferences.most_common() if count > 0
+        },
+    }
+
+
+def refresh_rollup(now=None, reconcile=True):
+    """
+    Bring the rollup up to date.
+
+    New subscribers are recounted for days that were not closed yet, a range
+    scan on subscribed_at. Today's totals are the latest stored totals plus
+    the changes queued since the last refresh; they are only recomputed from
+    scratch when there is nothing to start from, when a queued change asks
+    for it, or (with ``reconcile``) on the first refresh of a day.
+
+    On Postgres the refresh runs in a REPEATABLE READ transaction of its
+    own, taken once the lock is held, so the queued changes it consumes are
+    exactly the ones the totals it reads already include; changes committed
+    meanwhile stay queued for the next refresh.
+
+    Args:
+        now: Current UTC time (defaults to utcnow).
+        reconcile: Whether the first refresh of a day recounts the totals.
+    """
+    now = now or datetime.utcnow()
+    if not is_postgres():
+        _refresh(db.session, now, reconcile)
+        return
+
+    # Held by db.session's transaction until the refresh has committed
+    db.session.execute(db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': ROLLUP_LOCK_KEY})
+    try:
+        with db.engine.connect().execution_options(isolation_level='REPEATABLE READ') as connection:
+            with Session(bind=connection) as session:
+                _refresh(session, now, reconcile)
+    finally:
+        db.session.commit()
+
+
+def _refresh(session, now, reconcile):
+    today = now.date()
+    first_day = today - timedelta(days=GROWTH_DAYS - 1)
+
+    base = session.query(AnalyticsRollup).filter(
+        AnalyticsRollup.day <= today,
+        AnalyticsRollup.total_subscribers != None,
+        AnalyticsRollup.joke_count != None,
+    ).order_by(AnalyticsRollup.day.desc()).first()
+    changes, last_change = _pending_changes(session)
+    recount = base is None or changes['recount'] or (reconcile and base.day != today)
+    snapshot = compute_snapshot(session) if recount else _fold(base, changes)
+    snapshot['average_rating'] = (
+        snapshot['rating_total'] / snapshot['joke_count'] if snapshot['joke_count'] else 0.0
+    )
+    if last_change is not None:
+        # Only what was summed above; later changes belong to the next refresh
+        session.execute(delete(AnalyticsChange).where(AnalyticsChange.id <= last_change))
+
+    # A day is closed once its row was refreshed after the day ended
+    closed = {
+        day
+        for day, refreshed_at in session.query(
+            AnalyticsRollup.day, AnalyticsRollup.refreshed_at
+        ).filter(AnalyticsRollup.day >= first_day)
+        if refreshed_at >= datetime.combine(day + timedelta(days=1), datetime.min.time())
+    }
+    open_days = [
+        first_day + timedelta(days=offset)
+        for offset in range(GROWTH_DAYS)
+        if first_day + timedelta(days=offset) not in closed
+    ]
+
+    start = datetime.combine(open_days[0], datetime.min.time())
+    joined = {
+        _as_date(day): count
+        for day, count in session.query(
+            func.date(Subscriber.subscribed_at), func.count()
+        ).filter(
+            Subscriber.subscribed_at >= start
+        ).group_by(func.date(Subscriber.subscribed_at))
+    }
+
+    rows = [
+        {'day': day, 'new_subscribers': joined.get(day, 0), 'refreshed_at': now}
+        for day in open_days if day != today
+    ]
+    if rows:
+        statement = dialect_insert(AnalyticsRollup).values(rows)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['day'],
+            set_={'new_subscribers': statement.excluded.new_subscribers,
+                  'refreshed_at': statement.excluded.refreshed_at}
+        ))
+
+    today_row = dict(snapshot, day=today, new_subscribers=joined.get(today, 0), refreshed_at=now)
+    statement = dialect_insert(AnalyticsRollup).values(today_row)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=['day'],
+        set_={key: statement.excluded[key] for key in today_row if key != 'day'}
+    ))
+    session.commit()
+    if recount:
+        logger.info(f"Recounted analytics rollup ({len(open_days)} open days)")
+    else:
+        logger.info(f"Folded {changes['count']} changes into analytics rollup ({len(open_days)} open days)")
+
+
+def _latest_rollup():
+    return AnalyticsRollup.query.filter(
+        AnalyticsRollup.total_subscribers != None
+    ).order_by(AnalyticsRollup.day.desc()).first()
+
+
+def load_analytics(now=None):
+    """
+    Read the analytics page figures from the rollup.
+
+    The scheduler keeps the rollup fresh. The page only refreshes it itself
+    when there is no rollup yet, or when the latest one is older than
+    ANALYTICS_ROLLUP_TTL seconds; the latter only folds in queued changes.
+
+    Returns:
+        dict: Template variables for analytics.html.
+    """
+    now = now or datetime.utcnow()
+    today = now.date()
+    ttl = timedelta(seconds=current_app.config.get('ANALYTICS_ROLLUP_TTL', 1800))
+
+    latest = _latest_rollup()
+    if latest is None or latest.refreshed_at < now - ttl:
+        refresh_rollup(now, reconcile=latest is None)
+        latest = _latest_rollup()
+
+    first_day = today - timedelta(days=GROWTH_DAYS - 1)
+    growth = dict(db.session.query(AnalyticsRollup.day, AnalyticsRollup.new_subscribers).filter(
+        AnalyticsRollup.day >= first_day
+    ))
+    days = [first_day + timedelta(days=offset) for offset in range(GROWTH_DAYS)]
+    preferences = latest.category_preferences or {}
+
+    return {
+        'total_subscribers': latest.total_subscribers,
+        'active_subscribers': latest.active_subscribers,
+        'average_rating': latest.average_rating or 0,
+        'dates': [day.strftime('%Y-%m-%d') for day in days],
+        'growth_data': [growth.get(day, 0) for day in days],
+        'category_names': list(preferences),
+        'category_counts': list(preferences.values()),
+        'ratings_distribution': latest.ratings_distribution or [0] * 5,
+    }
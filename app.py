@@ -19,9 +19,14 @@ mail = Mail()
 login_manager = LoginManager()
 
 
-def create_app():
-    app = Flask(__name__)
+# Links rendered into emails; the worker app registers them build-only so it
+# can render emails without importing the web routes
+UNSUBSCRIBE_RULE = '/unsubscribe/<email>'
+RATE_RULE = '/rate/<int:joke_id>/<int:rating>'
+
 
+def configure_app(app):
+    """Load the configuration shared by the web app and the scheduler worker."""
     # Basic configuration
     app.secret_key = os.environ.get("FLASK_SECRET_KEY") or "a secret key"
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
@@ -38,12 +43,130 @@ def create_app():
     app.config['MAIL_PASSWORD'] = os.environ.get('GMAIL_APP_PASSWORD')
     app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('GMAIL_USERNAME')
 
+    # SMTP connection pool used for bulk delivery
+    app.config['MAIL_POOL_SIZE'] = int(os.environ.get('MAIL_POOL_SIZE', 4))
+    app.config['MAIL_POOL_MAX_MESSAGES'] = int(os.environ.get('MAIL_POOL_MAX_MESSAGES', 100))
+    app.config['MAIL_POOL_IDLE_TIMEOUT'] = int(os.environ.get('MAIL_POOL_IDLE_TIMEOUT', 60))
+
+    # Scheduler dispatch: worker threads per tick, deliveries per claimed batch,
+    # seconds after which unstarted deliveries carry over to the next tick,
+    # seconds before another replica may retake a claimed delivery,
+    # attempts before a delivery is marked failed, and sent emails recorded
+    # per bulk write (a crash can resend at most this many)
+    app.config['SCHEDULER_WORKERS'] = int(os.environ.get('SCHEDULER_WORKERS', 4))
+    app.config['SCHEDULER_CHUNK_SIZE'] = int(os.environ.get('SCHEDULER_CHUNK_SIZE', 50))
+    app.config['SCHEDULER_TICK_DEADLINE'] = int(os.environ.get('SCHEDULER_TICK_DEADLINE', 50))
+    app.config['SCHEDULER_CLAIM_LEASE'] = int(os.environ.get('SCHEDULER_CLAIM_LEASE', 300))
+    app.config['SCHEDULER_MAX_ATTEMPTS'] = int(os.environ.get('SCHEDULER_MAX_ATTEMPTS', 3))
+    app.config['SCHEDULER_FLUSH_SIZE'] = int(os.environ.get('SCHEDULER_FLUSH_SIZE', 50))
+
+    # In-process category cache: full reload interval and how often the
+    # shared version is checked for changes made by other processes (seconds)
+    app.config['CATEGORY_CACHE_TTL'] = int(os.environ.get('CATEGORY_CACHE_TTL', 300))
+    app.config['CATEGORY_CACHE_CHECK_INTERVAL'] = int(os.environ.get('CATEGORY_CACHE_CHECK_INTERVAL', 5))
+
+    # Seconds before the analytics page folds pending changes into the rollup
+    # itself; well above the scheduler's 10-minute refresh, so it only kicks in
+    # when the scheduler is not running
+    app.config['ANALYTICS_ROLLUP_TTL'] = int(os.environ.get('ANALYTICS_ROLLUP_TTL', 1800))
+
+    # Joke inventory refill: minimum sendable jokes per category on top of the
+    # deliveries due within the lookahead (minutes), jokes per AI call, and
+    # generation jobs run or queued per category per pass
+    app.config['JOKE_INVENTORY_LOW_WATERMARK'] = int(os.environ.get('JOKE_INVENTORY_LOW_WATERMARK', 20))
+    app.config['JOKE_REFILL_LOOKAHEAD'] = int(os.environ.get('JOKE_REFILL_LOOKAHEAD', 60))
+    app.config['JOKE_REFILL_BATCH'] = int(os.environ.get('JOKE_REFILL_BATCH', 10))
+    app.config['JOKE_REFILL_MAX_JOBS'] = int(os.environ.get('JOKE_REFILL_MAX_JOBS', 3))
+
+    # AI generation: concurrent requests, average request rate and attempts per request
+    app.config['AI_MAX_CONCURRENCY'] = int(os.environ.get('AI_MAX_CONCURRENCY', 4))
+    app.config['AI_REQUESTS_PER_MINUTE'] = int(os.environ.get('AI_REQUESTS_PER_MINUTE', 60))
+    app.config['AI_MAX_ATTEMPTS'] = int(os.environ.get('AI_MAX_ATTEMPTS', 5))
+
+    # Joke selection: how strongly ratings skew the draw (0 draws uniformly, 2
+    # makes a 5-star joke about 2.8 times as likely as a 3-star one)
+    app.config['JOKE_RATING_EXPONENT'] = float(os.environ.get('JOKE_RATING_EXPONENT', 2.0))
+
+    # Delivery mode: 'individual' picks and builds every subscriber's email on
+    # its own, 'broadcast' gives subscribers with the same categories the same
+    # jokes within a tick and builds each distinct email once. Every category
+    # combination needs its own email, so broadcast only pays off when many
+    # subscribers share one (see benchmarks/no_repeat_benchmark.py --broadcast)
+    app.config['DELIVERY_MODE'] = os.environ.get('DELIVERY_MODE', 'individual')
+
+    # Jaccard similarity of character shingles above which a new joke counts as a duplicate
+    app.config['JOKE_DEDUP_THRESHOLD'] = float(os.environ.get('JOKE_DEDUP_THRESHOLD', 0.7))
+
+    # Rating clicks: 'direct' writes each click in its own transaction, 'queue'
+    # appends it to a per-process spool file that a background thread folds
+    # into the database every RATING_FLUSH_INTERVAL milliseconds
+    app.config['RATING_INGEST_MODE'] = os.environ.get('RATING_INGEST_MODE', 'direct')
+    app.config['RATING_FLUSH_INTERVAL'] = int(os.environ.get('RATING_FLUSH_INTERVAL', 500))
+    app.config['RATING_SPOOL_DIR'] = os.environ.get('RATING_SPOOL_DIR') or os.path.join(app.instance_path, 'rating-spool')
+
+    # Delivery load levelling: subscribers one minute should hold, and how many
+    # minutes away from their chosen time the overflow may be sent
+    app.config['DELIVERY_SLOT_CAPACITY'] = int(os.environ.get('DELIVERY_SLOT_CAPACITY', 1000))
+    app.config['DELIVERY_SPREAD_TOLERANCE'] = int(os.environ.get('DELIVERY_SPREAD_TOLERANCE', 5))
+
+    # Welcome-email outbox: messages sent per batch, attempts before a message
+    # is marked failed, and seconds before the first retry (doubling after each
+    # further failure)
+    app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+    app.config['OUTBOX_MAX_ATTEMPTS'] = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+    app.config['OUTBOX_RETRY_DELAY'] = int(os.environ.get('OUTBOX_RETRY_DELAY', 60))
+
+    # Records per statement and per streamed piece in bulk imports and exports
+    app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+    # Uploaded imports are saved here and run by a background thread of the
+    # worker that received them; import files are the only large request
+    # bodies, so their size limit caps every request
+    app.config['BULK_SPOOL_DIR'] = os.environ.get('BULK_SPOOL_DIR') or os.path.join(app.instance_path, 'bulk-spool')
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('BULK_IMPORT_MAX_MB', 100)) * 1024 * 1024
+
+    # Bearer token required to read /metrics (metrics are off when unset), and
+    # the port the scheduler serves its own /metrics on (0 turns it off)
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['SCHEDULER_METRICS_PORT'] = int(os.environ.get('SCHEDULER_METRICS_PORT', 9200))
+    # Directory the web workers of one server share their metrics through, and
+    # how often each writes its values there (seconds)
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+    app.config['METRICS_WRITE_INTERVAL'] = float(os.environ.get('METRICS_WRITE_INTERVAL', 5))
+
     app.config['SERVER_NAME'] = os.environ.get('SERVER_NAME')  # e.g., "example.com"
     app.config['PREFERRED_URL_SCHEME'] = os.environ.get('PREFERRED_URL_SCHEME', 'https')
 
+
+def create_worker_app():
+    """
+    Build the minimal app the scheduler needs: configuration, database and mail.
+
+    Unlike create_app it registers no web routes (only the email link rules),
+    sets up no login manager, and leaves schema creation and upgrades to the
+    web app, so a scheduler process starts in a fraction of the time.
+    """
+    from metrics import init_app as init_metrics
+
+    app = Flask(__name__)
+    configure_app(app)
+    db.init_app(app)
+    mail.init_app(app)
+    init_metrics(app, web=False)
+    app.add_url_rule(UNSUBSCRIBE_RULE, endpoint='main.unsubscribe', build_only=True)
+    app.add_url_rule(RATE_RULE, endpoint='main.rate_joke', build_only=True)
+    return app
+
+
+def create_app():
+    from metrics import init_app as init_metrics
+
+    app = Flask(__name__)
+    configure_app(app)
+
     # Initialize extensions
     db.init_app(app)
     mail.init_app(app)
+    init_metrics(app)
     login_manager.init_app(app)
     login_manager.login_view = 'main.admin_login'
 
@@ -53,8 +176,10 @@ def create_app():
         return Admin.query.get(int(user_id))
 
     with app.app_context():
-        from models import Admin, Subscriber, Joke, JokeHistory
+        from models import Admin, Subscriber, Joke, JokeHistory, JokeRating, Delivery, CacheVersion, AnalyticsRollup, GenerationJob, JokeFingerprint, RatingBatch, SeenJokes, OutboxMessage
+        from schema import upgrade_schema
         db.create_all()
+        upgrade_schema()
 
         # Create default admin if not exists
         if not Admin.query.first():
@@ -67,4 +192,8 @@ def create_app():
     from routes import main_bp
     app.register_blueprint(main_bp)
 
+    # Bulk import/export commands: flask --app main bulk --help
+    from bulk import bulk_cli
+    app.cli.add_command(bulk_cli)
+
     return app
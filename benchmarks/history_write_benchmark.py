@@ -0,0 +1,118 @@
+"""
+Compare recording a tick's deliveries one transaction per email against the
+bulk DeliveryWriteBuffer, counting commits (fsyncs) and UPDATE statements
+(per-row lock round trips) as well as wall time.
+
+Uses DATABASE_URL when set, otherwise a temporary SQLite file so commits
+really hit the disk.
+
+Usage:
+    python benchmarks/history_write_benchmark.py --deliveries 5000 --flush-size 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from sqlalchemy import event
+from app import create_app, db
+from models import Category, Joke, Subscriber, JokeHistory, Delivery
+from delivery import DeliveryWriteBuffer
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.commits = 0
+        self.updates = 0
+        event.listen(engine, "commit", self._on_commit)
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("UPDATE"):
+            self.updates += len(parameters) if executemany else 1
+
+    def reset(self):
+        self.commits = self.updates = 0
+
+
+def seed(count, jokes_per_delivery):
+    category = Category(name="general", description="General jokes")
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all(Joke(content=f"Joke {i}", category_id=category.id)
+                       for i in range(count * jokes_per_delivery))
+    db.session.add_all(Subscriber(email=f"user{i}@example.com") for i in range(count))
+    db.session.flush()
+    subscriber_ids = [row.id for row in db.session.query(Subscriber.id).order_by(Subscriber.id)]
+    joke_ids = [row.id for row in db.session.query(Joke.id).order_by(Joke.id)]
+    db.session.add_all(Delivery(subscriber_id=subscriber_id, delivery_date=date.today(),
+                                status=Delivery.PENDING, attempts=1)
+                       for subscriber_id in subscriber_ids)
+    db.session.commit()
+    delivery_ids = [row.id for row in db.session.query(Delivery.id).order_by(Delivery.id)]
+    return [
+        (delivery_id, subscriber_id, joke_ids[i * jokes_per_delivery:(i + 1) * jokes_per_delivery])
+        for i, (delivery_id, subscriber_id) in enumerate(zip(delivery_ids, subscriber_ids))
+    ]
+
+
+def reset():
+    db.session.query(JokeHistory).delete()
+    db.session.query(Delivery).update({"status": Delivery.PENDING, "sent_at": None})
+    db.session.query(Joke).update({"last_sent": None})
+    db.session.commit()
+
+
+def per_delivery(work):
+    for delivery_id, subscriber_id, joke_ids in work:
+        sent_at = datetime.utcnow()
+        for joke_id in joke_ids:
+            db.session.get(Joke, joke_id).last_sent = sent_at
+            db.session.add(JokeHistory(joke_id=joke_id, user=subscriber_id, sent_at=sent_at))
+        db.session.get(Delivery, delivery_id).status = Delivery.SENT
+        db.session.commit()
+
+
+def buffered(work, flush_size):
+    # The buffer writes last_sent itself, for the emails it records
+    buffer = DeliveryWriteBuffer(flush_size)
+    for delivery_id, subscriber_id, joke_ids in work:
+        buffer.add(delivery_id, subscriber_id, joke_ids, datetime.utcnow())
+    buffer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--deliveries", type=int, default=5000)
+    parser.add_argument("--jokes-per-delivery", type=int, default=2)
+    parser.add_argument("--flush-size", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        work = seed(args.deliveries, args.jokes_per_delivery)
+        counter = StatementCounter(db.engine)
+
+        for name, run in (("per-delivery commit", lambda: per_delivery(work)),
+                          (f"buffered ({args.flush_size})", lambda: buffered(work, args.flush_size))):
+            reset()
+            counter.reset()
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            print(f"{name:22} {elapsed:8.2f}s  {counter.commits:7d} commits  "
+                  f"{counter.updates:7d} UPDATE stmts  {args.deliveries / elapsed:9.0f} deliveries/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Measure per-subscriber no-repeat selection at scale: every subscriber is run
+through select_jokes_for_subscribers in scheduler-sized batches, with seen
+bitmaps pre-filled with random history, and the picks are written back with
+save_seen as the delivery write buffer does. Reports time per batch, queries per
+batch, bitmap storage, whether any subscriber was served a joke twice and
+how many distinct joke sets were handed out (--broadcast groups subscribers
+by categories as DELIVERY_MODE=broadcast does). Every category combination
+needs a set of its own, so the number of combinations is the floor for the
+distinct sets.
+
+Uses DATABASE_URL when set, otherwise a temporary SQLite file.
+
+Usage:
+    python benchmarks/no_repeat_benchmark.py --subscribers 100000 --jokes 10000 --seen 300 [--broadcast]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from sqlalchemy import event, func, insert
+from app import create_app, db
+from models import Category, Joke, Subscriber, SeenJokes
+from joke_selection import JokeSampler, select_jokes_for_subscribers
+from seen_jokes import JokeBitmap, load_seen, save_seen
+
+
+def seed(subscribers, jokes, categories, seen):
+    rnd = random.Random(0)
+    names = [f"category{i}" for i in range(categories)]
+    db.session.execute(insert(Category), [{"name": name, "is_active": True} for name in names])
+    category_ids = [row.id for row in db.session.query(Category.id).order_by(Category.id)]
+    db.session.execute(insert(Joke), [
+        {"content": f"Joke {i}", "category_id": category_ids[i % categories], "rating": 0.0,
+         "rating_sum": 0, "rating_count": 0, "times_sent": 0}
+        for i in range(jokes)
+    ])
+    joke_ids = [row.id for row in db.session.query(Joke.id)]
+    for start in range(0, subscribers, 5000):
+        count = min(5000, subscribers - start)
+        db.session.execute(insert(Subscriber), [
+            {"email": f"user{start + i}@example.com", "is_active": True,
+             "preferences": {"categories": rnd.sample(names, min(3, categories))}}
+            for i in range(count)
+        ])
+    subscriber_ids = [row.id for row in db.session.query(Subscriber.id).order_by(Subscriber.id)]
+    for start in range(0, len(subscriber_ids), 5000):
+        bitmaps = {}
+        for subscriber_id in subscriber_ids[start:start + 5000]:
+            bitmap = JokeBitmap()
+            for joke_id in rnd.sample(joke_ids, seen):
+                bitmap.add(joke_id)
+            bitmaps[subscriber_id] = bitmap
+        save_seen(bitmaps)
+    db.session.commit()
+    return subscriber_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=100000)
+    parser.add_argument("--jokes", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--seen", type=int, default=300, help="jokes already sent to each subscriber")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--broadcast", action="store_true", help="share jokes within category groups")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        started = time.monotonic()
+        subscriber_ids = seed(args.subscribers, args.jokes, args.categories, args.seen)
+        print(f"Seeded {args.subscribers} subscribers x {args.jokes} jokes in {time.monotonic() - started:.1f}s")
+        storage = db.session.query(func.sum(func.length(SeenJokes.bitmap))).scalar()
+        print(f"Seen bitmaps: {storage / 1024:.0f} KiB total, {storage / args.subscribers:.0f} bytes per subscriber")
+
+        queries = [0]
+        event.listen(db.engine, "before_cursor_execute", lambda *a: queries.__setitem__(0, queries[0] + 1))
+
+        timings = []
+        per_batch = []
+        repeats = 0
+        joke_sets = set()
+        emails = 0
+        groups = set()
+        sampler = JokeSampler(broadcast=args.broadcast)
+        for start in range(0, len(subscriber_ids), args.batch_size):
+            ids = subscriber_ids[start:start + args.batch_size]
+            queries[0] = 0
+            began = time.perf_counter()
+            subscribers = Subscriber.query.filter(Subscriber.id.in_(ids)).all()
+            seen = load_seen(ids)
+            selections = select_jokes_for_subscribers(subscribers, seen, sampler)
+            emails += len(selections)
+            for subscriber, joke_ids in selections:
+                joke_sets.add(tuple(joke_ids))
+                groups.add(tuple(sorted(subscriber.preferences["categories"])))
+                for joke_id in joke_ids:
+                    repeats += joke_id in seen[subscriber.id]
+                    seen[subscriber.id].add(joke_id)
+            save_seen({subscriber.id: seen[subscriber.id] for subscriber, _ in selections})
+            db.session.commit()
+            timings.append(time.perf_counter() - began)
+            per_batch.append(queries[0])
+            db.session.expunge_all()
+
+        timings.sort()
+        print(f"{len(timings)} batches of {args.batch_size}: total {sum(timings):.1f}s, "
+              f"p50 {timings[len(timings) // 2] * 1000:.1f} ms, p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} ms")
+        print(f"Queries per batch: min {min(per_batch)}, max {max(per_batch)}")
+        print(f"Repeated jokes: {repeats}")
+        print(f"Distinct joke sets: {len(joke_sets)} for {emails} emails "
+              f"({emails / max(len(joke_sets), 1):.1f} emails per set, {len(groups)} category combinations)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Hammer /rate/<joke_id>/<rating> from many threads and report sustained clicks
+per second and latency, first with RATING_INGEST_MODE=direct (one transaction
+per click) and then with the queued spool, then check that every click of the
+queued run reached the database after its final flush.
+
+Uses DATABASE_URL when set, otherwise a temporary SQLite file.
+
+Usage:
+    python benchmarks/rating_load_test.py --threads 16 --seconds 10 --jokes 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("RATING_SPOOL_DIR", tempfile.mkdtemp())
+
+from sqlalchemy import func
+from app import create_app, db
+from models import Category, Joke, JokeRating
+from rating_queue import get_rating_spool
+
+
+def seed(jokes):
+    category = Category(name="general", description="General jokes")
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all(Joke(content=f"Joke {i}", category_id=category.id) for i in range(jokes))
+    db.session.commit()
+    return [row.id for row in db.session.query(Joke.id)]
+
+
+def rated():
+    return (db.session.query(func.coalesce(func.sum(Joke.rating_count), 0)).scalar(),
+            db.session.query(func.count(JokeRating.id)).scalar())
+
+
+def hammer(app, joke_ids, threads, seconds):
+    deadline = time.monotonic() + seconds
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        client = app.test_client()
+        local = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = client.get(f"/rate/{rnd.choice(joke_ids)}/{rnd.randint(1, 5)}")
+            local.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.monotonic()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {
+        "clicks": len(latencies),
+        "clicks_per_second": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--jokes", type=int, default=50)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        joke_ids = seed(args.jokes)
+
+    for mode in ("direct", "queue"):
+        app.config["RATING_INGEST_MODE"] = mode
+        with app.app_context():
+            before = rated()
+        result = hammer(app, joke_ids, args.threads, args.seconds)
+        if mode == "queue":
+            get_rating_spool(app).flush()
+        with app.app_context():
+            after = rated()
+        stored = after[0] - before[0]
+        print(f"{mode:>6}: {result['clicks']} clicks, {result['clicks_per_second']:.0f}/s, "
+              f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+              f"{result['errors']} errors, {stored} ratings stored "
+              f"({after[1] - before[1]} JokeRating rows)")
+
+
+if __name__ == "__main__":
+    main()
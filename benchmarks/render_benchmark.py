@@ -0,0 +1,64 @@
+"""
+Compare daily joke email rendering throughput: a full ``render_template`` per
+email against the cached DailyJokeRenderer.
+
+Usage:
+    python benchmarks/render_benchmark.py --emails 5000 --distinct-jokes 30
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("SERVER_NAME", "localhost")
+
+from flask import render_template
+from app import create_app, db
+from models import Category, Joke
+from email_service import DailyJokeRenderer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=5000)
+    parser.add_argument("--jokes-per-email", type=int, default=3)
+    parser.add_argument("--distinct-jokes", type=int, default=30,
+                        help="Size of the joke pool the emails draw from")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        category = Category(name="general", description="General jokes")
+        db.session.add(category)
+        db.session.flush()
+        jokes = [Joke(content=f"Joke number {i}", category_id=category.id)
+                 for i in range(args.distinct_jokes)]
+        db.session.add_all(jokes)
+        db.session.commit()
+
+        batches = [
+            (f"user{i}@example.com",
+             [jokes[(i + k) % len(jokes)] for k in range(args.jokes_per_email)])
+            for i in range(args.emails)
+        ]
+
+        started = time.perf_counter()
+        for email, batch in batches:
+            render_template("email/daily_joke.html", jokes=batch, is_welcome=False, email=email)
+        full = time.perf_counter() - started
+
+        renderer = DailyJokeRenderer()
+        started = time.perf_counter()
+        for email, batch in batches:
+            renderer.render(email, batch)
+        cached = time.perf_counter() - started
+
+    print(f"render_template:   {args.emails / full:10.0f} renders/s")
+    print(f"DailyJokeRenderer: {args.emails / cached:10.0f} renders/s ({full / cached:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+"""
+Benchmark the delivery and web hot paths against a seeded database and write
+the results to a JSON file that can be compared between commits.
+
+Seeds subscribers, categories, jokes, send history and ratings, then times
+send_jokes_for_time (with mail suppressed and an optional simulated SMTP
+latency) and the admin_analytics, admin_dashboard, rate_joke and subscribe
+endpoints through the Flask test client. Each scenario reports latency
+percentiles, SQL statements per operation and peak Python memory
+(tracemalloc, measured in a separate pass so it does not skew the timings).
+
+Uses DATABASE_URL when set, otherwise a temporary SQLite file. An existing
+database is only reused empty; pass --reset to drop and recreate its tables.
+
+Usage:
+    python benchmarks/suite.py --subscribers 10000 --jokes 2000 --output before.json
+    python benchmarks/suite.py --subscribers 10000 --jokes 2000 --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, time as dtime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("SERVER_NAME", "localhost")
+os.environ.setdefault("PREFERRED_URL_SCHEME", "http")
+
+from flask_mail import email_dispatched
+from sqlalchemy import event, func, insert
+from app import create_app, db, mail
+from models import Admin, Category, Joke, JokeHistory, JokeRating, Subscriber
+from schema import upgrade_schema
+import scheduler
+
+# First delivery minute of the seeded due subscribers (09:00 UTC)
+FIRST_SLOT = 9 * 60
+
+# Rows per INSERT while seeding
+SEED_CHUNK = 5000
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class QueryCounter:
+    """Counts SQL statements sent to an engine, from any thread."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class FakeMailbox:
+    """
+    Counts emails handed to Flask-Mail with MAIL_SUPPRESS_SEND on, generating
+    their bytes as a real send would and sleeping ``latency`` seconds per
+    message to stand in for an SMTP round trip.
+    """
+
+    def __init__(self, app, latency):
+        self.latency = latency
+        self.sent = 0
+        self.bytes = 0
+        app.config["MAIL_SUPPRESS_SEND"] = True
+        app.config["MAIL_DEFAULT_SENDER"] = app.config.get("MAIL_DEFAULT_SENDER") or "jokes@example.com"
+        # Flask-Mail reads these when it is initialised
+        mail.init_app(app)
+        email_dispatched.connect(self._on_dispatched, app)
+
+    def _on_dispatched(self, app, message):
+        self.sent += 1
+        self.bytes += len(message.as_bytes())
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def _chunked_insert(model, rows):
+    for start in range(0, len(rows), SEED_CHUNK):
+        db.session.execute(insert(model), rows[start:start + SEED_CHUNK])
+
+
+def reset_database():
+    db.drop_all()
+    db.create_all()
+    upgrade_schema()
+    admin = Admin(username="admin")
+    admin.set_password("admin")
+    db.session.add(admin)
+    db.session.commit()
+
+
+def seed(args):
+    """
+    Fill the database: ``args.due`` subscribers in each of the delivery slots
+    the delivery scenario sends, the rest spread over the other minutes of the
+    day, ``args.history`` sent jokes per subscriber and ``args.ratings`` ratings.
+
+    On top of ``args.jokes``, every category gets one never-sent joke per due
+    subscriber wanting it (plus room for their history), since a joke sent in
+    one run is in its resend cooldown for the later ones.
+
+    Returns:
+        tuple: The joke ids and a dict of the rows inserted per table.
+    """
+    rnd = random.Random(args.seed)
+    now = datetime.utcnow()
+
+    names = [f"category{i}" for i in range(args.categories)]
+    _chunked_insert(Category, [
+        {"name": name, "description": f"Benchmark category {i}", "is_active": True}
+        for i, name in enumerate(names)
+    ])
+    category_ids = dict(db.session.query(Category.name, Category.id))
+
+    due_slots = list(range(FIRST_SLOT, FIRST_SLOT + args.delivery_runs + 1))
+    other_slots = [minute for minute in range(24 * 60) if minute not in due_slots]
+    slots = [slot for slot in due_slots for _ in range(args.due)]
+    slots += [rnd.choice(other_slots) for _ in range(max(0, args.subscribers - len(slots)))]
+    subscribers = [
+        {
+            "email": f"user{i}@example.com",
+            "subscribed_at": now - timedelta(days=rnd.randint(0, 365)),
+            "is_active": rnd.random() < 0.95 or slot in due_slots,
+            "preferences": {"categories": rnd.sample(names, min(len(names), rnd.randint(1, 3)))},
+            "delivery_time": dtime(slot // 60, slot % 60),
+            "timezone": "UTC",
+            "delivery_slot": slot,
+            "send_slot": slot,
+        }
+        for i, slot in enumerate(slots)
+    ]
+    demand = Counter(
+        name for row, slot in zip(subscribers, slots) if slot in due_slots
+        for name in row["preferences"]["categories"]
+    )
+
+    jokes = []
+    for i in range(args.jokes):
+        count = rnd.randint(0, 20)
+        total = sum(rnd.randint(1, 5) for _ in range(count))
+        jokes.append({
+            "content": f"Benchmark joke {i}: {rnd.random():.12f}",
+            "category_id": category_ids[names[i % len(names)]],
+            "created_at": now - timedelta(days=rnd.randint(0, 365)),
+            "last_sent": None if rnd.random() < 0.3 else now - timedelta(minutes=rnd.randint(0, 60 * 24 * 30)),
+            "rating_sum": total,
+            "rating_count": count,
+            "rating": total / count if count else 0.0,
+            "times_sent": rnd.randint(0, 50),
+        })
+    for name in names:
+        for i in range(demand[name] + args.history if demand[name] else 0):
+            jokes.append({
+                "content": f"Benchmark {name} delivery joke {i}: {rnd.random():.12f}",
+                "category_id": category_ids[name],
+                "created_at": now - timedelta(days=rnd.randint(0, 365)),
+                "last_sent": None,
+                "rating_sum": 0,
+                "rating_count": 0,
+                "rating": 0.0,
+                "times_sent": 0,
+            })
+    _chunked_insert(Joke, jokes)
+    joke_ids = [row.id for row in db.session.query(Joke.id)]
+
+    _chunked_insert(Subscriber, subscribers)
+    subscriber_ids = [row.id for row in db.session.query(Subscriber.id)]
+
+    history = [
+        {"joke_id": rnd.choice(joke_ids), "user": subscriber_id,
+         "sent_at": now - timedelta(days=rnd.randint(1, 365))}
+        for subscriber_id in subscriber_ids
+        for _ in range(args.history)
+    ]
+    _chunked_insert(JokeHistory, history)
+    _chunked_insert(JokeRating, [
+        {"joke_id": rnd.choice(joke_ids), "rating": rnd.randint(1, 5),
+         "created_at": now - timedelta(days=rnd.randint(0, 365))}
+        for _ in range(args.ratings)
+    ])
+    db.session.commit()
+    return joke_ids, {
+        "subscribers": len(subscribers),
+        "jokes": len(jokes),
+        "history": len(history),
+        "ratings": args.ratings,
+    }
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(step, iterations, memory_iterations, counter, warmup=0):
+    """
+    Time ``step(i)`` ``iterations`` times, then run it ``memory_iterations``
+    more times under tracemalloc for the peak allocation.
+
+    Returns:
+        dict: Latency percentiles in milliseconds, queries per operation and peak memory.
+    """
+    for i in range(warmup):
+        step(i)
+
+    timings = []
+    queries = []
+    for i in range(warmup, warmup + iterations):
+        counter.count = 0
+        started = time.perf_counter()
+        step(i)
+        timings.append(time.perf_counter() - started)
+        queries.append(counter.count)
+
+    peak = None
+    if memory_iterations:
+        tracemalloc.start()
+        try:
+            for i in range(warmup + iterations, warmup + iterations + memory_iterations):
+                step(i)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    timings.sort()
+    result = {
+        "samples": len(timings),
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+        "queries_mean": round(sum(queries) / len(queries), 2),
+        "queries_max": max(queries),
+        "peak_memory_kib": round(peak / 1024, 1) if peak is not None else None,
+    }
+    for pct in PERCENTILES:
+        result[f"p{pct}_ms"] = round(percentile(timings, pct) * 1000, 3)
+    return result
+
+
+def bench_delivery(app, args, counter, mailbox):
+    """
+    Each step sends one seeded slot with send_jokes_for_time, as the minutely job does.
+
+    Fails when a run sends fewer than ``args.due`` emails, as its timing
+    would not be of a full tick.
+    """
+    scheduler.scheduler.init_app(app)
+    runs = []
+
+    def step(i):
+        before = mailbox.sent
+        slot = FIRST_SLOT + i
+        started = time.perf_counter()
+        scheduler.send_jokes_for_time(slot // 60, slot % 60)
+        runs.append((mailbox.sent - before, time.perf_counter() - started))
+
+    result = run_scenario(step, args.delivery_runs, 1, counter)
+    short = [sent for sent, _ in runs if sent < args.due]
+    if short:
+        raise SystemExit(f"Delivery runs sent {[sent for sent, _ in runs]} emails, expected {args.due} each; "
+                         "the timings are not of full ticks")
+    # The last run is the tracemalloc pass
+    timed = runs[:args.delivery_runs]
+    rates = sorted(sent / elapsed for sent, elapsed in timed if elapsed)
+    result["emails_per_run"] = [sent for sent, _ in timed]
+    result["emails_sent"] = sum(sent for sent, _ in timed)
+    result["emails_per_second"] = round(rates[len(rates) // 2], 1) if rates else None
+    return result
+
+
+def bench_web(app, args, counter, joke_ids):
+    """Time the web endpoints through the test client, each with its own warmup."""
+    rnd = random.Random(args.seed + 1)
+    results = {}
+
+    admin = app.test_client()
+    response = admin.post("/admin/login", data={"username": "admin", "password": "admin"})
+    if response.status_code != 302:
+        raise SystemExit("Could not log in as admin/admin")
+
+    def get(client, path, expected=200):
+        def step(i):
+            response = client.get(path)
+            if response.status_code != expected:
+                raise SystemExit(f"GET {path} returned {response.status_code}")
+        return step
+
+    results["admin_analytics"] = run_scenario(get(admin, "/admin/analytics"), args.iterations,
+                                              args.memory_iterations, counter, warmup=args.warmup)
+    results["admin_dashboard"] = run_scenario(get(admin, "/admin/dashboard"), args.iterations,
+                                              args.memory_iterations, counter, warmup=args.warmup)
+
+    visitor = app.test_client()
+
+    def rate(i):
+        response = visitor.get(f"/rate/{rnd.choice(joke_ids)}/{rnd.randint(1, 5)}")
+        if response.status_code != 200:
+            raise SystemExit(f"rate_joke returned {response.status_code}")
+
+    results["rate_joke"] = run_scenario(rate, args.iterations, args.memory_iterations,
+                                        counter, warmup=args.warmup)
+
+    names = [name for name, in db.session.query(Category.name)]
+
+    def subscribe(i):
+        response = visitor.post("/subscribe", data={
+            "email": f"new{i}@example.com",
+            "categories": rnd.sample(names, min(len(names), 2)),
+            "delivery_time": f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}",
+            "timezone": "Europe/Berlin",
+        })
+        if response.status_code != 302:
+            raise SystemExit(f"subscribe returned {response.status_code}")
+
+    results["subscribe"] = run_scenario(subscribe, args.iterations, args.memory_iterations,
+                                        counter, warmup=args.warmup)
+    return results
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def print_results(results):
+    print(f"{'scenario':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'peak KiB':>10}")
+    for name, result in results.items():
+        peak = result["peak_memory_kib"]
+        print(f"{name:<18}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['queries_mean']:>10.1f}{peak if peak is not None else '-':>10}")
+
+
+def print_comparison(results, baseline):
+    def change(new, old):
+        if new is None or old is None:
+            return "-"
+        if not old:
+            return "new" if new else "0%"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"\nAgainst {baseline['meta'].get('commit') or 'baseline'}:")
+    print(f"{'scenario':<18}{'p50':>10}{'p95':>10}{'queries':>10}{'peak':>10}")
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:<18}{'(not in baseline)':>40}")
+            continue
+        print(f"{name:<18}{change(result['p50_ms'], old['p50_ms']):>10}"
+              f"{change(result['p95_ms'], old['p95_ms']):>10}"
+              f"{change(result['queries_mean'], old['queries_mean']):>10}"
+              f"{change(result['peak_memory_kib'], old['peak_memory_kib']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--jokes", type=int, default=2000)
+    parser.add_argument("--history", type=int, default=20, help="sent jokes recorded per subscriber")
+    parser.add_argument("--ratings", type=int, default=20000)
+    parser.add_argument("--due", type=int, default=500, help="subscribers due in each timed delivery run")
+    parser.add_argument("--delivery-runs", type=int, default=5)
+    parser.add_argument("--smtp-latency", type=float, default=0.0, help="simulated milliseconds per email")
+    parser.add_argument("--iterations", type=int, default=200, help="timed requests per web scenario")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--memory-iterations", type=int, default=20)
+    parser.add_argument("--rating-mode", choices=("direct", "queue"), default="direct")
+    parser.add_argument("--delivery-mode", choices=("individual", "broadcast"), default="individual")
+    parser.add_argument("--scenarios", default="delivery,web", help="comma-separated: delivery, web")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="drop and recreate the tables of a non-empty database")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="earlier results file to print changes against")
+    args = parser.parse_args()
+    scenarios = set(args.scenarios.split(","))
+
+    app = create_app()
+    app.config["RATING_INGEST_MODE"] = args.rating_mode
+    app.config["DELIVERY_MODE"] = args.delivery_mode
+    mailbox = FakeMailbox(app, args.smtp_latency / 1000)
+
+    with app.app_context():
+        if db.session.query(func.count(Subscriber.id)).scalar():
+            if not args.reset:
+                raise SystemExit("The database already has subscribers; pass --reset to drop and recreate it")
+            reset_database()
+        started = time.perf_counter()
+        joke_ids, inserted = seed(args)
+        seeded = time.perf_counter() - started
+        print(f"Seeded {inserted['subscribers']} subscribers, {inserted['jokes']} jokes, "
+              f"{inserted['history']} history rows, {inserted['ratings']} ratings "
+              f"in {seeded:.1f}s ({db.engine.dialect.name})")
+
+        counter = QueryCounter(db.engine)
+        results = {}
+        if "delivery" in scenarios:
+            results["send_jokes_for_time"] = bench_delivery(app, args, counter, mailbox)
+        if "web" in scenarios:
+            results.update(bench_web(app, args, counter, joke_ids))
+        dialect = db.engine.dialect.name
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": platform.python_version(),
+            "database": dialect,
+            "seed_seconds": round(seeded, 2),
+            "seeded_rows": inserted,
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results)
+    print(f"\nWrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
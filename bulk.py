@@ -0,0 +1,542 @@
+import csv
+import functools
+import io
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, update
+from app import db
+from models import Category, ImportJob, Joke, Subscriber, MINUTES_PER_DAY, is_valid_timezone, utc_offset_minutes
+from category_cache import categories_changed
+from dedup import insert_jokes
+from analytics import record_change
+from rating_queue import _HOST, _pid_alive
+from utils.db_utils import dialect_insert
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl')
+
+# Columns written by the exports; imports read the ones they understand
+SUBSCRIBER_FIELDS = ('email', 'is_active', 'categories', 'delivery_time', 'timezone', 'subscribed_at')
+JOKE_FIELDS = ('id', 'category', 'content', 'rating', 'rating_count', 'times_sent', 'created_at')
+
+# Categories are a list in JSONL and joined with this in CSV
+CATEGORY_SEPARATOR = '|'
+
+# Error messages kept in an import summary
+MAX_REPORTED_ERRORS = 20
+
+
+class RecordError(ValueError):
+    """A record that cannot be imported; the import skips it and goes on."""
+
+
+def format_for(filename, default='csv'):
+    """Guess csv or jsonl from a file name."""
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_records(stream, fmt):
+    """
+    Yield one dict per record of a CSV (with a header row) or JSONL text stream.
+
+    Records are parsed as they are read, so memory does not grow with the file.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield RecordError(f"line {number}: {e}")
+            continue
+        yield record if isinstance(record, dict) else RecordError(f"line {number}: not a JSON object")
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _parse_bool(value, default=True):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 't', 'yes', 'y'):
+        return True
+    if text in ('0', 'false', 'f', 'no', 'n'):
+        return False
+    raise RecordError(f"not a boolean: {value!r}")
+
+
+def _parse_time(value):
+    if not value:
+        return datetime.strptime('09:00', '%H:%M').time()
+    for pattern in ('%H:%M', '%H:%M:%S'):
+        try:
+            return datetime.strptime(str(value).strip(), pattern).time()
+        except ValueError:
+            pass
+    raise RecordError(f"not a time: {value!r}")
+
+
+def _parse_datetime(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise RecordError(f"not an ISO date: {value!r}")
+
+
+def _parse_categories(value):
+    if isinstance(value, list):
+        names = value
+    else:
+        names = str(value or '').split(CATEGORY_SEPARATOR)
+    names = [str(name).strip() for name in names if str(name).strip()]
+    return names or ['general']
+
+
+@functools.lru_cache(maxsize=1024)
+def _zone(timezone):
+    """(timezone, current UTC offset in minutes); an unknown zone rejects the record."""
+    if not is_valid_timezone(timezone):
+        raise RecordError(f"unknown timezone: {timezone!r}")
+    return timezone, utc_offset_minutes(timezone)
+
+
+def _subscriber_row(record, now):
+    email = (record.get('email') or '').strip()
+    if '@' not in email or len(email) > 120:
+        raise RecordError(f"invalid email: {email!r}")
+    delivery_time = _parse_time(record.get('delivery_time'))
+    # Looked up once per zone per import rather than once per row
+    timezone, offset = _zone((record.get('timezone') or 'UTC').strip())
+    slot = (delivery_time.hour * 60 + delivery_time.minute - offset) % MINUTES_PER_DAY
+    return {
+        'email': email,
+        'is_active': _parse_bool(record.get('is_active')),
+        'preferences': {'categories': _parse_categories(record.get('categories'))},
+        'delivery_time': delivery_time,
+        'timezone': timezone,
+        'delivery_slot': slot,
+        'send_slot': slot,
+        'subscribed_at': _parse_datetime(record.get('subscribed_at')) or now,
+    }
+
+
+class ImportSummary:
+    """Counts kept while an import runs, and the first few record errors."""
+
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.errors = []
+
+    def error(self, number, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"record {number}: {message}")
+
+    def as_dict(self):
+        return {'read': self.read, 'imported': self.imported, 'skipped': self.skipped,
+                'duplicates': self.duplicates, 'errors': self.errors}
+
+
+def _parsed(records, summary, parse):
+    """Number and parse records, counting the ones that fail instead of stopping."""
+    for record in records:
+        summary.read += 1
+        if isinstance(record, RecordError):
+            summary.error(summary.read, str(record))
+            continue
+        try:
+            yield parse(record)
+        except RecordError as e:
+            summary.error(summary.read, str(e))
+
+
+def import_subscribers(stream, fmt='csv', chunk_size=None, progress=None):
+    """
+    Upsert subscribers from a CSV or JSONL stream, matched on email.
+
+    Every chunk is one batched INSERT ... ON CONFLICT (email) DO UPDATE
+    committed on its own, so memory stays flat and an interrupted import
+    keeps the chunks already written. Existing subscribers keep their
+    subscription date; everything else is replaced by the file.
+
+    Args:
+        stream: A text stream.
+        fmt: 'csv' or 'jsonl'.
+        chunk_size: Records per statement (defaults to BULK_CHUNK_SIZE).
+        progress: Called with the ImportSummary after each committed chunk.
+
+    Returns:
+        dict: read, imported, skipped and duplicates counts and the first errors.
+    """
+    chunk_size = chunk_size or current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    summary = ImportSummary()
+    now = datetime.utcnow()
+    _zone.cache_clear()
+    rows = _parsed(read_records(stream, fmt), summary, lambda record: _subscriber_row(record, now))
+    # Compiled once; SQLAlchemy batches each chunk into multi-row VALUES where the driver allows
+    statement = dialect_insert(Subscriber)
+    statement = statement.on_conflict_do_update(
+        index_elements=['email'],
+        set_={name: statement.excluded[name] for name in (
+            'is_active', 'preferences', 'delivery_time', 'timezone', 'delivery_slot', 'send_slot'
+        )}
+    )
+    for chunk in _chunks(rows, chunk_size):
+        # One statement cannot update the same row twice; the last occurrence wins
+        by_email = {row['email']: row for row in chunk}
+        summary.duplicates += len(chunk) - len(by_email)
+        db.session.execute(statement, list(by_email.values()))
+        # An upsert does not say what each row was before; have the rollup recount
+        record_change(recount=True)
+        db.session.commit()
+        summary.imported += len(by_email)
+        if progress:
+            progress(summary)
+    logger.info(f"Imported {summary.imported} subscribers ({summary.skipped} skipped)")
+    return summary.as_dict()
+
+
+def _joke_row(record):
+    content = (record.get('content') or '').strip()
+    if not content:
+        raise RecordError("empty joke")
+    category = (record.get('category') or '').strip()
+    if not category or len(category) > 50:
+        raise RecordError(f"invalid category: {category!r}")
+    return category, content
+
+
+def _category_ids(names):
+    """Map category names to ids, creating the missing ones as active categories."""
+    statement = dialect_insert(Category).values([{'name': name, 'is_active': True} for name in names])
+    created = db.session.execute(
+        statement.on_conflict_do_nothing(index_elements=['name']).returning(Category.id)
+    ).all()
+    if created:
+        categories_changed()
+    return dict(db.session.query(Category.name, Category.id).filter(Category.name.in_(names)))
+
+
+def import_jokes(stream, fmt='csv', chunk_size=None, progress=None):
+    """
+    Import jokes from a CSV or JSONL stream with ``category`` and ``content`` columns.
+
+    Categories are upserted by name. Jokes go through dedup.insert_jokes one
+    chunk per category at a time, so exact and near-duplicates of existing
+    jokes or of each other are skipped and counted. Each chunk is committed
+    on its own.
+
+    Args:
+        stream: A text stream.
+        fmt: 'csv' or 'jsonl'.
+        chunk_size: Records per chunk (defaults to BULK_CHUNK_SIZE).
+        progress: Called with the ImportSummary after each committed chunk.
+
+    Returns:
+        dict: read, imported, skipped and duplicates counts and the first errors.
+    """
+    chunk_size = chunk_size or current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    summary = ImportSummary()
+    rows = _parsed(read_records(stream, fmt), summary, _joke_row)
+    for chunk in _chunks(rows, chunk_size):
+        by_category = {}
+        for category, content in chunk:
+            by_category.setdefault(category, []).append(content)
+        ids = _category_ids(list(by_category))
+        for category, contents in by_category.items():
+            inserted, duplicates = insert_jokes(ids[category], contents)
+            summary.imported += len(inserted)
+            summary.duplicates += len(duplicates)
+        db.session.commit()
+        if progress:
+            progress(summary)
+    logger.info(f"Imported {summary.imported} jokes ({summary.duplicates} duplicates, {summary.skipped} skipped)")
+    return summary.as_dict()
+
+
+def _subscriber_records():
+    statement = select(
+        Subscriber.email, Subscriber.is_active, Subscriber.preferences,
+        Subscriber.delivery_time, Subscriber.timezone, Subscriber.subscribed_at
+    ).order_by(Subscriber.id)
+    for row in _stream(statement):
+        yield {
+            'email': row.email,
+            'is_active': bool(row.is_active),
+            'categories': (row.preferences or {}).get('categories', []),
+            'delivery_time': row.delivery_time.strftime('%H:%M') if row.delivery_time else '',
+            'timezone': row.timezone or 'UTC',
+            'subscribed_at': row.subscribed_at.isoformat() if row.subscribed_at else '',
+        }
+
+
+def _joke_records():
+    statement = select(
+        Joke.id, Category.name.label('category'), Joke.content, Joke.rating,
+        Joke.rating_count, Joke.times_sent, Joke.created_at
+    ).join(Category, Joke.category_id == Category.id).order_by(Joke.id)
+    for row in _stream(statement):
+        yield {
+            'id': row.id,
+            'category': row.category,
+            'content': row.content,
+            'rating': row.rating or 0.0,
+            'rating_count': row.rating_count or 0,
+            'times_sent': row.times_sent or 0,
+            'created_at': row.created_at.isoformat() if row.created_at else '',
+        }
+
+
+def _stream(statement):
+    """Run a Core select and yield its rows in BULK_CHUNK_SIZE batches (a server-side cursor on PostgreSQL)."""
+    size = current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    result = db.session.execute(statement.execution_options(yield_per=size))
+    for partition in result.partitions():
+        yield from partition
+
+
+EXPORTS = {
+    'subscribers': (_subscriber_records, SUBSCRIBER_FIELDS),
+    'jokes': (_joke_records, JOKE_FIELDS),
+}
+
+IMPORTS = {
+    'subscribers': import_subscribers,
+    'jokes': import_jokes,
+}
+
+_executor_lock = threading.Lock()
+
+
+def spool_import(upload, kind, fmt):
+    """
+    Save an uploaded file to BULK_SPOOL_DIR and queue an ImportJob for it.
+
+    Args:
+        upload: The werkzeug FileStorage.
+        kind: 'subscribers' or 'jokes'.
+        fmt: 'csv' or 'jsonl'.
+
+    Returns:
+        ImportJob: The committed job; start it with start_import.
+    """
+    directory = current_app.config['BULK_SPOOL_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"import-{uuid.uuid4().hex}.{fmt}")
+    upload.save(path)
+    job = ImportJob(kind=kind, format=fmt, filename=(upload.filename or '')[:255] or None,
+                    path=path, host=_HOST, pid=os.getpid())
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        os.remove(path)
+        raise
+    return job
+
+
+def _save_progress(job, counts):
+    job.read = counts['read']
+    job.imported = counts['imported']
+    job.skipped = counts['skipped']
+    job.duplicates = counts['duplicates']
+    job.errors = list(counts['errors'])
+    job.updated_at = datetime.utcnow()
+
+
+def run_import_job(job_id):
+    """
+    Run a queued import from its spool file.
+
+    The job's counts are saved with every committed chunk, so polling it shows
+    how far the import has got, and a failure leaves the chunks before it in
+    place. The spool file is removed once the job has finished either way.
+
+    Args:
+        job_id: ImportJob id.
+    """
+    job = db.session.get(ImportJob, job_id)
+    job.status = ImportJob.RUNNING
+    job.started_at = job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    def progress(summary):
+        _save_progress(job, summary.as_dict())
+        db.session.commit()
+
+    try:
+        with open(job.path, encoding='utf-8-sig', newline='') as stream:
+            counts = IMPORTS[job.kind](stream, job.format, progress=progress)
+        _save_progress(job, counts)
+        job.status = ImportJob.DONE
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Bulk import job {job_id} failed: {str(e)}")
+        job.status = ImportJob.FAILED
+        job.error = f"Import failed; chunks before the error were saved: {str(e)}"[:255]
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    try:
+        os.remove(job.path)
+    except FileNotFoundError:
+        pass
+    logger.info(f"Bulk import job {job_id} of {job.kind}: {job.status}, {job.imported} imported")
+
+
+def _run_in_app(app, job_id):
+    with app.app_context():
+        try:
+            run_import_job(job_id)
+        except Exception as e:
+            logger.error(f"Bulk import job {job_id} could not run: {str(e)}")
+
+
+def _orphaned_jobs():
+    """
+    Take over unfinished jobs of dead workers on this host.
+
+    Their spool files are still here, and both imports are safe to run again
+    from the start: subscribers are upserted and repeated jokes are skipped as
+    duplicates. Jobs whose file is gone are marked failed.
+    """
+    me = os.getpid()
+    claimed = []
+    for job in ImportJob.query.filter(
+        ImportJob.host == _HOST,
+        ImportJob.status.in_([ImportJob.QUEUED, ImportJob.RUNNING]),
+        ImportJob.pid != me,
+    ).all():
+        if _pid_alive(job.pid):
+            continue
+        resumable = os.path.exists(job.path)
+        # Only one surviving worker gets each job
+        taken = db.session.execute(
+            update(ImportJob).where(ImportJob.id == job.id, ImportJob.pid == job.pid).values(
+                pid=me,
+                status=ImportJob.QUEUED if resumable else ImportJob.FAILED,
+                error=None if resumable else 'Interrupted and the upload is gone; upload the file again',
+            )
+        ).rowcount
+        if taken and resumable:
+            claimed.append(job.id)
+    db.session.commit()
+    return claimed
+
+
+def start_import(job_id, app=None):
+    """
+    Run an import job on this process's import thread.
+
+    The thread is created lazily in each worker, since threads started in a
+    preloading parent do not survive the fork. Creating it also resumes jobs
+    left behind by dead workers on this host. One thread per worker keeps
+    imports from competing with each other for the database.
+    """
+    app = app or current_app._get_current_object()
+    with _executor_lock:
+        pid, executor = app.extensions.get('bulk_imports', (None, None))
+        resumed = []
+        if pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bulk-import')
+            app.extensions['bulk_imports'] = (os.getpid(), executor)
+            resumed = _orphaned_jobs()
+    for orphan in resumed:
+        logger.info(f"Resuming bulk import job {orphan} left by a dead worker")
+        executor.submit(_run_in_app, app, orphan)
+    return executor.submit(_run_in_app, app, job_id)
+
+
+def export_lines(kind, fmt='csv', chunk_size=None):
+    """
+    Yield an export of all subscribers or jokes as text, a few hundred kilobytes at a time.
+
+    Rows are read as plain tuples through a streaming cursor and never
+    loaded into the session, so memory stays flat however large the table.
+
+    Args:
+        kind: 'subscribers' or 'jokes'.
+        fmt: 'csv' or 'jsonl'.
+        chunk_size: Records per yielded piece (defaults to BULK_CHUNK_SIZE).
+    """
+    chunk_size = chunk_size or current_app.config.get('BULK_CHUNK_SIZE', 1000)
+    records, fields = EXPORTS[kind]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+    for chunk in _chunks(records(), chunk_size):
+        for record in chunk:
+            if writer:
+                if kind == 'subscribers':
+                    record['categories'] = CATEGORY_SEPARATOR.join(record['categories'])
+                writer.writerow(record)
+            else:
+                buffer.write(json.dumps(record, ensure_ascii=False))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# flask --app main bulk ...
+bulk_cli = AppGroup('bulk', help='Import and export subscribers and jokes as CSV or JSONL.')
+
+
+@bulk_cli.command('import')
+@click.argument('kind', type=click.Choice(list(IMPORTS)))
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension, else csv.')
+@click.option('--chunk-size', type=int, help='Records per statement.')
+def import_command(kind, source, fmt, chunk_size):
+    """Import KIND from SOURCE (a path, or - for stdin)."""
+    summary = IMPORTS[kind](source, fmt or format_for(source.name), chunk_size)
+    click.echo(f"read {summary['read']}, imported {summary['imported']}, "
+               f"duplicates {summary['duplicates']}, skipped {summary['skipped']}")
+    for error in summary['errors']:
+        click.echo(f"  {error}", err=True)
+
+
+@bulk_cli.command('export')
+@click.argument('kind', type=click.Choice(list(EXPORTS)))
+@click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension, else csv.')
+def export_command(kind, target, fmt):
+    """Export KIND to TARGET (a path, or stdout)."""
+    for piece in export_lines(kind, fmt or format_for(target.name)):
+        target.write(piece)
@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from models import Category, CacheVersion
+
+# Detached snapshot of a Category row, safe to share between sessions and threads
+CachedCategory = namedtuple('CachedCategory', 'id name description is_active')
+
+
+class CategoryCache:
+    """
+    In-process name -> category cache.
+
+    Entries are reloaded after ``CATEGORY_CACHE_TTL`` seconds, and at most every
+    ``CATEGORY_CACHE_CHECK_INTERVAL`` seconds the shared ``categories`` version
+    is read so that changes made by another gunicorn worker or the scheduler
+    process are picked up quickly. Admin views call invalidate() after
+    changing categories, which reloads this process immediately.
+    """
+
+    VERSION_KEY = 'categories'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = None
+        self._version = None
+        self._changed_at = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _is_fresh(self, now):
+        if self._by_name is None:
+            return False
+        config = current_app.config
+        if now - self._loaded_at >= config.get('CATEGORY_CACHE_TTL', 300):
+            return False
+        if now - self._checked_at >= config.get('CATEGORY_CACHE_CHECK_INTERVAL', 5):
+            self._checked_at = now
+            return CacheVersion.current(self.VERSION_KEY) == self._version
+        return True
+
+    def _entries(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._is_fresh(now):
+                self.hits += 1
+                return self._by_name
+            self.misses += 1
+            self.reloads += 1
+            version, changed_at = CacheVersion.state(self.VERSION_KEY)
+            self._by_name = {
+                category.name: CachedCategory(
+                    category.id, category.name, category.description, bool(category.is_active)
+                )
+                for category in Category.query.order_by(Category.id)
+            }
+            self._version = version
+            self._changed_at = changed_at
+            self._loaded_at = self._checked_at = now
+            return self._by_name
+
+    def get(self, name):
+        """Return the cached category with this name, or None."""
+        return self._entries().get(name)
+
+    def active(self):
+        """Return all active categories, ordered by id."""
+        return [category for category in self._entries().values() if category.is_active]
+
+    def active_by_name(self, names):
+        """Return a name -> category mapping for the active categories among names."""
+        entries = self._entries()
+        found = {}
+        for name in names:
+            category = entries.get(name)
+            if category and category.is_active:
+                found[name] = category
+        return found
+
+    def version(self):
+        """
+        Return (version, changed_at) of the categories this process has loaded.
+
+        Goes through the same freshness checks as a lookup, so it reads the
+        database only when a lookup would.
+        """
+        self._entries()
+        with self._lock:
+            return self._version, self._changed_at
+
+    def invalidate(self):
+        """Drop the cached entries so the next lookup reloads them."""
+        with self._lock:
+            self._by_name = None
+
+    def stats(self):
+        """Hit/miss counters for this process."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+category_cache = CategoryCache()
+
+
+def categories_changed():
+    """
+    Record a category change: bump the shared version in the current
+    transaction and drop this process's cache. Call before committing.
+    """
+    CacheVersion.bump(CategoryCache.VERSION_KEY)
+    category_cache.invalidate()
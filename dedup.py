@@ -0,0 +1,306 @@
+import hashlib
+import logging
+import re
+import unicodedata
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import insert
+from app import db
+from models import Joke, JokeFingerprint, CacheVersion
+from analytics import record_change
+from utils.db_utils import dialect_insert, update_from_values
+
+logger = logging.getLogger(__name__)
+
+# Character shingle length used for similarity
+SHINGLE_SIZE = 5
+
+# One-permutation MinHash: every shingle hash lands in one of SIGNATURE_BINS
+# bins and each bin keeps its minimum, so a signature costs one hash per
+# shingle instead of one per shingle per permutation
+SIGNATURE_BINS = 32
+_BIN_SHIFT = 64 - SIGNATURE_BINS.bit_length() + 1
+_VALUE_MASK = (1 << _BIN_SHIFT) - 1
+_EMPTY = 1 << 64
+_MASK64 = (1 << 64) - 1
+_MIX = 0x9E3779B97F4A7C15
+
+# LSH banding: jokes sharing all ROWS_PER_BAND bins of any band become
+# candidates (about 89% recall at Jaccard 0.7, 98% at 0.8)
+BANDS = 8
+ROWS_PER_BAND = SIGNATURE_BINS // BANDS
+
+# A joke as seen by the index
+Fingerprint = namedtuple('Fingerprint', 'content content_hash shingles buckets')
+
+# Bumped whenever normalize() changes, so stored fingerprints are recomputed
+# once (see reindex_stale); kept as a CacheVersion counter
+INDEX_VERSION = 1
+INDEX_VERSION_KEY = 'dedup_index'
+
+
+def normalize(text):
+    """Casefold, strip accents and punctuation, and collapse whitespace; any script."""
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def _int64(data):
+    """Stable signed 64-bit hash, so it fits a BIGINT column."""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big', signed=True)
+
+
+# content_hash of jokes with nothing to compare
+EMPTY_HASH = _int64(b'')
+
+
+def shingles(normalized):
+    """The set of overlapping character shingles of normalized text."""
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def signature(shingle_set):
+    """
+    One-permutation MinHash signature of a shingle set.
+
+    Empty bins borrow the value of the next filled bin, offset by the
+    distance, so short texts still produce comparable signatures.
+    """
+    bins = [_EMPTY] * SIGNATURE_BINS
+    for shingle in shingle_set:
+        value = (zlib.crc32(shingle.encode()) * _MIX) & _MASK64
+        index = value >> _BIN_SHIFT
+        value &= _VALUE_MASK
+        if value < bins[index]:
+            bins[index] = value
+    if _EMPTY in bins and len(set(bins)) > 1:
+        filled = list(bins)
+        for index, value in enumerate(bins):
+            distance = 1
+            while value == _EMPTY:
+                value = bins[(index + distance) % SIGNATURE_BINS]
+                distance += 1
+            filled[index] = value if distance == 1 else value + distance - 1
+        bins = filled
+    return bins
+
+
+def band_buckets(bins):
+    """Hash each band of a signature into a bucket id."""
+    return [
+        _int64(band.to_bytes(1, 'big') + b''.join(
+            value.to_bytes(9, 'big') for value in bins[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        ))
+        for band in range(BANDS)
+    ]
+
+
+def fingerprint(content):
+    """
+    Compute everything the index stores or compares for one joke.
+
+    Text with no words left after normalizing (e.g. only emoji) gets the
+    hash of the empty string and no buckets: it is never compared.
+    """
+    normalized = normalize(content)
+    if not normalized:
+        return Fingerprint(content=content, content_hash=EMPTY_HASH, shingles=set(), buckets=[])
+    shingle_set = shingles(normalized)
+    return Fingerprint(
+        content=content,
+        content_hash=_int64(normalized.encode()),
+        shingles=shingle_set,
+        buckets=band_buckets(signature(shingle_set)),
+    )
+
+
+def similarity(left, right):
+    """Jaccard similarity of two shingle sets."""
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+
+def find_duplicates(fingerprints, threshold=None):
+    """
+    Check candidate jokes against the index and against each other.
+
+    Runs two indexed queries however many candidates there are: exact
+    matches by normalized-text hash, then LSH bucket collisions, which are
+    confirmed by comparing shingles with the stored joke text. Candidates
+    with no words (EMPTY_HASH) are never duplicates.
+
+    Args:
+        fingerprints: A list of Fingerprint tuples.
+        threshold: Minimum Jaccard similarity counted as a duplicate
+            (defaults to JOKE_DEDUP_THRESHOLD).
+
+    Returns:
+        dict: Maps the position of every duplicate candidate to the id of the
+        joke it duplicates, or None if it repeats an earlier candidate in the
+        same list. New candidates are absent.
+    """
+    if threshold is None:
+        threshold = current_app.config.get('JOKE_DEDUP_THRESHOLD', 0.7)
+    if not fingerprints:
+        return {}
+
+    exact = dict(
+        db.session.query(Joke.content_hash, Joke.id).filter(
+            Joke.content_hash.in_({fp.content_hash for fp in fingerprints} - {EMPTY_HASH})
+        )
+    )
+    buckets = {bucket for fp in fingerprints for bucket in fp.buckets}
+    colliding = {}
+    candidates = {}
+    for bucket, joke_id, content in db.session.query(
+        JokeFingerprint.bucket, Joke.id, Joke.content
+    ).join(Joke, Joke.id == JokeFingerprint.joke_id).filter(JokeFingerprint.bucket.in_(buckets)):
+        colliding.setdefault(bucket, set()).add(joke_id)
+        if joke_id not in candidates:
+            candidates[joke_id] = shingles(normalize(content))
+
+    duplicates = {}
+    accepted = []
+    for position, fp in enumerate(fingerprints):
+        if fp.content_hash == EMPTY_HASH:
+            continue
+        if fp.content_hash in exact:
+            duplicates[position] = exact[fp.content_hash]
+            continue
+        nearby = set().union(*(colliding.get(bucket, ()) for bucket in fp.buckets))
+        match = next(
+            (joke_id for joke_id in sorted(nearby)
+             if similarity(fp.shingles, candidates[joke_id]) >= threshold),
+            None
+        )
+        if match is not None:
+            duplicates[position] = match
+            continue
+        if any(
+            other.content_hash == fp.content_hash
+            or (set(other.buckets) & set(fp.buckets) and similarity(other.shingles, fp.shingles) >= threshold)
+            for other in accepted
+        ):
+            duplicates[position] = None
+            continue
+        accepted.append(fp)
+    return duplicates
+
+
+def _index(rows):
+    """Insert the bucket rows for (joke_id, Fingerprint) pairs."""
+    entries = [
+        {'bucket': bucket, 'joke_id': joke_id}
+        for joke_id, fp in rows for bucket in set(fp.buckets)
+    ]
+    if entries:
+        db.session.execute(
+            dialect_insert(JokeFingerprint).values(entries).on_conflict_do_nothing()
+        )
+
+
+def insert_jokes(category_id, contents, created_at=None):
+    """
+    Insert jokes that are not near-duplicates of existing ones and index them.
+
+    The caller commits.
+
+    Args:
+        category_id: Category the jokes belong to.
+        contents: A list of joke texts.
+        created_at: Creation time stored on the new rows (defaults to utcnow).
+
+    Returns:
+        tuple: (list of new joke ids, dict of duplicates as returned by find_duplicates).
+    """
+    created_at = created_at or datetime.utcnow()
+    fingerprints = [fingerprint(content) for content in contents]
+    duplicates = find_duplicates(fingerprints)
+    fresh = [fp for position, fp in enumerate(fingerprints) if position not in duplicates]
+    if not fresh:
+        return [], duplicates
+
+    ids = db.session.scalars(
+        insert(Joke).returning(Joke.id, sort_by_parameter_order=True),
+        [
+            {'content': fp.content, 'category_id': category_id,
+             'created_at': created_at, 'content_hash': fp.content_hash}
+            for fp in fresh
+        ]
+    ).all()
+    _index(zip(ids, fresh))
+    record_change(jokes=len(ids))
+    if duplicates:
+        logger.info(f"Skipped {len(duplicates)} duplicate joke(s) in category {category_id}")
+    return ids, duplicates
+
+
+def backfill_index(chunk_size=1000):
+    """
+    Fingerprint jokes that predate the index, a chunk per transaction.
+
+    Returns:
+        int: Number of jokes indexed.
+    """
+    indexed = 0
+    while True:
+        rows = db.session.query(Joke.id, Joke.content).filter(
+            Joke.content_hash == None
+        ).order_by(Joke.id).limit(chunk_size).all()
+        if not rows:
+            return indexed
+        fingerprints = [(joke_id, fingerprint(content)) for joke_id, content in rows]
+        update_from_values(Joke, [
+            {'id': joke_id, 'content_hash': fp.content_hash} for joke_id, fp in fingerprints
+        ])
+        _index(fingerprints)
+        db.session.commit()
+        indexed += len(rows)
+        logger.info(f"Indexed {indexed} existing jokes for duplicate detection")
+
+
+def reindex_stale(chunk_size=1000):
+    """
+    Recompute fingerprints stored under an older normalize(), once per
+    INDEX_VERSION, a chunk per transaction.
+
+    Returns:
+        int: Number of jokes whose fingerprint changed.
+    """
+    if CacheVersion.current(INDEX_VERSION_KEY) >= INDEX_VERSION:
+        return 0
+    changed = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Joke.id, Joke.content, Joke.content_hash).filter(
+            Joke.id > last_id
+        ).order_by(Joke.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        stale = []
+        for joke_id, content, content_hash in rows:
+            fp = fingerprint(content)
+            if fp.content_hash != content_hash:
+                stale.append((joke_id, fp))
+        if stale:
+            update_from_values(Joke, [
+                {'id': joke_id, 'content_hash': fp.content_hash} for joke_id, fp in stale
+            ])
+            db.session.query(JokeFingerprint).filter(
+                JokeFingerprint.joke_id.in_([joke_id for joke_id, _ in stale])
+            ).delete(synchronize_session=False)
+            _index(stale)
+        db.session.commit()
+        changed += len(stale)
+    CacheVersion.bump(INDEX_VERSION_KEY)
+    db.session.commit()
+    if changed:
+        logger.info(f"Re-fingerprinted {changed} jokes for index version {INDEX_VERSION}")
+    return changed
@@ -0,0 +1,377 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, insert, update, literal, and_, or_
+from sqlalchemy.orm import joinedload
+from app import db
+from models import Subscriber, Joke, JokeHistory, Delivery
+from joke_selection import JokeSampler, select_jokes_for_subscribers
+from seen_jokes import load_seen, save_seen
+from email_service import build_daily_joke, get_mail_pool, DailyJokeRenderer
+from metrics import EMAILS, TickSpans
+from utils.db_utils import dialect_insert, is_postgres, update_from_values
+
+logger = logging.getLogger(__name__)
+
+# Serializes joke reservation across scheduler replicas (pg_advisory_xact_lock key)
+SELECTION_LOCK_KEY = 7_242_001
+
+# Identifies this process in Delivery.claimed_by
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Allowance for replica clocks disagreeing when reading each other's reservations
+CLOCK_SKEW = timedelta(seconds=30)
+
+# Set when the process is shutting down: ticks stop claiming and hand back
+# deliveries they have not started, as if their deadline had passed
+shutdown_requested = threading.Event()
+
+
+def enqueue_deliveries(slot, delivery_date):
+    """
+    Create pending ledger rows for every active subscriber whose send slot is due.
+
+    Runs as a single INSERT ... SELECT that ignores rows which already exist,
+    so every replica can call it for the same tick.
+
+    Args:
+        slot: UTC minute of day being delivered.
+        delivery_date: The date the deliveries belong to.
+
+    Returns:
+        int: Number of new ledger rows.
+    """
+    due = select(
+        Subscriber.id,
+        literal(delivery_date, db.Date),
+        literal(Delivery.PENDING),
+        literal(0),
+    ).where(
+        Subscriber.is_active == True,
+        Subscriber.send_slot == slot
+    )
+    statement = dialect_insert(Delivery).from_select(
+        ['subscriber_id', 'delivery_date', 'status', 'attempts'], due
+    ).on_conflict_do_nothing(index_elements=['subscriber_id', 'delivery_date'])
+    result = db.session.execute(statement)
+    db.session.commit()
+    return result.rowcount
+
+
+def _take_reserved(sampler, now, lease):
+    """
+    Keep jokes reserved on the ledger by other claims out of the sampler.
+
+    The first call takes the jokes of every pending delivery and of every
+    recent claim; later calls only those of deliveries other replicas
+    claimed since, as this process's own picks are already in the sampler.
+    """
+    query = db.session.query(Delivery.joke_ids).filter(Delivery.joke_ids != None)
+    if sampler.synced_at is None:
+        query = query.filter(or_(
+            and_(Delivery.status == Delivery.PENDING, Delivery.delivery_date >= now.date() - timedelta(days=1)),
+            Delivery.claimed_at >= now - lease
+        ))
+    else:
+        query = query.filter(Delivery.claimed_at >= sampler.synced_at - CLOCK_SKEW, Delivery.claimed_by != WORKER_ID)
+    sampler.take(joke_id for joke_ids, in query for joke_id in joke_ids)
+    sampler.synced_at = now
+
+
+def claim_deliveries(limit, now=None, sampler=None):
+    """
+    Claim a batch of pending deliveries for this process and reserve their jokes.
+
+    Rows locked by another replica are skipped. Deliveries claimed for the
+    first time get their jokes selected and stored on the ledger row in the
+    same transaction; retried deliveries keep the jokes they had. A joke
+    reserved for one delivery is not selected for another, including ones
+    claimed by other replicas. Seen
+    bitmaps and joke counters are only written once an email is sent (see
+    DeliveryWriteBuffer).
+
+    Args:
+        limit: Maximum number of deliveries to claim.
+        now: Reference time (defaults to utcnow).
+        sampler: The tick's JokeSampler, so candidate tables are built once
+            per tick rather than once per batch (a new one is built when omitted).
+
+    Returns:
+        list: (delivery_id, subscriber_id, joke_ids) tuples ready to send.
+    """
+    now = now or datetime.utcnow()
+    lease = timedelta(seconds=current_app.config.get('SCHEDULER_CLAIM_LEASE', 300))
+    max_attempts = current_app.config.get('SCHEDULER_MAX_ATTEMPTS', 3)
+    sampler = sampler or JokeSampler()
+
+    # Keep going while whole batches turn out to be skipped, so a run of
+    # unsubscribed or joke-less rows does not end the tick early
+    while True:
+        if is_postgres():
+            db.session.execute(
+                db.text('SELECT pg_advisory_xact_lock(:key)'), {'key': SELECTION_LOCK_KEY}
+            )
+
+        deliveries = Delivery.query.filter(
+            Delivery.status == Delivery.PENDING,
+            Delivery.delivery_date >= now.date() - timedelta(days=1),
+            or_(Delivery.claimed_at == None, Delivery.claimed_at < now - lease)
+        ).order_by(Delivery.id).limit(limit).with_for_update(skip_locked=True).all()
+        if not deliveries:
+            db.session.commit()
+            return []
+
+        subscribers = Subscriber.query.filter(
+            Subscriber.id.in_([delivery.subscriber_id for delivery in deliveries]),
+            Subscriber.is_active == True
+        ).all()
+        fresh = {delivery.subscriber_id for delivery in deliveries if delivery.joke_ids is None}
+        if fresh:
+            # Under the selection lock, so no other replica is reserving meanwhile
+            _take_reserved(sampler, now, lease)
+        seen = load_seen(subscriber.id for subscriber in subscribers if subscriber.id in fresh)
+        selected = {
+            subscriber.id: joke_ids
+            for subscriber, joke_ids in select_jokes_for_subscribers(
+                [subscriber for subscriber in subscribers if subscriber.id in fresh], seen, sampler
+            )
+        }
+        active = {subscriber.id for subscriber in subscribers}
+
+        claimed = []
+        for delivery in deliveries:
+            if delivery.subscriber_id in selected:
+                delivery.joke_ids = selected[delivery.subscriber_id]
+            if delivery.subscriber_id not in active or not delivery.joke_ids:
+                delivery.status = Delivery.SKIPPED
+                continue
+            if delivery.attempts >= max_attempts:
+                # Claimed repeatedly by workers that never finished it
+                delivery.status = Delivery.FAILED
+                continue
+            delivery.claimed_by = WORKER_ID
+            delivery.claimed_at = now
+            delivery.attempts += 1
+            claimed.append((delivery.id, delivery.subscriber_id, list(delivery.joke_ids)))
+        db.session.commit()
+        if claimed:
+            return claimed
+
+
+def release_deliveries(delivery_ids):
+    """Hand claimed but unstarted deliveries back so the next tick picks them up."""
+    if not delivery_ids:
+        return
+    db.session.query(Delivery).filter(
+        Delivery.id.in_(delivery_ids),
+        Delivery.status == Delivery.PENDING
+    ).update({'claimed_by': None, 'claimed_at': None}, synchronize_session=False)
+    db.session.commit()
+
+
+class DeliveryWriteBuffer:
+    """
+    Write-behind buffer for finished deliveries.
+
+    Instead of one transaction per email, sent deliveries are collected and
+    written every ``flush_size`` emails in a single transaction: one
+    multi-row INSERT for their JokeHistory rows, one UPDATE for their ledger
+    rows, the subscribers' seen bitmaps, and the sent jokes' ``times_sent``
+    and ``last_sent``. Only emails that actually went out are recorded, so a
+    failed delivery leaves no trace on the jokes. Larger flushes mean fewer
+    commits and row locks, at the cost of resending up to ``flush_size``
+    emails if the process dies between a send and the next flush.
+    """
+
+    def __init__(self, flush_size):
+        self.flush_size = max(1, flush_size)
+        self.history = []
+        self.deliveries = []
+
+    def add(self, delivery_id, subscriber_id, joke_ids, sent_at):
+        self.history.extend(
+            {'joke_id': joke_id, 'user': subscriber_id, 'sent_at': sent_at}
+            for joke_id in joke_ids
+        )
+        self.deliveries.append(
+            {'id': delivery_id, 'status': Delivery.SENT, 'sent_at': sent_at, 'error': None}
+        )
+        if len(self.deliveries) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if not self.deliveries:
+            return
+        if self.history:
+            db.session.execute(insert(JokeHistory).values(self.history))
+            self._mark_sent()
+        update_from_values(Delivery, self.deliveries)
+        db.session.commit()
+        self.history = []
+        self.deliveries = []
+
+    def _mark_sent(self):
+        seen = load_seen(row['user'] for row in self.history)
+        for row in self.history:
+            seen[row['user']].add(row['joke_id'])
+        save_seen(seen)
+
+        # Well-rated jokes go to several subscribers of a flush; one UPDATE per distinct count
+        sent_at = max(row['sent_at'] for row in self.history)
+        by_count = {}
+        for joke_id, count in Counter(row['joke_id'] for row in self.history).items():
+            by_count.setdefault(count, []).append(joke_id)
+        for count, joke_ids in by_count.items():
+            db.session.execute(
+                update(Joke).where(Joke.id.in_(joke_ids)).values(
+                    last_sent=sent_at, times_sent=Joke.times_sent + count
+                ),
+                execution_options={'synchronize_session': False}
+            )
+
+
+def _record_failure(delivery_id, error):
+    max_attempts = current_app.config.get('SCHEDULER_MAX_ATTEMPTS', 3)
+    delivery = db.session.get(Delivery, delivery_id)
+    delivery.error = str(error)[:255]
+    delivery.claimed_by = None
+    delivery.claimed_at = None
+    if delivery.attempts >= max_attempts:
+        delivery.status = Delivery.FAILED
+    db.session.commit()
+
+
+def _send_batch(app, batch, deadline, renderer, spans, broadcast=False):
+    """
+    Worker: send one claimed batch and record each delivery as it completes.
+
+    Each call runs in its own app context, so it gets its own database
+    session, and holds one pooled SMTP connection for the batch.
+
+    Args:
+        app: The Flask application.
+        batch: (delivery_id, subscriber_id, joke_ids) tuples from claim_deliveries.
+        deadline: time.monotonic() value after which no new delivery is started.
+        renderer: The tick's shared DailyJokeRenderer.
+        spans: The tick's TickSpans.
+        broadcast: Fill emails in from the renderer's per-joke-set envelopes.
+
+    Returns:
+        int: Number of emails sent.
+    """
+    sent = 0
+    buffer = DeliveryWriteBuffer(app.config.get('SCHEDULER_FLUSH_SIZE', 50))
+    with app.app_context(), get_mail_pool().connection() as connection:
+        with spans.phase('select'):
+            subscribers = {
+                subscriber.id: subscriber
+                for subscriber in Subscriber.query.filter(
+                    Subscriber.id.in_([subscriber_id for _, subscriber_id, _ in batch])
+                )
+            }
+            jokes = {
+                joke.id: joke
+                for joke in Joke.query.options(joinedload(Joke.category)).filter(
+                    Joke.id.in_([joke_id for _, _, ids in batch for joke_id in ids])
+                )
+            }
+
+        for index, (delivery_id, subscriber_id, joke_ids) in enumerate(batch):
+            if time.monotonic() >= deadline or shutdown_requested.is_set():
+                with spans.phase('persist'):
+                    buffer.flush()
+                    release_deliveries([pending_id for pending_id, _, _ in batch[index:]])
+                break
+
+            subscriber = subscribers.get(subscriber_id)
+            jokes_to_send = [jokes[joke_id] for joke_id in joke_ids if joke_id in jokes]
+            try:
+                # Send jokes to the subscriber
+                with spans.phase('render'):
+                    msg = build_daily_joke(subscriber, jokes_to_send, renderer, broadcast)
+                with spans.phase('send'):
+                    connection.send(msg)
+            except Exception as e:
+                EMAILS.inc(result='failed')
+                db.session.rollback()
+                logger.error(f"Failed to deliver jokes to subscriber {subscriber_id}: {str(e)}")
+                with spans.phase('persist'):
+                    _record_failure(delivery_id, e)
+                continue
+
+            # Log each joke sent and close the ledger entry with the next bulk write
+            EMAILS.inc(result='sent')
+            with spans.phase('persist'):
+                buffer.add(delivery_id, subscriber_id, [joke.id for joke in jokes_to_send], datetime.utcnow())
+            sent += 1
+        with spans.phase('persist'):
+            buffer.flush()
+    return sent
+
+
+def dispatch_deliveries(app, deadline, spans=None):
+    """
+    Drain pending deliveries across a pool of worker threads until none are left or the deadline passes.
+
+    Batches are claimed only as workers free up, so at most one batch per
+    worker is held by this process at a time; whatever is still pending at
+    the deadline is left for the next tick or another replica. Time spent
+    selecting, rendering, sending and persisting is logged at the end of the
+    tick and recorded in the tick metrics.
+
+    With DELIVERY_MODE 'broadcast', subscribers with the same categories get
+    the same jokes for the tick where their history allows, and each distinct
+    email is generated once and filled in per recipient.
+
+    Args:
+        app: The Flask application.
+        deadline: time.monotonic() value after which no new delivery is started.
+        spans: The tick's TickSpans, if the caller already timed part of it.
+
+    Returns:
+        int: Number of emails sent.
+    """
+    chunk_size = app.config.get('SCHEDULER_CHUNK_SIZE', 50)
+    workers = max(1, app.config.get('SCHEDULER_WORKERS', 1))
+    broadcast = app.config.get('DELIVERY_MODE', 'individual') == 'broadcast'
+    renderer = DailyJokeRenderer()
+    spans = spans or TickSpans()
+    with app.app_context():
+        sampler = JokeSampler(broadcast=broadcast)
+
+    sent = 0
+    overran = False
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='delivery') as executor:
+        running = set()
+        while True:
+            if shutdown_requested.is_set():
+                break
+            if time.monotonic() >= deadline:
+                overran = True
+                break
+            if len(running) >= workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                sent += sum(future.result() for future in done)
+                continue
+            with app.app_context(), spans.phase('select'):
+                batch = claim_deliveries(chunk_size, sampler=sampler)
+            if not batch:
+                break
+            running.add(executor.submit(_send_batch, app, batch, deadline, renderer, spans, broadcast))
+        sent += sum(future.result() for future in running)
+
+    elapsed, phases = spans.finish()
+    logger.info(f"Delivered {sent} emails with {workers} worker(s) in {elapsed:.2f}s "
+                f"({sent / elapsed if elapsed else 0:.1f} msg/s); "
+                + ", ".join(f"{name} {total:.2f}s" for name, total in phases.items()))
+    if broadcast and sent:
+        logger.info(f"Broadcast: {sent} emails from {len(renderer.envelopes)} distinct joke sets")
+    if overran:
+        logger.warning("Tick deadline reached, remaining deliveries carry over to the next tick")
+    return sent
@@ -0,0 +1,203 @@
+import logging
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, case, cast, extract, func, not_, update, Integer
+from app import db
+from models import Subscriber, MINUTES_PER_DAY, utc_offset_minutes
+from utils.db_utils import update_from_values
+
+logger = logging.getLogger(__name__)
+
+
+def _minute_of_day(now):
+    return now.hour * 60 + now.minute
+
+
+def _minutes_back(later, earlier):
+    """Minutes from ``earlier`` forward to ``later`` on the 24-hour clock; works on ints and SQL expressions."""
+    return (later - earlier + MINUTES_PER_DAY) % MINUTES_PER_DAY
+
+
+def _skips_delivery(current, target, minute):
+    """
+    Whether moving a send slot from ``current`` to ``target`` at UTC
+    ``minute`` would skip the coming delivery: the slot moves back, and
+    ``minute`` lies between the target and the current slot, so the current
+    slot has not been enqueued yet while the target has already gone by.
+    Slots sit on a 24-hour clock, so a move of less than half a day counts
+    as moving back even across 00:00 (00:30 to 23:30 does, 23:30 to 00:30
+    does not). Such moves wait for a later run, once the current slot has
+    passed.
+
+    Returns:
+        tuple: Conditions that must all hold; plain bools for ints, SQL
+        expressions for columns.
+    """
+    back = _minutes_back(current, target)
+    return back > 0, back < MINUTES_PER_DAY // 2, _minutes_back(minute, target) <= back
+
+
+def _skips_today(current, target, minute):
+    """SQL condition for _skips_delivery."""
+    return and_(*_skips_delivery(current, target, minute))
+
+
+def recompute_delivery_slots(now=None):
+    """
+    Move subscribers whose timezone's UTC offset has changed (DST) to their new UTC slot.
+
+    Offsets are worked out once per distinct timezone and applied with a
+    single UPDATE that only touches rows whose slot actually moves. Moved
+    subscribers get send_slot reset too, unless that would skip today's
+    delivery; rebalance_send_slots spreads them again afterwards.
+
+    Returns:
+        int: Number of subscribers moved.
+    """
+    now = now or datetime.utcnow()
+    offsets = {
+        timezone: utc_offset_minutes(timezone, now)
+        for timezone, in db.session.query(Subscriber.timezone).distinct()
+        if timezone
+    }
+    offsets = {timezone: offset for timezone, offset in offsets.items() if offset}
+
+    local = cast(
+        extract('hour', Subscriber.delivery_time) * 60 + extract('minute', Subscriber.delivery_time),
+        Integer
+    )
+    offset = case(offsets, value=Subscriber.timezone, else_=0) if offsets else 0
+    slot = (local - offset + MINUTES_PER_DAY) % MINUTES_PER_DAY
+
+    result = db.session.execute(
+        update(Subscriber).where(
+            Subscriber.delivery_time != None,
+            Subscriber.delivery_slot != slot
+        ).values(
+            delivery_slot=slot,
+            send_slot=case(
+                (_skips_today(Subscriber.send_slot, slot, _minute_of_day(now)), Subscriber.send_slot),
+                else_=slot
+            )
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    if result.rowcount:
+        logger.info(f"Moved {result.rowcount} subscribers to new UTC delivery slots")
+    return result.rowcount
+
+
+def plan_spread(counts, capacity, tolerance):
+    """
+    Decide how many subscribers of each overloaded minute move, and where.
+
+    Every minute keeps up to ``capacity`` of its own subscribers; the rest
+    go to the nearest minutes within ``tolerance`` that still have room,
+    trying one minute later, then one earlier, then two later and so on.
+    Whatever does not fit stays put.
+
+    Args:
+        counts: Mapping of minute of day to the number of subscribers preferring it.
+        capacity: Subscribers a minute should hold.
+        tolerance: Furthest a subscriber may be moved, in minutes.
+
+    Returns:
+        dict: Mapping of overloaded minute to a list of (target minute, count).
+    """
+    load = {minute: min(count, capacity) for minute, count in counts.items()}
+    moves = {}
+    overloaded = sorted((minute for minute, count in counts.items() if count > capacity),
+                        key=lambda minute: (-counts[minute], minute))
+    for minute in overloaded:
+        remaining = counts[minute] - capacity
+        for distance in range(1, tolerance + 1):
+            for target in ((minute + distance) % MINUTES_PER_DAY, (minute - distance) % MINUTES_PER_DAY):
+                room = capacity - load.get(target, 0)
+                if remaining and room > 0:
+                    taken = min(room, remaining)
+                    load[target] = load.get(target, 0) + taken
+                    moves.setdefault(minute, []).append((target, taken))
+                    remaining -= taken
+        if remaining:
+            logger.warning(f"{remaining} subscribers at minute {minute} do not fit within "
+                           f"{tolerance} minutes, they stay in an overloaded slot")
+    return moves
+
+
+def rebalance_send_slots(now=None):
+    """
+    Spread overloaded delivery minutes over their neighbours so each tick has a level load.
+
+    Uses DELIVERY_SLOT_CAPACITY and DELIVERY_SPREAD_TOLERANCE. Within an
+    overloaded minute the longest-standing subscribers keep their exact time.
+    Subscribers outside overloaded minutes are sent back to their own slot.
+    A move that would skip today's delivery is left for a later run.
+
+    Args:
+        now: Current UTC time (defaults to utcnow).
+
+    Returns:
+        int: Number of subscribers whose send slot changed.
+    """
+    current_minute = _minute_of_day(now or datetime.utcnow())
+    config = current_app.config
+    capacity = max(1, config.get('DELIVERY_SLOT_CAPACITY', 1000))
+    tolerance = config.get('DELIVERY_SPREAD_TOLERANCE', 5)
+
+    counts = dict(
+        db.session.query(Subscriber.delivery_slot, func.count(Subscriber.id)).filter(
+            Subscriber.is_active == True,
+            Subscriber.delivery_slot != None
+        ).group_by(Subscriber.delivery_slot)
+    )
+    moves = plan_spread(counts, capacity, tolerance)
+
+    changes = []
+    deferred = 0
+    if moves:
+        position = {}
+        for subscriber_id, delivery_slot, send_slot in db.session.query(
+            Subscriber.id, Subscriber.delivery_slot, Subscriber.send_slot
+        ).filter(
+            Subscriber.is_active == True,
+            Subscriber.delivery_slot.in_(moves)
+        ).order_by(Subscriber.delivery_slot, Subscriber.id):
+            index = position.get(delivery_slot, 0)
+            position[delivery_slot] = index + 1
+            target = delivery_slot
+            index -= capacity
+            for minute, count in moves[delivery_slot]:
+                if 0 <= index < count:
+                    target = minute
+                    break
+                index -= count
+            if target == send_slot:
+                continue
+            if all(_skips_delivery(send_slot, target, current_minute)):
+                deferred += 1
+                continue
+            changes.append({'id': subscriber_id, 'send_slot': target})
+        update_from_values(Subscriber, changes)
+
+    reset = db.session.execute(
+        update(Subscriber).where(
+            Subscriber.send_slot != Subscriber.delivery_slot,
+            Subscriber.delivery_slot.not_in(list(moves)),
+            not_(_skips_today(Subscriber.send_slot, Subscriber.delivery_slot, current_minute))
+        ).values(send_slot=Subscriber.delivery_slot),
+        execution_options={'synchronize_session': False}
+    )
+    db.session.commit()
+    changed = len(changes) + reset.rowcount
+    if changed:
+        logger.info(f"Rebalanced send slots: {len(changes)} spread, {reset.rowcount} restored")
+    if deferred:
+        logger.info(f"Deferred {deferred} send slot moves that would skip today's delivery")
+    return changed
+
+
+def update_delivery_slots(now=None):
+    """Scheduler entry point: follow DST changes, then level the per-minute load."""
+    recompute_delivery_slots(now)
+    return rebalance_send_slots(now)
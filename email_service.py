@@ -1,39 +1,423 @@
-from flask import render_template
+import logging
+import queue
+import re
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import formatdate
+from flask import render_template, current_app, url_for
+from markupsafe import escape
 from app import mail
-from flask_mail import Message
+from flask_mail import Message, sanitize_address
+from metrics import SMTP_CONNECT_SECONDS, SMTP_ERRORS, SMTP_SEND_SECONDS
 
-def send_welcome_email(email):
+logger = logging.getLogger(__name__)
+
+DAILY_JOKE_SUBJECT = 'Your Daily Dose of Laughter! 😂'
+
+
+class PooledConnection:
+    """
+    A long-lived Flask-Mail connection that survives across many messages.
+
+    The underlying SMTP session is opened lazily, recycled after the pool's
+    per-connection message cap or idle timeout, and reopened once if the
+    server drops it mid-batch.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+        self.sent = 0
+        self.last_used = 0.0
+
+    def open(self):
+        self.close()
+        with SMTP_CONNECT_SECONDS.time():
+            self.connection = mail.connect().__enter__()
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            # The server already hung up; nothing left to close politely
+            pass
+        self.connection = None
+
+    def _is_stale(self):
+        return (
+            self.connection is None
+            or self.sent >= self.pool.max_messages
+            or time.monotonic() - self.last_used > self.pool.idle_timeout
+        )
+
+    def send(self, message):
+        if self._is_stale():
+            self.open()
+        started = time.perf_counter()
+        try:
+            self.connection.send(message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            SMTP_ERRORS.inc()
+            logger.warning("SMTP connection dropped, reconnecting")
+            self.open()
+            started = time.perf_counter()
+            self.connection.send(message)
+        except smtplib.SMTPException:
+            SMTP_ERRORS.inc()
+            raise
+        SMTP_SEND_SECONDS.observe(time.perf_counter() - started)
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+
+class SMTPConnectionPool:
+    """
+    A bounded pool of PooledConnection objects shared by the senders of a process.
+
+    Args:
+        size: Maximum number of connections checked out at once.
+        max_messages: Messages sent over one SMTP session before it is recycled.
+        idle_timeout: Seconds after which an unused session is reopened instead of reused.
+    """
+
+    def __init__(self, size=4, max_messages=100, idle_timeout=60):
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection, returning it to the pool afterwards."""
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = PooledConnection(self)
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            self._idle.put(conn)
+            self._slots.release()
+
+    def close(self):
+        """Close every idle connection in the pool."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def get_mail_pool(app=None):
+    """Return the application's SMTP connection pool, creating it on first use."""
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('mail_pool')
+    if pool is None:
+        pool = SMTPConnectionPool(
+            size=app.config.get('MAIL_POOL_SIZE', 4),
+            max_messages=app.config.get('MAIL_POOL_MAX_MESSAGES', 100),
+            idle_timeout=app.config.get('MAIL_POOL_IDLE_TIMEOUT', 60),
+        )
+        app.extensions['mail_pool'] = pool
+    return pool
+
+
+def send_messages(messages, connection=None):
+    """
+    Send a batch of messages over a single pooled connection.
+
+    Args:
+        messages: An iterable of Message objects.
+        connection: A PooledConnection to reuse; one is checked out if omitted.
+
+    Returns:
+        dict: Counts of sent and failed messages, elapsed seconds and messages per second.
+    """
+    if connection is None:
+        with get_mail_pool().connection() as connection:
+            return send_messages(messages, connection)
+
+    sent = failed = 0
+    started = time.monotonic()
+    for message in messages:
+        try:
+            connection.send(message)
+            sent += 1
+        except smtplib.SMTPException as e:
+            logger.error(f"Failed to send email to {message.recipients}: {str(e)}")
+            failed += 1
+    elapsed = time.monotonic() - started
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Sent {sent} emails ({failed} failed) in {elapsed:.2f}s, {rate:.1f} msg/s")
+    return {'sent': sent, 'failed': failed, 'elapsed': elapsed, 'rate': rate}
+
+
+class DailyJokeRenderer:
+    """
+    Renders daily joke emails from pieces cached for the lifetime of the renderer.
+
+    The layout around the jokes is rendered once with a placeholder recipient,
+    each joke's block is rendered once the first time it is used, and every
+    email is then assembled by string concatenation with only the recipient's
+    unsubscribe link filled in. The result is byte-identical to rendering
+    ``email/daily_joke.html`` directly; if the layout cannot be split safely the
+    renderer falls back to a full render. In broadcast mode it also keeps one
+    BroadcastEnvelope per joke set (see envelope()). Create one per tick, since
+    cached joke blocks are not refreshed. Safe to share between threads.
+    """
+
+    TEMPLATE = 'email/daily_joke.html'
+    JOKE_TEMPLATE = 'email/_joke.html'
+    PLACEHOLDER = 'daily-joke-recipient-placeholder'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fragments = {}
+        self._layout = None
+        self._verified = False
+        self.envelopes = {}
+
+    def _fragment(self, joke):
+        fragment = self._fragments.get(joke.id)
+        if fragment is None:
+            fragment = render_template(self.JOKE_TEMPLATE, joke=joke, is_welcome=False)
+            self._fragments[joke.id] = fragment
+        return fragment
+
+    def _full_render(self, jokes, email):
+        return render_template(self.TEMPLATE, jokes=jokes, is_welcome=False, email=email)
+
+    def _split_layout(self, probe):
+        """Find where the joke blocks go in the layout, using one joke as a probe."""
+        empty = self._full_render([], self.PLACEHOLDER)
+        full = self._full_render([probe], self.PLACEHOLDER)
+        fragment = self._fragment(probe)
+
+        common = 0
+        for left, right in zip(empty, full):
+            if left != right:
+                break
+            common += 1
+        for split in range(common, max(common - len(fragment), 0) - 1, -1):
+            if empty[:split] + fragment + empty[split:] == full:
+                break
+        else:
+            return False
+
+        head, tail = empty[:split], empty[split:]
+        link = str(escape(url_for('main.unsubscribe', email=self.PLACEHOLDER, _external=True)))
+        if tail.count(link) != 1:
+            return False
+        before_link, after_link = tail.split(link)
+        if self.PLACEHOLDER in head + before_link + after_link:
+            return False
+        return head, before_link, after_link
+
+    def render(self, email, jokes):
+        """
+        Render the daily joke email body for one recipient.
+
+        Args:
+            email: The recipient's email address.
+            jokes: A list of Joke objects.
+
+        Returns:
+            str: The rendered HTML.
+        """
+        if not jokes:
+            return self._full_render(jokes, email)
+
+        with self._lock:
+            if self._layout is None:
+                self._layout = self._split_layout(jokes[0])
+                if not self._layout:
+                    logger.warning("Could not split the daily joke layout, rendering each email in full")
+            layout = self._layout
+            if not layout:
+                return self._full_render(jokes, email)
+            body = ''.join(self._fragment(joke) for joke in jokes)
+            verify = not self._verified
+            self._verified = True
+
+        head, before_link, after_link = layout
+        link = str(escape(url_for('main.unsubscribe', email=email, _external=True)))
+        html = head + body + before_link + link + after_link
+
+        # Check the first assembled email against a full render before trusting the cache
+        if verify and html != self._full_render(jokes, email):
+            logger.warning("Assembled daily joke email differs from a full render, disabling the cache")
+            with self._lock:
+                self._layout = False
+            return self._full_render(jokes, email)
+        return html
+
+    def envelope(self, jokes):
+        """
+        Return the BroadcastEnvelope for a joke set, generating it the first time the set is used.
+
+        Args:
+            jokes: A list of Joke objects.
+
+        Returns:
+            BroadcastEnvelope: The shared email, or None if it could not be
+            templated and each recipient's email has to be built in full.
+        """
+        key = tuple(joke.id for joke in jokes)
+        with self._lock:
+            envelope = self.envelopes.get(key)
+        if envelope is None:
+            link = str(escape(url_for('main.unsubscribe', email=self.PLACEHOLDER, _external=True)))
+            envelope = BroadcastEnvelope(self.render(self.PLACEHOLDER, jokes), link)
+            if not envelope.valid:
+                logger.warning(f"Could not template the daily joke email for jokes {list(key)}, building it per recipient")
+            with self._lock:
+                envelope = self.envelopes.setdefault(key, envelope)
+        return envelope if envelope.valid else None
+
+
+class BroadcastEnvelope:
+    """
+    A daily joke email generated once and sent to every recipient of one joke set.
+
+    Generating the MIME headers costs far more than rendering the body, so
+    the email is generated once, through Flask-Mail, for placeholder To,
+    Message-ID, Date and unsubscribe link. Each recipient's bytes are that
+    output with only those four filled in.
+
+    Args:
+        html: The email body rendered for the placeholder recipient.
+        link: The placeholder's unsubscribe link as it appears in ``html``.
+    """
+
+    RECIPIENT = 'broadcast-recipient-placeholder@example.invalid'
+    MESSAGE_ID = '<broadcast-message-id-placeholder@example.invalid>'
+
+    def __init__(self, html, link):
+        self.subject = DAILY_JOKE_SUBJECT
+        self.date = time.time()
+        template = Message(self.subject, recipients=[self.RECIPIENT], html=html, date=self.date)
+        template.msgId = self.MESSAGE_ID
+        raw = template.as_bytes()
+
+        self._to = self.RECIPIENT.encode()
+        self._message_id = self.MESSAGE_ID.encode()
+        self._link = link.encode()
+        self._date = formatdate(self.date, localtime=True).encode()
+        tokens = (self._to, self._message_id, self._link, self._date)
+        # Each placeholder must come through verbatim exactly once, or the template cannot be filled in
+        self.valid = html.count(link) == 1 and all(raw.count(token) == 1 for token in tokens)
+        self.html_before, _, self.html_after = html.partition(link)
+        self.pieces = re.split(b'(' + b'|'.join(re.escape(token) for token in tokens) + b')', raw)
+
+    def message(self, email):
+        """Return the email for one recipient, with their own To, Message-ID and unsubscribe link."""
+        link = str(escape(url_for('main.unsubscribe', email=email, _external=True)))
+        return BroadcastMessage(self, email, link)
+
+    def encode(self, message):
+        values = {
+            self._to: sanitize_address(message.recipients[0]).encode(),
+            self._message_id: message.msgId.encode(),
+            self._link: message.link.encode(),
+            # Stamped when the message is sent, like any other Message
+            self._date: formatdate(message.date, localtime=True).encode(),
+        }
+        return b''.join(values.get(piece, piece) for piece in self.pieces)
+
+
+class BroadcastMessage(Message):
+    """
+    A Message whose bytes are filled in from its BroadcastEnvelope instead of generated.
+
+    Otherwise an ordinary Message (subject, recipients and html are all set),
+    so it is sent, suppressed and recorded exactly like any other.
+    """
+
+    def __init__(self, envelope, email, link):
+        super().__init__(envelope.subject, recipients=[email],
+                         html=envelope.html_before + link + envelope.html_after)
+        self.envelope = envelope
+        self.link = link
+
+    def as_bytes(self):
+        return self.envelope.encode(self)
+
+
+def build_welcome_email(email):
+    """Builds the welcome email for a new subscriber without sending it."""
     msg = Message(
         'Welcome to Daily Jokes!',
         recipients=[email]
     )
-    msg.html = render_template('email/daily_joke.html', 
+    msg.html = render_template('email/daily_joke.html',
                              content="Why did we sign you up? Because laughter is the best medicine! 😄",
                              is_welcome=True,
                              email=email)
-    mail.send(msg)
+    return msg
 
 
-def send_daily_joke(subscriber, jokes):
+def build_daily_joke(subscriber, jokes, renderer=None, broadcast=False):
     """
-    Sends a daily joke email with multiple jokes to a subscriber.
+    Builds the daily joke email for a subscriber without sending it.
 
     Args:
         subscriber: The Subscriber object.
         jokes: A list of Joke objects, one from each subscribed category.
+        renderer: Optional DailyJokeRenderer whose cached pieces are reused.
+        broadcast: Fill the email in from the renderer's shared envelope for
+            this joke set instead of generating it (needs a renderer).
+
+    Returns:
+        Message: The rendered email.
     """
+    if broadcast and renderer is not None:
+        envelope = renderer.envelope(jokes)
+        if envelope is not None:
+            return envelope.message(subscriber.email)
+
     msg = Message(
-        'Your Daily Dose of Laughter! 😂',
+        DAILY_JOKE_SUBJECT,
         recipients=[subscriber.email]
     )
 
     # Render the email template with multiple jokes
-    msg.html = render_template(
-        'email/daily_joke.html',
-        jokes=jokes,
-        is_welcome=False,
-        email=subscriber.email
-    )
+    if renderer is not None:
+        msg.html = renderer.render(subscriber.email, jokes)
+    else:
+        msg.html = render_template(
+            'email/daily_joke.html',
+            jokes=jokes,
+            is_welcome=False,
+            email=subscriber.email
+        )
+    return msg
+
+
+def send_daily_joke(subscriber, jokes, connection=None, renderer=None):
+    """
+    Sends a daily joke email with multiple jokes to a subscriber.
+
+    Args:
+        subscriber: The Subscriber object.
+        jokes: A list of Joke objects, one from each subscribed category.
+        connection: Optional PooledConnection to send over instead of opening a new one.
+        renderer: Optional DailyJokeRenderer shared by the emails of a tick.
+    """
+    msg = build_daily_joke(subscriber, jokes, renderer)
 
     # Send the email
-    mail.send(msg)
+    if connection is not None:
+        connection.send(msg)
+    else:
+        mail.send(msg)
@@ -0,0 +1,189 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_, and_, true
+from app import db
+from models import Category, Joke, Subscriber, GenerationJob
+from joke_selection import RESEND_COOLDOWN
+from dedup import insert_jokes
+
+logger = logging.getLogger(__name__)
+
+# A job left running this long is assumed to belong to a dead process
+STALE_JOB_AGE = timedelta(minutes=15)
+
+
+def eligible_counts(now=None):
+    """
+    Count jokes per active category that can be sent right now.
+
+    Returns:
+        dict: Mapping of category id to the number of jokes outside the resend cooldown.
+    """
+    now = now or datetime.utcnow()
+    counts = dict(
+        db.session.query(Joke.category_id, func.count(Joke.id)).filter(
+            or_(Joke.last_sent == None, Joke.last_sent <= now - RESEND_COOLDOWN)
+        ).group_by(Joke.category_id)
+    )
+    return {
+        category_id: counts.get(category_id, 0)
+        for category_id, in db.session.query(Category.id).filter(Category.is_active == True)
+    }
+
+
+def upcoming_demand(now=None, minutes=60):
+    """
+    Count active subscribers per category name due within the next few minutes.
+
+    Returns:
+        dict: Mapping of category name to the number of deliveries coming up.
+    """
+    now = now or datetime.utcnow()
+    start = now.hour * 60 + now.minute
+    end = start + minutes
+    if end < 24 * 60:
+        window = Subscriber.send_slot.between(start, end)
+    else:
+        window = or_(Subscriber.send_slot >= start, Subscriber.send_slot <= end - 24 * 60)
+
+    elements = Subscriber.category_elements()
+    return dict(
+        db.session.query(elements.c.value, func.count()).select_from(Subscriber).join(
+            elements, true()
+        ).filter(
+            Subscriber.is_active == True, window
+        ).group_by(elements.c.value)
+    )
+
+
+def enqueue_generation(category_id, count=10, source='admin'):
+    """Queue a generation job; the caller commits."""
+    job = GenerationJob(category_id=category_id, count=count, source=source)
+    db.session.add(job)
+    return job
+
+
+def plan_refills(now=None):
+    """
+    Queue generation jobs for every category whose eligible inventory has
+    dropped below its low watermark.
+
+    A category's watermark is JOKE_INVENTORY_LOW_WATERMARK plus the deliveries
+    due for it within JOKE_REFILL_LOOKAHEAD minutes. Categories that already
+    have a queued or running job are left alone.
+
+    Returns:
+        int: Number of jobs queued.
+    """
+    config = current_app.config
+    watermark = config.get('JOKE_INVENTORY_LOW_WATERMARK', 20)
+    batch = config.get('JOKE_REFILL_BATCH', 10)
+    max_jobs = config.get('JOKE_REFILL_MAX_JOBS', 3)
+
+    inventory = eligible_counts(now)
+    demand = upcoming_demand(now, config.get('JOKE_REFILL_LOOKAHEAD', 60))
+    names = dict(db.session.query(Category.id, Category.name).filter(Category.id.in_(inventory)))
+    busy = {
+        category_id for category_id, in db.session.query(GenerationJob.category_id).filter(
+            GenerationJob.status.in_([GenerationJob.QUEUED, GenerationJob.RUNNING])
+        )
+    }
+
+    queued = 0
+    for category_id, available in inventory.items():
+        needed = watermark + demand.get(names[category_id], 0)
+        if available >= needed or category_id in busy:
+            continue
+        jobs = min(max_jobs, math.ceil((needed - available) / batch))
+        logger.info(f"Category {names[category_id]} has {available} eligible jokes "
+                    f"(watermark {needed}), queueing {jobs} generation job(s)")
+        for _ in range(jobs):
+            enqueue_generation(category_id, batch, source='refill')
+        queued += jobs
+    db.session.commit()
+    return queued
+
+
+def _claim_jobs(now, limit):
+    jobs = GenerationJob.query.filter(
+        or_(
+            GenerationJob.status == GenerationJob.QUEUED,
+            and_(GenerationJob.status == GenerationJob.RUNNING,
+                 GenerationJob.started_at < now - STALE_JOB_AGE)
+        )
+    ).order_by(GenerationJob.id).limit(limit).with_for_update(skip_locked=True).all()
+    for job in jobs:
+        job.status = GenerationJob.RUNNING
+        job.started_at = now
+    db.session.commit()
+    return jobs
+
+
+def _finish_job(job, jokes):
+    """Insert a job's jokes, minus duplicates, and record its outcome; returns the number inserted."""
+    job.finished_at = datetime.utcnow()
+    if jokes:
+        ids, duplicates = insert_jokes(job.category_id, jokes, job.finished_at)
+        job.status = GenerationJob.DONE
+        job.inserted = len(ids)
+        if duplicates:
+            job.error = f'{len(duplicates)} duplicate joke(s) skipped'
+    else:
+        job.status = GenerationJob.FAILED
+        job.error = 'The AI service returned no jokes'
+    db.session.commit()
+    logger.info(f"Generation job {job.id} for {job.category.name}: {job.status}, {job.inserted} jokes")
+    return job.inserted
+
+
+def run_generation_jobs(limit=None):
+    """
+    Work through queued generation jobs until the queue is empty or ``limit``
+    jobs have run.
+
+    Jobs are claimed AI_MAX_CONCURRENCY at a time and generated concurrently,
+    within the AI_REQUESTS_PER_MINUTE budget. The AI calls happen outside any
+    transaction; as each job's result arrives its jokes, minus near-duplicates
+    of existing ones, are inserted in the same transaction that marks the job done.
+
+    Returns:
+        int: Number of jokes inserted.
+    """
+    # openai is slow to import; load it only when there is generation to do
+    from utils import ai_utils
+
+    config = current_app.config
+    concurrency = max(1, config.get('AI_MAX_CONCURRENCY', 4))
+    options = {
+        'max_concurrency': concurrency,
+        'requests_per_minute': config.get('AI_REQUESTS_PER_MINUTE', 60),
+        'max_attempts': config.get('AI_MAX_ATTEMPTS', 5),
+    }
+
+    inserted = 0
+    runs = 0
+
+    def finish(request, jokes):
+        nonlocal inserted
+        inserted += _finish_job(jobs[request.key], jokes)
+
+    while limit is None or runs < limit:
+        batch = concurrency if limit is None else min(concurrency, limit - runs)
+        jobs = {job.id: job for job in _claim_jobs(datetime.utcnow(), batch)}
+        if not jobs:
+            break
+        runs += len(jobs)
+        requests = [
+            ai_utils.JokeRequest(job.category.name, job.category.description, job.count, job.id)
+            for job in jobs.values()
+        ]
+        ai_utils.generate_jokes_batch(requests, on_result=finish, **options)
+    return inserted
+
+
+def refill_inventory():
+    """Scheduler entry point: queue jobs for low categories, then work through the queue."""
+    plan_refills()
+    return run_generation_jobs()
@@ -0,0 +1,310 @@
+import random
+from array import array
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_
+from app import db
+from models import Joke
+from category_cache import category_cache
+from seen_jokes import load_seen
+
+# A joke is eligible again once it has not been sent to anyone for this long
+RESEND_COOLDOWN = timedelta(days=7)
+
+# Ratings are smoothed towards PRIOR_RATING as if every joke had PRIOR_COUNT
+# extra ratings of it, so one early 5 does not outweigh a long track record
+# and unrated jokes still get drawn
+PRIOR_RATING = 3.0
+PRIOR_COUNT = 5
+
+# Weighted draws tried per pick before scanning for a joke the subscriber has not seen
+MAX_DRAWS = 8
+
+# Broadcast mode: most recent shared joke sets of a category group offered to
+# a subscriber before a new set is picked for them
+MAX_SHARED_SETS = 8
+
+
+def load_active_categories(names):
+    """
+    Resolve category names to active categories through the category cache.
+
+    Args:
+        names: An iterable of category names.
+
+    Returns:
+        dict: Mapping of category name to CachedCategory for every active match.
+    """
+    return category_cache.active_by_name(set(names))
+
+
+def joke_weight(rating_sum, rating_count, exponent):
+    """Sampling weight of a joke: its smoothed average rating raised to ``exponent``."""
+    average = ((rating_sum or 0) + PRIOR_RATING * PRIOR_COUNT) / ((rating_count or 0) + PRIOR_COUNT)
+    return average ** exponent
+
+
+class AliasTable:
+    """
+    Walker/Vose alias table over a list of positive weights.
+
+    Built in O(n); every draw is one uniform column pick and one biased coin
+    flip, so O(1) however many jokes the category holds.
+    """
+
+    def __init__(self, weights):
+        size = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * size / total for weight in weights]
+        self.size = size
+        self.probability = array('d', [1.0]) * size
+        self.alias = array('l', range(size))
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            lesser, greater = small.pop(), large.pop()
+            self.probability[lesser] = scaled[lesser]
+            self.alias[lesser] = greater
+            scaled[greater] += scaled[lesser] - 1.0
+            (small if scaled[greater] < 1.0 else large).append(greater)
+        # Whatever is left is 1 up to rounding error and keeps probability 1
+
+    def draw(self, rng):
+        column = int(rng.random() * self.size)
+        return column if rng.random() < self.probability[column] else self.alias[column]
+
+
+class CategoryCandidates:
+    """
+    One category's jokes outside the resend cooldown, for a tick.
+
+    Jokes are drawn with rating-weighted probability. Ids are held in a
+    compact array rather than as ORM objects. Jokes already reserved this
+    tick are redrawn; once draws keep landing on them the table is rebuilt
+    without them, so a pick stays O(1) amortized as the tick uses the
+    category up.
+    """
+
+    def __init__(self, rows, exponent):
+        self.ids = array('l', (row.id for row in rows))
+        self.weights = array('d', (joke_weight(row.rating_sum, row.rating_count, exponent) for row in rows))
+        self.table = AliasTable(self.weights) if rows else None
+
+    def _drop(self, taken):
+        """Rebuild the table without the reserved jokes; returns whether any were dropped."""
+        keep = [index for index, joke_id in enumerate(self.ids) if joke_id not in taken]
+        if len(keep) == len(self.ids):
+            return False
+        self.ids = array('l', (self.ids[index] for index in keep))
+        self.weights = array('d', (self.weights[index] for index in keep))
+        self.table = AliasTable(self.weights) if keep else None
+        return True
+
+    def pick(self, seen, taken, rng):
+        """
+        Return a joke id in neither ``seen`` nor ``taken``, or None if there is none left.
+
+        Args:
+            seen: The subscriber's JokeBitmap.
+            taken: Joke ids reserved for other subscribers this tick.
+            rng: random.Random.
+        """
+        for attempt in range(2):
+            if self.table is None:
+                return None
+            for _ in range(MAX_DRAWS):
+                joke_id = self.ids[self.table.draw(rng)]
+                if joke_id not in seen and joke_id not in taken:
+                    return joke_id
+            if not self._drop(taken):
+                break
+        # The subscriber has seen most of what is left; walk it from a random start
+        size = len(self.ids)
+        start = int(rng.random() * size)
+        for step in range(size):
+            joke_id = self.ids[(start + step) % size]
+            if joke_id not in seen and joke_id not in taken:
+                return joke_id
+        return None
+
+
+class JokeSampler:
+    """
+    Rating-weighted joke picker shared by every batch of a tick.
+
+    Each category's candidate table is loaded and built the first time the
+    tick needs it (one query for all the categories a batch adds), after
+    which a pick costs O(1) expected time per subscriber and category.
+
+    Every picked joke is reserved for the rest of the tick, so no two
+    subscribers get the same one; in broadcast mode the members of a group
+    share the group's reservations. Jokes reserved elsewhere (by earlier
+    batches or other replicas) are added with ``take``.
+
+    Args:
+        now: Reference time for the cooldown (defaults to utcnow).
+        exponent: How strongly ratings skew the draw; 0 draws uniformly
+            (defaults to JOKE_RATING_EXPONENT).
+        rng: Optional random.Random, for reproducible draws.
+        broadcast: Give subscribers with the same categories the same jokes
+            for the rest of the tick (see pick_shared).
+    """
+
+    def __init__(self, now=None, exponent=None, rng=None, broadcast=False):
+        self.cutoff = (now or datetime.utcnow()) - RESEND_COOLDOWN
+        self.exponent = current_app.config.get('JOKE_RATING_EXPONENT', 2.0) if exponent is None else exponent
+        self.rng = rng or random.Random()
+        self.broadcast = broadcast
+        self.categories = {}
+        self.shared = {}
+        self.taken = set()
+        # When reservations on the delivery ledger were last read (see delivery.claim_deliveries)
+        self.synced_at = None
+
+    def prepare(self, category_ids):
+        """Build the candidate tables of the given categories that are not loaded yet."""
+        missing = set(category_ids) - set(self.categories)
+        if not missing:
+            return
+        rows = {category_id: [] for category_id in missing}
+        for row in db.session.query(
+            Joke.category_id, Joke.id, Joke.rating_sum, Joke.rating_count
+        ).filter(
+            Joke.category_id.in_(missing),
+            or_(Joke.last_sent == None, Joke.last_sent <= self.cutoff)
+        ):
+            rows[row.category_id].append(row)
+        for category_id, category_rows in rows.items():
+            self.categories[category_id] = CategoryCandidates(category_rows, self.exponent)
+
+    def take(self, joke_ids):
+        """Keep jokes reserved outside this sampler from being picked."""
+        self.taken.update(joke_ids)
+
+    def pick(self, category_id, seen):
+        """Pick and reserve a joke of a category the subscriber has not seen, or None."""
+        candidates = self.categories.get(category_id)
+        joke_id = candidates.pick(seen, self.taken, self.rng) if candidates else None
+        if joke_id is not None:
+            self.taken.add(joke_id)
+        return joke_id
+
+    def pick_shared(self, category_ids, seen):
+        """
+        Pick jokes for the subscribers of one category group, sharing sets between them.
+
+        Each subscriber first gets the group's newest set from earlier in the
+        tick that they have seen none of. The rest get new sets, each picked
+        from jokes none of them has seen, so one set covers everyone it can;
+        the subscribers it misses get the next set. Only a set picked for a
+        single subscriber may leave out a category they have exhausted.
+
+        Args:
+            category_ids: The group's category ids, sorted.
+            seen: The JokeBitmaps of the group's subscribers in this batch.
+
+        Returns:
+            list: A tuple of joke ids per subscriber, in the order of ``seen``.
+        """
+        sets = self.shared.setdefault(category_ids, [])
+        picks = [None] * len(seen)
+        for index, bitmap in enumerate(seen):
+            for joke_ids in reversed(sets[-MAX_SHARED_SETS:]):
+                if not any(joke_id in bitmap for joke_id in joke_ids):
+                    picks[index] = joke_ids
+                    break
+
+        remaining = [index for index, joke_ids in enumerate(picks) if joke_ids is None]
+        while remaining:
+            group = GroupSeen([seen[index] for index in remaining])
+            first = seen[remaining[0]]
+            joke_ids = []
+            for category_id in category_ids:
+                joke_id = self.pick(category_id, group)
+                if joke_id is None:
+                    joke_id = self.pick(category_id, first)
+                joke_ids.append(joke_id)
+            if None in joke_ids:
+                # Not a full set; only the subscriber it was picked for gets it
+                picks[remaining.pop(0)] = tuple(joke_id for joke_id in joke_ids if joke_id is not None)
+                continue
+            joke_ids = tuple(joke_ids)
+            sets.append(joke_ids)
+            rest = []
+            for index in remaining:
+                if any(joke_id in seen[index] for joke_id in joke_ids):
+                    rest.append(index)
+                else:
+                    picks[index] = joke_ids
+            remaining = rest
+        return picks
+
+
+class GroupSeen:
+    """The jokes seen by any of several subscribers, checked against each of their bitmaps."""
+
+    def __init__(self, bitmaps):
+        self.bitmaps = bitmaps
+
+    def __contains__(self, joke_id):
+        return any(joke_id in bitmap for bitmap in self.bitmaps)
+
+
+def select_jokes_for_subscribers(subscribers, seen=None, sampler=None):
+    """
+    Pick one joke per subscribed category for every subscriber in a batch,
+    never one the subscriber has been sent before.
+
+    Jokes are drawn with probability growing with their rating (see
+    JokeSampler); jokes sent to anyone within RESEND_COOLDOWN, or picked
+    for another subscriber this tick, are not eligible. With a broadcast
+    sampler, subscribers are grouped by their set of active categories and
+    each group shares as few joke sets as its members' histories allow (see
+    JokeSampler.pick_shared). Queries: the seen bitmaps (see seen_jokes.py),
+    plus one candidate query the first time the sampler meets a category.
+
+    Args:
+        subscribers: A list of Subscriber objects.
+        seen: Optional mapping of subscriber id to JokeBitmap, loaded when
+            omitted. Selected jokes are not added to it.
+        sampler: The tick's JokeSampler; a new one is built when omitted.
+
+    Returns:
+        list: (subscriber, joke ids) tuples for subscribers with at least one joke.
+    """
+    wanted = [
+        (subscriber, list(dict.fromkeys((subscriber.preferences or {}).get('categories', []))))
+        for subscriber in subscribers
+    ]
+    categories = load_active_categories(
+        name for _, names in wanted for name in names
+    )
+    if seen is None:
+        seen = load_seen(subscriber.id for subscriber in subscribers)
+    sampler = sampler or JokeSampler()
+    sampler.prepare(category.id for category in categories.values())
+
+    picks = {}
+    if sampler.broadcast:
+        groups = {}
+        for subscriber, names in wanted:
+            category_ids = tuple(sorted(categories[name].id for name in names if name in categories))
+            groups.setdefault(category_ids, []).append(subscriber)
+        groups.pop((), None)
+        for category_ids, members in groups.items():
+            shared = sampler.pick_shared(category_ids, [seen[subscriber.id] for subscriber in members])
+            picks.update(zip((subscriber.id for subscriber in members), shared))
+    else:
+        for subscriber, names in wanted:
+            joke_ids = []
+            for name in names:
+                if name in categories:
+                    joke_id = sampler.pick(categories[name].id, seen[subscriber.id])
+                    if joke_id is not None:
+                        joke_ids.append(joke_id)
+            picks[subscriber.id] = joke_ids
+
+    return [
+        (subscriber, list(picks[subscriber.id]))
+        for subscriber, _ in wanted if picks.get(subscriber.id)
+    ]
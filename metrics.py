@@ -0,0 +1,423 @@
+import atexit
+import bisect
+import functools
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; wide enough for a sub-millisecond query and a slow SMTP handshake
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# A tick, or one phase of it summed over its workers, can take most of a minute
+TICK_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 120.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def state(self):
+        with self._lock:
+            return dict(self._values)
+
+    def combine(self, total, pairs):
+        """Add (label values, value) pairs read from another process into ``total``."""
+        for key, value in pairs:
+            key = tuple(key)
+            total[key] = total.get(key, 0) + value
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram:
+    """
+    Observation counts in fixed buckets per label set, plus their sum and count.
+
+    An observation is a bisect and three additions under a lock, so timing
+    every SQL statement and SMTP send costs a few microseconds.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def state(self):
+        with self._lock:
+            return {key: list(values) for key, values in self._series.items()}
+
+    def combine(self, total, pairs):
+        """Add (label values, series) pairs read from another process into ``total``."""
+        for key, values in pairs:
+            if len(values) != len(self.buckets) + 2:
+                # Written with other buckets, by a process from another release
+                continue
+            key = tuple(key)
+            if key in total:
+                total[key] = [mine + theirs for mine, theirs in zip(total[key], values)]
+            else:
+                total[key] = list(values)
+
+    def samples(self, series):
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {values[-1]}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}'
+
+
+class Registry:
+    """
+    The metrics of this process, rendered in the Prometheus text format.
+
+    After share(), every process also writes its values to a file of its own
+    in a common directory every few seconds, and render() adds the files of
+    the other processes to its own live values. Whichever gunicorn worker
+    answers a scrape then reports the totals of all of them.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.interval = None
+        self._writer = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory, interval=5.0, reset=False):
+        """
+        Merge these metrics with those of the other processes using ``directory``.
+
+        Forked children (gunicorn --preload workers) drop the values they
+        inherited and write a file of their own.
+
+        Args:
+            directory: Directory shared by the processes of one server.
+            interval: Seconds between writes of this process's values.
+            reset: Remove files left by earlier runs; only for the process
+                that starts before the others, such as the gunicorn master.
+        """
+        os.makedirs(directory, exist_ok=True)
+        if reset:
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(directory, name))
+        self.directory = directory
+        self.interval = interval
+        if self._writer is None:
+            os.register_at_fork(after_in_child=self._after_fork)
+            atexit.register(self.write)
+            self._start_writer()
+
+    def _path(self):
+        return os.path.join(self.directory, f'{os.getpid()}.json')
+
+    def _start_writer(self):
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.write()
+
+        self._writer = threading.Thread(target=run, name='metrics-writer', daemon=True)
+        self._writer.start()
+
+    def _after_fork(self):
+        for metric in self.metrics:
+            metric.reset()
+        self._start_writer()
+
+    def write(self):
+        """Write this process's values to its file in the shared directory."""
+        if self.directory is None:
+            return
+        path = self._path()
+        data = {
+            metric.name: [[list(key), value] for key, value in metric.state().items()]
+            for metric in self.metrics
+        }
+        try:
+            with open(f'{path}.tmp', 'w') as handle:
+                json.dump(data, handle)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {path}: {str(e)}")
+
+    def _shared(self):
+        if self.directory is None:
+            return
+        own = os.path.basename(self._path())
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as handle:
+                    yield json.load(handle)
+            except (OSError, ValueError):
+                # Removed or replaced while being read; its values return on the next scrape
+                continue
+
+    def render(self):
+        totals = {metric.name: metric.state() for metric in self.metrics}
+        for data in self._shared():
+            for metric in self.metrics:
+                metric.combine(totals[metric.name], data.get(metric.name, ()))
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(totals[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+# Values are per process unless the registry is shared (see init_app): the
+# gunicorn workers behind one port then report their combined totals, while
+# the scheduler, one process per replica, serves its own on a port of its own
+registry = Registry()
+
+TICK_SECONDS = registry.add(Histogram(
+    'dailyjokes_tick_seconds', 'Wall time of a delivery tick.', buckets=TICK_BUCKETS))
+TICK_PHASE_SECONDS = registry.add(Histogram(
+    'dailyjokes_tick_phase_seconds', 'Time a delivery tick spent per phase, summed over its worker threads.',
+    labels=('phase',), buckets=TICK_BUCKETS))
+EMAILS = registry.add(Counter(
+    'dailyjokes_emails_total', 'Daily joke emails by outcome.', labels=('result',)))
+SQL_SECONDS = registry.add(Histogram(
+    'dailyjokes_sql_statement_seconds', 'SQL statement latency by statement kind and table.',
+    labels=('statement',)))
+SMTP_SEND_SECONDS = registry.add(Histogram(
+    'dailyjokes_smtp_send_seconds', 'Time to hand one message to the SMTP server.'))
+SMTP_CONNECT_SECONDS = registry.add(Histogram(
+    'dailyjokes_smtp_connect_seconds', 'Time to open an SMTP session, including TLS and login.'))
+SMTP_ERRORS = registry.add(Counter(
+    'dailyjokes_smtp_errors_total', 'SMTP sends that failed or dropped the connection.'))
+HTTP_SECONDS = registry.add(Histogram(
+    'dailyjokes_http_request_seconds', 'Web request latency by endpoint.', labels=('endpoint', 'method')))
+
+
+class TickSpans:
+    """
+    Per-phase timing for one delivery tick, shared by its worker threads.
+
+    Phases are enqueue, select (claiming and loading), render, send and
+    persist. finish() records the totals in the tick histograms and returns
+    them for the tick's log line.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.totals = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.started
+        TICK_SECONDS.observe(elapsed)
+        with self._lock:
+            totals = dict(self.totals)
+        for name, total in totals.items():
+            TICK_PHASE_SECONDS.observe(total, phase=name)
+        return elapsed, totals
+
+
+_VERB = re.compile(r'^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA|CREATE|ALTER|DROP)\b',
+                   re.IGNORECASE | re.DOTALL)
+_TABLE = {
+    'SELECT': re.compile(r'\bFROM\s+"?(\w+)', re.IGNORECASE),
+    'INSERT': re.compile(r'\bINTO\s+"?(\w+)', re.IGNORECASE),
+    'UPDATE': re.compile(r'^\s*UPDATE\s+"?(\w+)', re.IGNORECASE),
+    'DELETE': re.compile(r'\bFROM\s+"?(\w+)', re.IGNORECASE),
+}
+
+
+@functools.lru_cache(maxsize=2048)
+def statement_group(statement):
+    """
+    Reduce a SQL statement to a low-cardinality label such as ``SELECT subscriber``.
+
+    Statements are grouped by verb and first table, not by text, so the
+    number of series stays bounded however many query shapes there are.
+    """
+    verb = _VERB.match(statement)
+    if not verb:
+        return 'OTHER'
+    verb = verb.group(1).upper()
+    table = _TABLE.get(verb)
+    table = table.search(statement) if table else None
+    return f'{verb} {table.group(1).lower()}' if table else verb
+
+
+_sql_timing_installed = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is not None:
+        SQL_SECONDS.observe(time.perf_counter() - started, statement=statement_group(statement))
+
+
+def install_sql_timing():
+    """Time every statement run through any SQLAlchemy engine of this process."""
+    global _sql_timing_installed
+    if not _sql_timing_installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _sql_timing_installed = True
+
+
+def authorized(header, token):
+    """Whether an Authorization header carries the METRICS_TOKEN bearer token (never, if none is set)."""
+    if not token:
+        return False
+    return hmac.compare_digest(header or '', f'Bearer {token}')
+
+
+def init_app(app, web=True):
+    """
+    Turn on SQL timing and, for the web app, per-endpoint request timing and
+    a registry shared by its worker processes through METRICS_DIR.
+
+    Args:
+        app: The Flask application.
+        web: Whether this is the web app.
+    """
+    install_sql_timing()
+    if not web:
+        return
+    # The web app is created once before gunicorn forks its workers
+    registry.share(app.config['METRICS_DIR'], app.config.get('METRICS_WRITE_INTERVAL', 5), reset=True)
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            HTTP_SECONDS.observe(time.perf_counter() - started,
+                                 endpoint=request.endpoint or 'unmatched', method=request.method)
+        return response
+
+
+def serve(port, token=None, host='0.0.0.0'):
+    """
+    Serve GET /metrics from a daemon thread, for processes without a web app.
+
+    Args:
+        port: Port to listen on.
+        token: Bearer token scrapers must send; without one every scrape is refused.
+        host: Interface to bind.
+
+    Returns:
+        ThreadingHTTPServer: The running server; call shutdown() to stop it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            if not authorized(self.headers.get('Authorization'), token):
+                self.send_error(401)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"metrics: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on {host}:{port}/metrics")
+    return server
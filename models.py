@@ -1,7 +1,11 @@
 from app import db
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
+from sqlalchemy.dialects.postgresql import JSONB
+from utils.db_utils import is_postgres
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 class Admin(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -21,6 +25,34 @@ class Category(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+MINUTES_PER_DAY = 24 * 60
+
+
+def is_valid_timezone(name):
+    """Whether name is an IANA timezone known to this system."""
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, TypeError):
+        return False
+    return True
+
+
+def utc_offset_minutes(timezone, now=None):
+    """Current UTC offset of an IANA timezone in minutes (0 for UTC or unknown zones)."""
+    if not timezone or timezone == 'UTC' or not is_valid_timezone(timezone):
+        return 0
+    now = now or datetime.utcnow()
+    offset = now.replace(tzinfo=ZoneInfo('UTC')).astimezone(ZoneInfo(timezone)).utcoffset()
+    return int(offset.total_seconds() // 60)
+
+
+def delivery_slot_for(value, timezone='UTC', now=None):
+    """Return the UTC minute of day for a local delivery time, or None if it is unset."""
+    if value is None:
+        return None
+    return (value.hour * 60 + value.minute - utc_offset_minutes(timezone, now)) % MINUTES_PER_DAY
+
+
 class Subscriber(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -28,6 +60,53 @@ class Subscriber(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     preferences = db.Column(db.JSON, default=lambda: {"categories": ["general"]})
     delivery_time = db.Column(db.Time, default=datetime.strptime('09:00', '%H:%M').time())
+    # IANA timezone delivery_time is expressed in
+    timezone = db.Column(db.String(64), default='UTC')
+    # UTC minute of day of delivery_time in timezone, so the scheduler can look
+    # subscribers up by index; recomputed in bulk when offsets change (see delivery_slots.py)
+    delivery_slot = db.Column(db.SmallInteger, default=9 * 60)
+    # Minute the scheduler actually sends in: delivery_slot, or a neighbouring
+    # minute when delivery_slot is overloaded
+    send_slot = db.Column(db.SmallInteger, default=9 * 60)
+
+    # SQLite only uses a partial index when the query repeats its WHERE term
+    # verbatim, and SQLAlchemy writes is_active == True as is_active = 1 there
+    __table_args__ = (
+        db.Index(
+            'ix_subscriber_active_delivery_slot', 'delivery_slot',
+            postgresql_where=db.text('is_active'),
+            sqlite_where=db.text('is_active = 1'),
+        ),
+        db.Index(
+            'ix_subscriber_active_send_slot', 'send_slot',
+            postgresql_where=db.text('is_active'),
+            sqlite_where=db.text('is_active = 1'),
+        ),
+    )
+
+    @validates('delivery_time', 'timezone')
+    def _sync_delivery_slot(self, key, value):
+        delivery_time = value if key == 'delivery_time' else self.delivery_time
+        timezone = value if key == 'timezone' else self.timezone
+        self.delivery_slot = self.send_slot = delivery_slot_for(delivery_time, timezone or 'UTC')
+        return value
+
+    @classmethod
+    def wants_category(cls, name):
+        """SQL condition: the subscriber's preferences include this category name."""
+        if is_postgres():
+            return db.cast(cls.preferences, JSONB)['categories'].has_key(name)
+        categories = db.func.json_each(cls.preferences, '$.categories').table_valued('value')
+        return db.select(categories.c.value).where(categories.c.value == name).exists()
+
+    @classmethod
+    def category_elements(cls):
+        """Table-valued function yielding one ``value`` row per preferred category name."""
+        if is_postgres():
+            return db.func.jsonb_array_elements_text(
+                db.cast(cls.preferences, JSONB)['categories']
+            ).table_valued('value')
+        return db.func.json_each(cls.preferences, '$.categories').table_valued('value')
 
 class Joke(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -35,14 +114,294 @@ class Joke(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_sent = db.Column(db.DateTime, nullable=True)
+    # Average of rating_sum / rating_count, kept in step by add_ratings()
     rating = db.Column(db.Float, default=0.0)
+    rating_sum = db.Column(db.Integer, default=0)
+    rating_count = db.Column(db.Integer, default=0)
     times_sent = db.Column(db.Integer, default=0)
+    # Hash of the normalized text, see dedup.py
+    content_hash = db.Column(db.BigInteger, nullable=True)
     
     category = db.relationship('Category', backref=db.backref('jokes', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_joke_category_last_sent', 'category_id', 'last_sent'),
+        db.Index('ix_joke_category_id', 'category_id', 'id'),
+        db.Index('ix_joke_content_hash', 'content_hash'),
+    )
+
+    @classmethod
+    def add_ratings(cls, joke_id, total, count=1):
+        """
+        Fold ratings into a joke's running aggregate with one atomic UPDATE.
+
+        The new values are computed by the database from the current row, so
+        concurrent raters never overwrite each other.
+
+        Args:
+            joke_id: The joke being rated.
+            total: Sum of the ratings being added.
+            count: Number of ratings being added.
+
+        Returns:
+            tuple: (old rating, new rating), or None if the joke does not exist.
+        """
+        row = db.session.execute(
+            db.update(cls).where(cls.id == joke_id).values(
+                rating_sum=cls.rating_sum + total,
+                rating_count=cls.rating_count + count,
+                rating=db.cast(cls.rating_sum + total, db.Float) / (cls.rating_count + count),
+            ).returning(cls.rating_sum, cls.rating_count).execution_options(synchronize_session=False)
+        ).first()
+        if row is None:
+            return None
+        rating_sum, rating_count = row
+        old_count = rating_count - count
+        old_rating = (rating_sum - total) / old_count if old_count else 0.0
+        return old_rating, rating_sum / rating_count
+
+
+class JokeRating(db.Model):
+    """Append-only log of individual rating clicks."""
+    id = db.Column(db.Integer, primary_key=True)
+    joke_id = db.Column(db.Integer, db.ForeignKey('joke.id'), nullable=False, index=True)
+    rating = db.Column(db.SmallInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class JokeFingerprint(db.Model):
+    """LSH bucket ids of a joke's MinHash signature, one row per band (see dedup.py)."""
+    bucket = db.Column(db.BigInteger, primary_key=True)
+    joke_id = db.Column(db.Integer, db.ForeignKey('joke.id'), primary_key=True)
+
 
 class JokeHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     joke_id = db.Column(db.Integer, db.ForeignKey('joke.id'), nullable=False)
     sent_at = db.Column(db.DateTime, nullable=True)
     user = db.Column(db.Integer, db.ForeignKey('subscriber.id'), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_joke_history_user_sent_at', 'user', 'sent_at'),
+    )
+
+
+class SeenJokes(db.Model):
+    """Compressed bitmap of the jokes each subscriber has been sent (see seen_jokes.py)."""
+    subscriber_id = db.Column(db.Integer, db.ForeignKey('subscriber.id'), primary_key=True)
+    bitmap = db.Column(db.LargeBinary, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Delivery(db.Model):
+    """
+    Send ledger: one row per subscriber per delivery date.
+
+    Rows are created as pending when a tick starts, claimed in batches with
+    ``FOR UPDATE SKIP LOCKED`` and marked sent in the same transaction that
+    records the JokeHistory, so a crashed or overrunning tick can be resumed
+    by any scheduler replica without sending twice or skipping anyone.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subscriber_id = db.Column(db.Integer, db.ForeignKey('subscriber.id'), nullable=False)
+    delivery_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING)
+    # Jokes reserved for this delivery when it is first claimed, reused on retries
+    joke_ids = db.Column(db.JSON, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(64), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('subscriber_id', 'delivery_date', name='uq_delivery_subscriber_date'),
+        db.Index(
+            'ix_delivery_pending', 'delivery_date', 'id',
+            postgresql_where=db.text("status = 'pending'"),
+            sqlite_where=db.text("status = 'pending'"),
+        ),
+        # Replicas read each other's recent joke reservations by claim time
+        db.Index('ix_delivery_claimed_at', 'claimed_at'),
+    )
+
+
+class OutboxMessage(db.Model):
+    """
+    Transactional outbox for emails triggered by a web request.
+
+    The row is written in the same transaction as the change that calls for
+    the email, so the request only pays for its commit; the scheduler drains
+    pending rows in batches over pooled SMTP connections, claiming them the
+    same way as Delivery rows so replicas never send one twice.
+    """
+    WELCOME = 'welcome'
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)
+    recipient = db.Column(db.String(120), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(64), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    retry_at = db.Column(db.DateTime, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index(
+            'ix_outbox_message_pending', 'id',
+            postgresql_where=db.text("status = 'pending'"),
+            sqlite_where=db.text("status = 'pending'"),
+        ),
+    )
+
+
+class CacheVersion(db.Model):
+    """
+    Shared version counters for data cached in process memory.
+
+    Writers bump a counter in the same transaction as their change; caches in
+    every web worker and scheduler process compare it with the version they
+    loaded and reload when it moves.
+    """
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # When the counter last moved, used as Last-Modified for cached pages
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def current(cls, name):
+        """Read a counter straight from the database (0 if it was never bumped)."""
+        return db.session.query(cls.version).filter_by(name=name).scalar() or 0
+
+    @classmethod
+    def state(cls, name):
+        """Read a counter and the time it last moved: (version, updated_at)."""
+        row = db.session.query(cls.version, cls.updated_at).filter_by(name=name).first()
+        return (row.version, row.updated_at) if row else (0, None)
+
+    @classmethod
+    def bump(cls, name):
+        """Increment a counter as part of the current transaction."""
+        now = datetime.utcnow()
+        updated = db.session.query(cls).filter_by(name=name).update(
+            {cls.version: cls.version + 1, cls.updated_at: now}, synchronize_session=False
+        )
+        if not updated:
+            db.session.add(cls(name=name, version=1, updated_at=now))
+
+
+class AnalyticsRollup(db.Model):
+    """
+    Daily snapshot of the admin analytics figures.
+
+    Every row carries the number of subscribers who joined that day; the row
+    for the current day also holds the totals, rating buckets and category
+    preferences as of ``refreshed_at``. Closed days are never recounted.
+    """
+    day = db.Column(db.Date, primary_key=True)
+    new_subscribers = db.Column(db.Integer, nullable=False, default=0)
+    total_subscribers = db.Column(db.Integer, nullable=True)
+    active_subscribers = db.Column(db.Integer, nullable=True)
+    average_rating = db.Column(db.Float, nullable=True)
+    # Rated jokes and the sum of their ratings, so changes can be folded into the average
+    joke_count = db.Column(db.Integer, nullable=True)
+    rating_total = db.Column(db.Float, nullable=True)
+    ratings_distribution = db.Column(db.JSON, nullable=True)
+    category_preferences = db.Column(db.JSON, nullable=True)
+    refreshed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class AnalyticsChange(db.Model):
+    """
+    A change to the analytics totals, written in the transaction that made it
+    and folded into the rollup (then deleted) by the next refresh.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    subscribers = db.Column(db.Integer, nullable=False, default=0)
+    active_subscribers = db.Column(db.Integer, nullable=False, default=0)
+    jokes = db.Column(db.Integer, nullable=False, default=0)
+    rating_total = db.Column(db.Float, nullable=False, default=0.0)
+    # Change in jokes per star bucket, and in active subscribers per category name
+    ratings = db.Column(db.JSON, nullable=True)
+    categories = db.Column(db.JSON, nullable=True)
+    # Set by writers that cannot tell what they changed; the next refresh recounts
+    recount = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class GenerationJob(db.Model):
+    """A queued request to generate jokes for a category with the AI service."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=10)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    # 'admin' for button clicks, 'refill' for low-inventory top-ups
+    source = db.Column(db.String(16), nullable=False, default='admin')
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    category = db.relationship('Category')
+
+
+class ImportJob(db.Model):
+    """An uploaded bulk import file, processed in the background by the web worker that received it (see bulk.py)."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)
+    format = db.Column(db.String(8), nullable=False)
+    filename = db.Column(db.String(255), nullable=True)
+    # The spool file only exists on the host that received the upload
+    path = db.Column(db.String(512), nullable=False)
+    host = db.Column(db.String(255), nullable=False)
+    pid = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    read = db.Column(db.Integer, nullable=False, default=0)
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    duplicates = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'format': self.format, 'filename': self.filename,
+            'status': self.status, 'read': self.read, 'imported': self.imported, 'skipped': self.skipped,
+            'duplicates': self.duplicates, 'errors': self.errors or [], 'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class RatingBatch(db.Model):
+    """Spool files of queued ratings already applied, so a replayed file is applied once (see rating_queue.py)."""
+    name = db.Column(db.String(120), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
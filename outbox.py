@@ -0,0 +1,128 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_
+from app import db
+from models import OutboxMessage
+from delivery import WORKER_ID, shutdown_requested
+from email_service import build_welcome_email, get_mail_pool
+from utils.db_utils import update_from_values
+
+logger = logging.getLogger(__name__)
+
+# Message builders by OutboxMessage.kind
+BUILDERS = {
+    OutboxMessage.WELCOME: build_welcome_email,
+}
+
+
+def enqueue_welcome(email):
+    """Queue a welcome email as part of the current transaction; the caller commits."""
+    db.session.add(OutboxMessage(kind=OutboxMessage.WELCOME, recipient=email))
+
+
+def claim_messages(limit, after_id=0, now=None):
+    """
+    Claim a batch of pending outbox messages for this process.
+
+    Rows locked by another replica are skipped, rows claimed by a process
+    that has not finished them within SCHEDULER_CLAIM_LEASE are retaken, and
+    failed rows wait until their retry time.
+
+    Args:
+        limit: Maximum number of messages to claim.
+        after_id: Only claim messages with a larger id, so a pass does not
+            retry the failures it has just released.
+        now: Reference time (defaults to utcnow).
+
+    Returns:
+        list: (message_id, kind, recipient, attempts) tuples ready to send.
+    """
+    now = now or datetime.utcnow()
+    lease = timedelta(seconds=current_app.config.get('SCHEDULER_CLAIM_LEASE', 300))
+
+    messages = OutboxMessage.query.filter(
+        OutboxMessage.status == OutboxMessage.PENDING,
+        OutboxMessage.id > after_id,
+        or_(OutboxMessage.claimed_at == None, OutboxMessage.claimed_at < now - lease),
+        or_(OutboxMessage.retry_at == None, OutboxMessage.retry_at <= now)
+    ).order_by(OutboxMessage.id).limit(limit).with_for_update(skip_locked=True).all()
+
+    claimed = []
+    for message in messages:
+        message.claimed_by = WORKER_ID
+        message.claimed_at = now
+        message.attempts += 1
+        claimed.append((message.id, message.kind, message.recipient, message.attempts))
+    db.session.commit()
+    return claimed
+
+
+def _send_claimed(batch, connection):
+    """
+    Send one claimed batch over a pooled connection and record every outcome with one UPDATE.
+
+    Failed messages go back to pending until they have used up
+    OUTBOX_MAX_ATTEMPTS, and are retried after OUTBOX_RETRY_DELAY seconds,
+    doubled for every earlier failure.
+
+    Returns:
+        int: Number of messages sent.
+    """
+    max_attempts = current_app.config.get('OUTBOX_MAX_ATTEMPTS', 5)
+    retry_delay = current_app.config.get('OUTBOX_RETRY_DELAY', 60)
+    outcomes = []
+    sent = 0
+    for message_id, kind, recipient, attempts in batch:
+        try:
+            connection.send(BUILDERS[kind](recipient))
+        except Exception as e:
+            logger.error(f"Failed to send {kind} email to {recipient}: {str(e)}")
+            outcomes.append({
+                'id': message_id,
+                'status': OutboxMessage.FAILED if attempts >= max_attempts else OutboxMessage.PENDING,
+                'claimed_by': None, 'claimed_at': None,
+                'retry_at': datetime.utcnow() + timedelta(seconds=retry_delay * 2 ** (attempts - 1)),
+                'sent_at': None, 'error': str(e)[:255],
+            })
+            continue
+        outcomes.append({
+            'id': message_id, 'status': OutboxMessage.SENT,
+            'claimed_by': WORKER_ID, 'claimed_at': None, 'retry_at': None,
+            'sent_at': datetime.utcnow(), 'error': None,
+        })
+        sent += 1
+    update_from_values(OutboxMessage, outcomes)
+    db.session.commit()
+    return sent
+
+
+def drain_outbox(deadline=None):
+    """
+    Send pending outbox messages in batches of OUTBOX_BATCH_SIZE until none are left.
+
+    All batches of a pass share one pooled SMTP connection. Stops between
+    batches at the deadline or when the process is shutting down; the rest
+    is picked up by the next pass.
+
+    Args:
+        deadline: Optional time.monotonic() value after which no new batch is claimed.
+
+    Returns:
+        int: Number of messages sent.
+    """
+    batch_size = current_app.config.get('OUTBOX_BATCH_SIZE', 50)
+    sent = 0
+    started = time.monotonic()
+    batch = claim_messages(batch_size)
+    if not batch:
+        return 0
+    with get_mail_pool().connection() as connection:
+        while batch:
+            sent += _send_claimed(batch, connection)
+            if shutdown_requested.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                break
+            batch = claim_messages(batch_size, after_id=batch[-1][0])
+    logger.info(f"Sent {sent} outbox emails in {time.monotonic() - started:.2f}s")
+    return sent
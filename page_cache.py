@@ -0,0 +1,118 @@
+import hashlib
+import threading
+from collections import namedtuple
+from datetime import datetime
+from flask import render_template, make_response, request, session
+from category_cache import category_cache
+
+# Pages rendered by an older deploy must not look current, so nothing is
+# older than this process
+STARTED_AT = datetime.utcnow().replace(microsecond=0)
+
+# A rendered page with its validators
+CachedPage = namedtuple('CachedPage', 'body etag last_modified')
+
+
+class PageCache:
+    """
+    In-process cache of rendered public pages.
+
+    Pages are keyed by route, template and variant, and dropped as soon as
+    the shared ``categories`` version moves. The version comes from the
+    category cache, so a hit normally touches no database at all. Flash
+    messages are the only per-visitor part of these templates, so a request
+    with messages pending is rendered without the cache and its page is
+    stored nowhere, not even by the browser. Conditional pages also get an
+    ETag and a Last-Modified taken from the version's change time, and
+    matching conditional requests are answered with 304.
+    """
+
+    MAX_ENTRIES = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._version = None
+        self.routes = {}
+
+    def _count(self, route, outcome):
+        with self._lock:
+            counters = self.routes.setdefault(route, {'hits': 0, 'misses': 0, 'not_modified': 0})
+            counters[outcome] += 1
+
+    def render(self, route, template, variant=None, conditional=False, **context):
+        """
+        Render a template through the cache.
+
+        Args:
+            route: Name the page is counted under in stats().
+            template: The template to render.
+            variant: Hashable value telling apart renders of the same
+                template with different context.
+            conditional: Whether to add ETag/Last-Modified and answer
+                conditional requests with 304. Only for pages whose request
+                has no side effects.
+            **context: Template context, only used on a miss.
+
+        Returns:
+            Response: The page, or an empty 304 response.
+        """
+        if session.get('_flashes'):
+            self._count(route, 'misses')
+            response = make_response(render_template(template, **context))
+            response.cache_control.no_store = True
+            return response
+
+        version, changed_at = category_cache.version()
+        key = (route, template, variant)
+
+        with self._lock:
+            if version != self._version:
+                self._pages = {}
+                self._version = version
+            page = self._pages.get(key)
+
+        if page is None:
+            outcome = 'misses'
+            body = render_template(template, **context)
+            page = CachedPage(
+                body,
+                hashlib.blake2b(body.encode(), digest_size=16).hexdigest(),
+                max(changed_at or STARTED_AT, STARTED_AT),
+            )
+            with self._lock:
+                if len(self._pages) >= self.MAX_ENTRIES:
+                    self._pages = {}
+                if version == self._version:
+                    self._pages[key] = page
+        else:
+            outcome = 'hits'
+
+        response = make_response(page.body)
+        if conditional:
+            response.set_etag(page.etag)
+            response.last_modified = page.last_modified
+            response.cache_control.no_cache = True
+            response.make_conditional(request)
+            if response.status_code == 304:
+                outcome = 'not_modified'
+        self._count(route, outcome)
+        return response
+
+    def invalidate(self):
+        """Drop every cached page."""
+        with self._lock:
+            self._pages = {}
+
+    def stats(self):
+        """Per-route hit/miss counters for this process; 304s count as hits."""
+        with self._lock:
+            routes = {route: dict(counters) for route, counters in self.routes.items()}
+        for counters in routes.values():
+            served = counters['hits'] + counters['not_modified']
+            total = served + counters['misses']
+            counters['hit_ratio'] = served / total if total else 0.0
+        return routes
+
+
+page_cache = PageCache()
@@ -0,0 +1,243 @@
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Joke, JokeRating, RatingBatch
+from analytics import ratings_changed
+
+logger = logging.getLogger(__name__)
+
+# Applied batch names are kept this long before being pruned
+BATCH_RETENTION = timedelta(days=7)
+
+# Dots would clash with the file suffixes
+_HOST = socket.gethostname().replace('.', '_')
+
+_spool_lock = threading.Lock()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RatingSpool:
+    """
+    Durable write-behind queue for rating clicks.
+
+    Each click is appended as one line to this process's spool file, which
+    survives the process being killed or restarted. A background thread
+    rotates the file into a batch every ``interval`` seconds and folds the
+    batch into the database in one transaction: one Joke.add_ratings UPDATE
+    per rated joke and one multi-row JokeRating INSERT. The batch's name is
+    recorded in RatingBatch in the same transaction, so a batch replayed after
+    a crash between commit and cleanup is not applied twice. Spool files and
+    batches left by dead processes on the same host are picked up by any
+    process sharing the directory.
+
+    Args:
+        app: The Flask application.
+        directory: Spool directory, shared by the workers of a host.
+        interval: Seconds between flushes.
+    """
+
+    def __init__(self, app, directory, interval):
+        self.app = app
+        self.directory = directory
+        self.interval = interval
+        self.pid = os.getpid()
+        self.prefix = f"ratings-{_HOST}-"
+        self.path = os.path.join(directory, f"{self.prefix}{self.pid}.log")
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._fd = None
+        self._dirty = False
+        self._sequence = 0
+        self._pruned_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # A spool file left by an earlier process with the same pid is ours now
+        self._dirty = os.fstat(self._fd).st_size > 0
+
+    def append(self, joke_id, rating):
+        """Queue one rating click."""
+        line = f"{joke_id} {rating} {time.time():.3f}\n".encode()
+        with self._lock:
+            if self._fd is None:
+                self._open()
+            # A single O_APPEND write, so a killed process leaves at most a torn last line
+            os.write(self._fd, line)
+            self._dirty = True
+
+    def _rotate(self):
+        """Move the current spool file aside as a batch and start a new one."""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.close(self._fd)
+            self._fd = None
+            self._sequence += 1
+            batch = f"{self.prefix}{self.pid}-{int(time.time() * 1000)}-{self._sequence}.batch"
+            os.replace(self.path, os.path.join(self.directory, batch))
+            self._dirty = False
+
+    def _claim(self, name):
+        """
+        Take ownership of a batch by renaming it, or of a dead process's spool file.
+
+        Returns the claimed path and the batch name used in RatingBatch, or None.
+        """
+        stem, _, suffix = name.partition('.')
+        if suffix == 'log':
+            pid = stem[len(self.prefix):]
+            if not pid.isdigit() or int(pid) == self.pid or _pid_alive(int(pid)):
+                return None
+            stem = f"{stem}-orphan-{int(time.time() * 1000)}"
+        elif suffix.startswith('batch.'):
+            owner = suffix[len('batch.'):]
+            if owner.isdigit() and int(owner) != self.pid and _pid_alive(int(owner)):
+                return None
+        elif suffix != 'batch':
+            return None
+
+        claimed = os.path.join(self.directory, f"{stem}.batch.{self.pid}")
+        try:
+            os.replace(os.path.join(self.directory, name), claimed)
+        except FileNotFoundError:
+            # Another process got there first
+            return None
+        return claimed, stem
+
+    def _apply(self, path, name):
+        totals = {}
+        rows = []
+        with open(path, 'rb') as spool:
+            for line in spool:
+                try:
+                    joke_id, rating, clicked_at = line.split()
+                    joke_id, rating = int(joke_id), int(rating)
+                    clicked_at = datetime.utcfromtimestamp(float(clicked_at))
+                except ValueError:
+                    # Torn last line of a killed process
+                    continue
+                total, count = totals.get(joke_id, (0, 0))
+                totals[joke_id] = (total + rating, count + 1)
+                rows.append({'joke_id': joke_id, 'rating': rating, 'created_at': clicked_at})
+
+        try:
+            db.session.add(RatingBatch(name=name))
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            logger.info(f"Rating batch {name} was already applied")
+            os.remove(path)
+            return 0
+
+        changes = {
+            joke_id: Joke.add_ratings(joke_id, total, count)
+            for joke_id, (total, count) in totals.items()
+        }
+        missing = {joke_id for joke_id, change in changes.items() if change is None}
+        ratings_changed(change for change in changes.values() if change is not None)
+        rows = [row for row in rows if row['joke_id'] not in missing]
+        if rows:
+            db.session.execute(insert(JokeRating).values(rows))
+        db.session.commit()
+        os.remove(path)
+        return len(rows)
+
+    def flush(self):
+        """
+        Apply this process's queued clicks and any batches left by dead processes.
+
+        Returns:
+            int: Number of ratings applied.
+        """
+        applied = 0
+        with self._flush_lock, self.app.app_context():
+            self._rotate()
+            for name in sorted(os.listdir(self.directory)):
+                if not name.startswith(self.prefix):
+                    continue
+                claimed = self._claim(name)
+                if claimed is None:
+                    continue
+                try:
+                    applied += self._apply(*claimed)
+                except Exception as e:
+                    # The claimed file stays put and is retried on the next flush
+                    db.session.rollback()
+                    logger.error(f"Failed to apply rating batch {claimed[1]}: {str(e)}")
+            if applied:
+                logger.info(f"Applied {applied} queued ratings")
+            self._prune()
+        return applied
+
+    def _prune(self):
+        if time.monotonic() - self._pruned_at < 3600:
+            return
+        self._pruned_at = time.monotonic()
+        RatingBatch.query.filter(
+            RatingBatch.applied_at < datetime.utcnow() - BATCH_RETENTION
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Rating flusher failed: {str(e)}")
+
+    def start(self):
+        """Start the background flusher and flush once more at interpreter exit."""
+        self._thread = threading.Thread(target=self._run, name='rating-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flusher after a final flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Final rating flush failed, the spool file is kept: {str(e)}")
+
+
+def get_rating_spool(app=None):
+    """
+    Return this process's rating spool, starting its flusher on first use.
+
+    The spool is created lazily in each worker, since threads started in a
+    preloading parent do not survive the fork.
+    """
+    app = app or current_app._get_current_object()
+    with _spool_lock:
+        spool = app.extensions.get('rating_spool')
+        if spool is None or spool.pid != os.getpid():
+            spool = RatingSpool(
+                app,
+                app.config['RATING_SPOOL_DIR'],
+                app.config.get('RATING_FLUSH_INTERVAL', 500) / 1000,
+            )
+            spool.start()
+            app.extensions['rating_spool'] = spool
+        return spool
@@ -1,12 +1,20 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, Response, abort, render_template, request, flash, redirect, url_for, jsonify, make_response, current_app, stream_with_context
 from flask_login import login_required, login_user, logout_user
-from models import db, Admin, Subscriber, Joke, Category
-from email_service import send_welcome_email
-from sqlalchemy import func, case, extract
+from app import RATE_RULE, UNSUBSCRIBE_RULE
+from models import db, Admin, Subscriber, Joke, Category, JokeRating, ImportJob, is_valid_timezone
+from outbox import enqueue_welcome
+from category_cache import category_cache, categories_changed
+from page_cache import page_cache
+from rating_queue import get_rating_spool
+from analytics import load_analytics, subscriber_changed, ratings_changed
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime, timedelta
-from utils.ai_utils import generate_bulk_jokes
-from openai import OpenAIError, RateLimitError, APIError, APIConnectionError
+from werkzeug.exceptions import RequestEntityTooLarge
+from datetime import datetime
+from inventory import enqueue_generation
+from dedup import insert_jokes
+from bulk import EXPORTS, FORMATS, IMPORTS, format_for, export_lines, spool_import, start_import
+import metrics
 import logging
 
 
@@ -16,18 +24,23 @@ logger = logging.getLogger(__name__)
 
 main_bp = Blueprint('main', __name__)
 
+# Page sizes for the admin dashboard's JSON list endpoints
+ADMIN_PAGE_SIZE = 25
+ADMIN_PAGE_SIZE_MAX = 100
+
 
 
 @main_bp.route('/')
 def index():
-    categories = Category.query.filter_by(is_active=True).all()
-    return render_template('index.html', categories=categories)
+    categories = category_cache.active()
+    return page_cache.render('index', 'index.html', conditional=True, categories=categories)
 
 @main_bp.route('/subscribe', methods=['POST'])
 def subscribe():
     email = request.form.get('email')
     categories = request.form.getlist('categories')
     delivery_time = request.form.get('delivery_time')
+    timezone = request.form.get('timezone') or 'UTC'
     
     if not email:
         flash('Email is required!', 'error')
@@ -38,6 +51,9 @@ def subscribe():
     except ValueError:
         flash('Invalid delivery time format!', 'error')
         return redirect(url_for('main.index'))
+
+    if not is_valid_timezone(timezone):
+        timezone = 'UTC'
     
     try:
         existing = Subscriber.query.filter_by(email=email).first()
@@ -45,9 +61,12 @@ def subscribe():
             if existing.is_active:
                 flash('You are already subscribed!', 'info')
             else:
+                before = (existing.is_active, (existing.preferences or {}).get('categories', []))
                 existing.is_active = True
                 existing.preferences = {'categories': categories}
+                subscriber_changed(before, (True, categories))
                 existing.delivery_time = delivery_time
+                existing.timezone = timezone
                 db.session.commit()
                 flash('Welcome back! Your subscription has been reactivated.', 'success')
             return redirect(url_for('main.index'))
@@ -55,12 +74,15 @@ def subscribe():
         subscriber = Subscriber(
             email=email,
             preferences={'categories': categories or ['general']},
-            delivery_time=delivery_time
+            delivery_time=delivery_time,
+            timezone=timezone
         )
         db.session.add(subscriber)
+        subscriber_changed(None, (True, subscriber.preferences['categories']))
+        # Sent by the scheduler's outbox job; the signup only waits for this commit
+        enqueue_welcome(email)
         db.session.commit()
         
-        send_welcome_email(email)
         flash('Successfully subscribed!', 'success')
         
     except IntegrityError:
@@ -72,37 +94,47 @@ def subscribe():
     
     return redirect(url_for('main.index'))
 
-@main_bp.route('/rate/<int:joke_id>/<int:rating>')
+@main_bp.route(RATE_RULE)
 def rate_joke(joke_id, rating):
     if not 1 <= rating <= 5:
         flash('Invalid rating value!', 'error')
-        return render_template('rate.html', success=False)
+        return page_cache.render('rate', 'rate.html', variant=False, success=False)
     
+    if current_app.config.get('RATING_INGEST_MODE') == 'queue':
+        # A primary key read, so only real jokes are acknowledged
+        if db.session.query(Joke.id).filter_by(id=joke_id).first() is None:
+            return page_cache.render('rate', 'rate.html', variant=False, success=False)
+        # Acknowledge at once; the rating reaches the database with the next flush
+        get_rating_spool().append(joke_id, rating)
+        return page_cache.render('rate', 'rate.html', variant=True, success=True)
+
     try:
-        joke = Joke.query.get_or_404(joke_id)
-        if joke.times_sent == 0:
-            joke.rating = float(rating)
-        else:
-            joke.rating = (joke.rating * joke.times_sent + rating) / (joke.times_sent + 1)
-        joke.times_sent += 1
+        change = Joke.add_ratings(joke_id, rating)
+        if change is None:
+            db.session.rollback()
+            return page_cache.render('rate', 'rate.html', variant=False, success=False)
+        db.session.add(JokeRating(joke_id=joke_id, rating=rating))
+        ratings_changed([change])
         db.session.commit()
-        return render_template('rate.html', success=True)
+        return page_cache.render('rate', 'rate.html', variant=True, success=True)
     except Exception:
         db.session.rollback()
-        return render_template('rate.html', success=False)
+        return page_cache.render('rate', 'rate.html', variant=False, success=False)
 
-@main_bp.route('/unsubscribe/<email>')
+@main_bp.route(UNSUBSCRIBE_RULE)
 def unsubscribe(email):
     try:
         subscriber = Subscriber.query.filter_by(email=email).first()
         if subscriber:
+            categories = (subscriber.preferences or {}).get('categories', [])
+            subscriber_changed((subscriber.is_active, categories), (False, categories))
             subscriber.is_active = False
             db.session.commit()
             flash('Successfully unsubscribed!', 'success')
     except Exception:
         db.session.rollback()
         flash('An error occurred while unsubscribing.', 'error')
-    return render_template('unsubscribe.html')
+    return page_cache.render('unsubscribe', 'unsubscribe.html')
 
 @main_bp.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
@@ -121,69 +153,140 @@ def admin_login():
 @main_bp.route('/admin/dashboard')
 @login_required
 def admin_dashboard():
-    jokes = Joke.query.order_by(Joke.created_at.desc()).all()
-    subscribers = Subscriber.query.filter_by(is_active=True).all()
+    # Joke and subscriber lists are loaded page by page from the JSON endpoints below
+    joke_count = db.session.query(func.count(Joke.id)).scalar()
+    subscriber_count = db.session.query(func.count(Subscriber.id)).filter(
+        Subscriber.is_active == True
+    ).scalar()
     categories = Category.query.all()
-    return render_template('admin.html', section='dashboard', 
-                         jokes=jokes, subscribers=subscribers, 
+    return render_template('admin.html', section='dashboard',
+                         joke_count=joke_count, subscriber_count=subscriber_count,
                          categories=categories)
 
+def _page_args():
+    """Read the keyset cursor, page size and search text shared by the admin list endpoints."""
+    limit = max(1, min(request.args.get('limit', ADMIN_PAGE_SIZE, type=int), ADMIN_PAGE_SIZE_MAX))
+    after = request.args.get('after', type=int)
+    if 'after' in request.args and not (after and after > 0):
+        # Falling back to the first page would send a client round in circles
+        abort(make_response(jsonify({'status': 'error', 'message': 'Invalid cursor'}), 400))
+    search = (request.args.get('q') or '').strip()
+    return limit, after, search
+
+def _like_pattern(text, prefix_only=False):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'{escaped}%' if prefix_only else f'%{escaped}%'
+
+def _keyset_page(rows, limit, serialize):
+    """Turn up to limit + 1 rows ordered by id descending into a page and the next cursor."""
+    items = [serialize(row) for row in rows[:limit]]
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@main_bp.route('/admin/api/jokes')
+@login_required
+def admin_jokes_page():
+    limit, after, search = _page_args()
+    query = db.session.query(
+        Joke.id, Joke.content, Joke.rating, Joke.rating_count, Joke.created_at,
+        Category.name.label('category')
+    ).join(Category, Joke.category_id == Category.id)
+
+    category_id = request.args.get('category_id', type=int)
+    if category_id:
+        query = query.filter(Joke.category_id == category_id)
+    if search:
+        query = query.filter(Joke.content.ilike(_like_pattern(search), escape='\\'))
+    if after:
+        query = query.filter(Joke.id < after)
+
+    rows = query.order_by(Joke.id.desc()).limit(limit + 1).all()
+    return _keyset_page(rows, limit, lambda row: {
+        'id': row.id,
+        'content': row.content,
+        'category': row.category,
+        'rating': row.rating or 0.0,
+        'rating_count': row.rating_count or 0,
+        'created_at': row.created_at.isoformat() if row.created_at else '',
+    })
+
+@main_bp.route('/admin/api/subscribers')
+@login_required
+def admin_subscribers_page():
+    limit, after, search = _page_args()
+    query = db.session.query(
+        Subscriber.id, Subscriber.email, Subscriber.subscribed_at,
+        Subscriber.delivery_time, Subscriber.timezone, Subscriber.preferences
+    ).filter(Subscriber.is_active == True)
+
+    category = request.args.get('category')
+    if category:
+        query = query.filter(Subscriber.wants_category(category))
+    if search:
+        query = query.filter(Subscriber.email.ilike(_like_pattern(search, prefix_only=True), escape='\\'))
+    if after:
+        query = query.filter(Subscriber.id < after)
+
+    rows = query.order_by(Subscriber.id.desc()).limit(limit + 1).all()
+    return _keyset_page(rows, limit, lambda row: {
+        'id': row.id,
+        'email': row.email,
+        'subscribed_at': row.subscribed_at.isoformat() if row.subscribed_at else '',
+        'delivery_time': row.delivery_time.strftime('%H:%M') if row.delivery_time else '',
+        'timezone': row.timezone or 'UTC',
+        'categories': (row.preferences or {}).get('categories', []),
+    })
+
+@main_bp.route('/admin/export/<kind>.<fmt>')
+@login_required
+def admin_export(kind, fmt):
+    if kind not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+    # Streamed straight from a database cursor; the app context stays up until the last piece
+    return Response(
+        stream_with_context(export_lines(kind, fmt)),
+        content_type='text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="{kind}-{datetime.utcnow():%Y%m%d}.{fmt}"'}
+    )
+
+@main_bp.route('/admin/import/<kind>', methods=['POST'])
+@login_required
+def admin_import(kind):
+    try:
+        upload = request.files.get('file')
+    except RequestEntityTooLarge:
+        limit = current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+        return jsonify({'status': 'error', 'message': f'Import files are limited to {limit} MB'}), 413
+    if kind not in IMPORTS or not upload:
+        return jsonify({'status': 'error', 'message': 'Choose subscribers or jokes and a file'}), 400
+    fmt = request.form.get('format') or format_for(upload.filename)
+    if fmt not in FORMATS:
+        return jsonify({'status': 'error', 'message': f'Unknown format {fmt}'}), 400
+    # Saved to disk and run by a background thread, so a big file cannot outlast the request timeout
+    try:
+        job = spool_import(upload, kind, fmt)
+        start_import(job.id)
+    except Exception as e:
+        logger.error(f"Queueing bulk import of {kind} failed: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Could not queue the import'}), 500
+    return jsonify({
+        'status': 'queued', 'job': job.as_dict(),
+        'progress_url': url_for('main.admin_import_job', job_id=job.id),
+    }), 202
+
+@main_bp.route('/admin/import/jobs/<int:job_id>')
+@login_required
+def admin_import_job(job_id):
+    job = db.session.get(ImportJob, job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.as_dict())
+
 @main_bp.route('/admin/analytics')
 @login_required
 def admin_analytics():
-    # Get basic stats
-    total_subscribers = Subscriber.query.count()
-    active_subscribers = Subscriber.query.filter_by(is_active=True).count()
-    average_rating = db.session.query(func.avg(Joke.rating)).scalar() or 0
-
-    # Get subscriber growth data (last 30 days)
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    growth_query = db.session.query(
-        func.date(Subscriber.subscribed_at).label('date'),
-        func.count().label('count')
-    ).filter(
-        Subscriber.subscribed_at >= thirty_days_ago
-    ).group_by(
-        func.date(Subscriber.subscribed_at)
-    ).order_by(
-        func.date(Subscriber.subscribed_at)
-    ).all()
-
-    dates = [(thirty_days_ago + timedelta(days=x)).strftime('%Y-%m-%d') 
-             for x in range(31)]
-    growth_data = [0] * 31
-    for date, count in growth_query:
-        day_index = (date - thirty_days_ago.date()).days
-        growth_data[day_index] = count
-
-    # Get category preferences
-    category_preferences = {}
-    subscribers = Subscriber.query.filter_by(is_active=True).all()
-    for subscriber in subscribers:
-        for category in subscriber.preferences.get('categories', []):
-            category_preferences[category] = category_preferences.get(category, 0) + 1
-
-    category_names = list(category_preferences.keys())
-    category_counts = [category_preferences[name] for name in category_names]
-
-    # Get ratings distribution
-    ratings_distribution = []
-    for rating in range(1, 6):
-        count = Joke.query.filter(
-            Joke.rating >= rating - 0.5,
-            Joke.rating < rating + 0.5
-        ).count()
-        ratings_distribution.append(count)
-
-    return render_template('analytics.html',
-                         total_subscribers=total_subscribers,
-                         active_subscribers=active_subscribers,
-                         average_rating=average_rating,
-                         dates=dates,
-                         growth_data=growth_data,
-                         category_names=category_names,
-                         category_counts=category_counts,
-                         ratings_distribution=ratings_distribution)
+    # Served from the daily rollup; see analytics.load_analytics
+    return render_template('analytics.html', **load_analytics())
 
 @main_bp.route('/admin/jokes', methods=['POST'])
 @login_required
@@ -193,10 +296,12 @@ def admin_jokes():
         category_id = request.form.get('category_id')
         
         if content and category_id:
-            joke = Joke(content=content, category_id=category_id)
-            db.session.add(joke)
+            ids, duplicates = insert_jokes(int(category_id), [content])
             db.session.commit()
-            flash('Joke added successfully!', 'success')
+            if ids:
+                flash('Joke added successfully!', 'success')
+            else:
+                flash(f'This joke is too similar to joke #{duplicates[0]}, it was not added.', 'error')
     except Exception:
         db.session.rollback()
         flash('An error occurred while adding the joke.', 'error')
@@ -207,7 +312,10 @@ def admin_jokes():
 @login_required
 def generate_ai_joke():
     """
-    Generate a joke using OpenAI API and save it to the database
+    Queue an AI joke generation job for a category.
+
+    The OpenAI call runs in the scheduler process (see inventory.run_generation_jobs),
+    so the request returns as soon as the job is recorded.
     """
     try:
         category_id = request.form.get('category_id')
@@ -216,57 +324,22 @@ def generate_ai_joke():
             return redirect(url_for('main.admin_dashboard'))
 
         category = Category.query.get_or_404(category_id)
-        logger.info(f"Attempting to generate joke for category: {category.name}")
-        
-        # Generate joke using OpenAI
-        generated_content = generate_bulk_jokes(category.name, category.description)
-        
-        if generated_content:
-            # Save the generated joke
-            for content in generated_content:
-                joke = Joke(
-                    content=content,
-                    category_id=category_id
-                )
-                db.session.add(joke)
-                db.session.commit()
-            
-            logger.info(f"Successfully generated and saved joke for category: {category.name}")
-            flash('AI joke generated and added successfully!', 'success')
-        else:
-            logger.error("Failed to generate joke content")
-            flash('Failed to generate joke. The AI service might be temporarily unavailable.', 'error')
-            
-    except RateLimitError:
-        logger.error("OpenAI rate limit exceeded")
-        flash('Rate limit exceeded. Please try again in a few minutes.', 'error')
-        db.session.rollback()
-    
-    except APIConnectionError:
-        logger.error("Failed to connect to OpenAI API")
-        flash('Unable to connect to the AI service. Please check your internet connection.', 'error')
-        db.session.rollback()
-    
-    except APIError:
-        logger.error("OpenAI API error occurred")
-        flash('An error occurred with the AI service. Please try again later.', 'error')
-        db.session.rollback()
-    
-    except OpenAIError as e:
-        logger.error(f"OpenAI error: {str(e)}")
-        flash('An error occurred while generating the joke. Please try again.', 'error')
-        db.session.rollback()
-    
+        enqueue_generation(category.id)
+        db.session.commit()
+
+        logger.info(f"Queued joke generation for category: {category.name}")
+        flash('AI joke generation queued. New jokes will appear shortly.', 'success')
+
     except IntegrityError:
         logger.error("Database integrity error")
-        flash('Failed to save the generated joke due to a database error.', 'error')
+        flash('Failed to queue joke generation due to a database error.', 'error')
         db.session.rollback()
-    
+
     except Exception as e:
         logger.error(f"Unexpected error in generate_ai_joke: {str(e)}")
         flash('An unexpected error occurred. Please try again later.', 'error')
         db.session.rollback()
-    
+
     return redirect(url_for('main.admin_dashboard'))
 
 @main_bp.route('/admin/categories', methods=['GET', 'POST'])
@@ -280,6 +353,7 @@ def admin_categories():
             if name:
                 category = Category(name=name, description=description)
                 db.session.add(category)
+                categories_changed()
                 db.session.commit()
                 flash('Category added successfully!', 'success')
         except IntegrityError:
@@ -297,12 +371,28 @@ def toggle_category(id):
     try:
         category = Category.query.get_or_404(id)
         category.is_active = not category.is_active
+        categories_changed()
         db.session.commit()
         return jsonify({'status': 'success', 'is_active': category.is_active})
     except Exception:
         db.session.rollback()
         return jsonify({'status': 'error'}), 500
 
+@main_bp.route('/admin/cache/stats')
+@login_required
+def cache_stats():
+    return jsonify({'categories': category_cache.stats(), 'pages': page_cache.stats()})
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    # Scraped by Prometheus rather than viewed by an admin, so guarded by a token instead of a login
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    if not metrics.authorized(request.headers.get('Authorization'), token):
+        abort(401)
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
 
 # @main_bp.route('/test', methods=['GET'])
 # def trigger_task():
@@ -1,62 +1,36 @@
-from app import db
-from models import Subscriber, Joke, Category, JokeHistory
+import time
+
+# Taken before any other import so the logged import time covers them all
+_started = time.perf_counter()
+
+import logging
+import signal
+import threading
+from datetime import datetime
 from flask_apscheduler import APScheduler
-from email_service import send_daily_joke
-from datetime import datetime, timedelta
-from sqlalchemy import or_, extract
-from app import create_app
-
-# Create the Flask app instance
-app = create_app()
-# Create and configure the scheduler
+from app import create_worker_app
+from metrics import TickSpans, serve as serve_metrics
+
+logger = logging.getLogger(__name__)
+
+# Create the scheduler; the app is attached in main(). Job modules are
+# imported inside the jobs, so startup only pays for Flask and SQLAlchemy.
 scheduler = APScheduler()
 
 
 def send_jokes_for_time(current_hour, current_minute):
     """Send jokes to subscribers who want delivery at the specified hour"""
-    with scheduler.app.app_context():
-        # Get subscribers who want delivery at this time
-        subscribers = Subscriber.query.filter(
-            Subscriber.is_active == True,
-            extract('hour', Subscriber.delivery_time) == current_hour,
-            extract('minute', Subscriber.delivery_time) == current_minute
-        ).all()
-
-        for subscriber in subscribers:
-            categories = subscriber.preferences.get('categories', [])
-            if not categories:
-                continue
-
-            # Collect jokes for each category
-            jokes_to_send = []
-            for category_name in categories:
-                category = Category.query.filter_by(name=category_name, is_active=True).first()
-                if not category:
-                    continue
-
-                # Get a joke for the category that hasn't been sent recently
-                joke = Joke.query.filter(
-                    Joke.category_id == category.id,
-                    or_(
-                        Joke.last_sent == None,
-                        Joke.last_sent <= datetime.utcnow() - timedelta(days=7)
-                    )
-                ).order_by(Joke.last_sent.nulls_first()).first()
-
-                if joke:
-                    jokes_to_send.append(joke)
-
-            if jokes_to_send:
-                # Send jokes to the subscriber
-                send_daily_joke(subscriber, jokes_to_send)
-
-                # Log each joke sent and update `last_sent`
-                for joke in jokes_to_send:
-                    joke.last_sent = datetime.utcnow()
-                    log = JokeHistory(joke_id=joke.id, user=subscriber.id, sent_at=datetime.utcnow())
-                    db.session.add(log)
-
-                db.session.commit()
+    from delivery import enqueue_deliveries, dispatch_deliveries
+
+    app = scheduler.app
+    deadline = time.monotonic() + app.config.get('SCHEDULER_TICK_DEADLINE', 50)
+    spans = TickSpans()
+
+    with app.app_context(), spans.phase('enqueue'):
+        # Record who is due at this time; rows left pending by an earlier tick are drained too
+        enqueue_deliveries(current_hour * 60 + current_minute, datetime.utcnow().date())
+
+    dispatch_deliveries(app, deadline, spans)
 
 
 # Run every minute to check for subscribers who want delivery at that time
@@ -68,12 +42,94 @@ def send_minutely_jokes():
     return "success"
 
 
-if __name__ == "__main__":
+# Send welcome emails queued by signups
+@scheduler.task('interval', id='send_outbox', seconds=10)
+def send_outbox():
+    from outbox import drain_outbox
+
+    with scheduler.app.app_context():
+        drain_outbox()
+    return "success"
+
+
+# Keep the analytics rollup warm so the admin page never aggregates inline
+@scheduler.task('interval', id='refresh_analytics', minutes=10)
+def refresh_analytics():
+    from analytics import refresh_rollup
+
+    with scheduler.app.app_context():
+        refresh_rollup()
+    return "success"
+
+
+# Top up categories running low on sendable jokes, off the web request path
+@scheduler.task('interval', id='refill_jokes', minutes=5)
+def refill_jokes():
+    from inventory import refill_inventory
+
+    with scheduler.app.app_context():
+        refill_inventory()
+    return "success"
+
+
+# Follow DST changes and spread overloaded minutes before they come up
+@scheduler.task('interval', id='update_delivery_slots', minutes=15)
+def update_slots():
+    from delivery_slots import update_delivery_slots
+
+    with scheduler.app.app_context():
+        update_delivery_slots()
+    return "success"
+
+
+def main():
+    """
+    Run the scheduler until SIGTERM or SIGINT.
+
+    On a signal, running ticks stop claiming, hand back deliveries they have
+    not started and finish the email in flight; then the scheduler and the
+    SMTP pool are shut down.
+    """
+    logging.basicConfig(level=logging.INFO)
+    imported = time.perf_counter() - _started
+
+    app = create_worker_app()
     scheduler.init_app(app)
-    with app.app_context():
-        print("Starting scheduler...")
-        scheduler.start()
-        # Keep the process alive
-        import time
-        while True:
-            time.sleep(1)
+    metrics_port = app.config.get('SCHEDULER_METRICS_PORT')
+    metrics_token = app.config.get('METRICS_TOKEN')
+    metrics_server = None
+    if metrics_port and metrics_token:
+        metrics_server = serve_metrics(metrics_port, metrics_token)
+    elif metrics_port:
+        logger.warning("METRICS_TOKEN is not set, not serving scheduler metrics")
+
+    stopping = threading.Event()
+
+    def request_stop(signum, frame):
+        from delivery import shutdown_requested
+
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+        shutdown_requested.set()
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    scheduler.start()
+    booted = time.perf_counter() - _started
+    logger.info(f"Scheduler started in {booted:.3f}s (imports {imported:.3f}s, "
+                f"app and scheduler {booted - imported:.3f}s)")
+
+    stopping.wait()
+    stopped = time.perf_counter()
+    scheduler.shutdown(wait=True)
+    pool = app.extensions.get('mail_pool')
+    if pool is not None:
+        pool.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    logger.info(f"Scheduler stopped in {time.perf_counter() - stopped:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import logging
+from sqlalchemy import inspect, cast, extract, func, select, Integer
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+def _added_columns():
+    """Columns added to existing tables after their first release."""
+    from models import Subscriber, Joke, CacheVersion, AnalyticsRollup, OutboxMessage
+    return [
+        Subscriber.__table__.c.delivery_slot,
+        Subscriber.__table__.c.timezone,
+        Subscriber.__table__.c.send_slot,
+        Joke.__table__.c.rating_sum,
+        Joke.__table__.c.rating_count,
+        Joke.__table__.c.content_hash,
+        CacheVersion.__table__.c.updated_at,
+        AnalyticsRollup.__table__.c.joke_count,
+        AnalyticsRollup.__table__.c.rating_total,
+        OutboxMessage.__table__.c.retry_at,
+    ]
+
+
+def _backfills():
+    """UPDATE statements filling added columns on rows that predate them."""
+    from models import Subscriber, Joke, JokeHistory
+    sends = select(func.count(JokeHistory.id)).where(
+        JokeHistory.joke_id == Joke.id
+    ).scalar_subquery()
+    return [
+        db.update(Subscriber).where(
+            Subscriber.delivery_slot == None,
+            Subscriber.delivery_time != None
+        ).values(
+            delivery_slot=cast(
+                extract('hour', Subscriber.delivery_time) * 60
+                + extract('minute', Subscriber.delivery_time),
+                Integer
+            )
+        ),
+        # Subscribers from before timezones were UTC, and were sent at their own slot
+        db.update(Subscriber).where(
+            Subscriber.timezone == None
+        ).values(timezone='UTC'),
+        db.update(Subscriber).where(
+            Subscriber.send_slot == None
+        ).values(send_slot=Subscriber.delivery_slot),
+        # times_sent used to count ratings; move that into rating_count and
+        # make times_sent the number of deliveries recorded in history
+        db.update(Joke).where(
+            Joke.rating_count == None
+        ).values(
+            rating_count=func.coalesce(Joke.times_sent, 0),
+            rating_sum=cast(
+                func.round(func.coalesce(Joke.rating, 0) * func.coalesce(Joke.times_sent, 0)),
+                Integer
+            ),
+            times_sent=sends,
+        ),
+    ]
+
+
+def upgrade_schema():
+    """
+    Bring a database created by an older release up to date.
+
+    ``db.create_all()`` only creates missing tables, so this adds missing
+    columns and indexes to existing ones and backfills derived columns.
+    Every step is idempotent and cheap once applied.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for column in _added_columns():
+            table = column.table
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            logger.info(f"Adding column {table.name}.{column.name}")
+            conn.execute(db.text(
+                f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            ))
+
+        for statement in _backfills():
+            result = conn.execute(statement)
+            if result.rowcount:
+                logger.info(f"Backfilled {result.rowcount} rows in {statement.table.name}")
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    # Jokes from before the duplicate index, or from before its last change,
+    # need their fingerprints computed in Python
+    from dedup import backfill_index, reindex_stale
+    backfill_index()
+    reindex_stale()
@@ -0,0 +1,89 @@
+import zlib
+from datetime import datetime
+from app import db
+from models import JokeHistory, SeenJokes
+from utils.db_utils import dialect_insert
+
+
+class JokeBitmap:
+    """
+    Set of joke ids stored as a bitmap, bit ``n`` standing for joke ``n``.
+
+    Stored zlib-compressed: a subscriber who has seen a few hundred of ten
+    thousand jokes takes a few hundred bytes, and a membership test is one
+    byte lookup.
+    """
+
+    def __init__(self, bits=b''):
+        self.bits = bytearray(bits)
+
+    @classmethod
+    def decode(cls, blob):
+        return cls(zlib.decompress(blob))
+
+    def encode(self):
+        return zlib.compress(bytes(self.bits))
+
+    def __contains__(self, joke_id):
+        index = joke_id >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (joke_id & 7)))
+
+    def add(self, joke_id):
+        index = joke_id >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytes(index + 1 - len(self.bits)))
+        self.bits[index] |= 1 << (joke_id & 7)
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self.bits if byte)
+
+
+def load_seen(subscriber_ids):
+    """
+    Load the seen-joke bitmaps of many subscribers.
+
+    Subscribers without a stored bitmap get one built from JokeHistory, so
+    existing history is honoured before the first save. At most two queries
+    however many subscribers there are.
+
+    Returns:
+        dict: Mapping of subscriber id to JokeBitmap.
+    """
+    subscriber_ids = set(subscriber_ids)
+    if not subscriber_ids:
+        return {}
+    seen = {
+        subscriber_id: JokeBitmap.decode(bitmap)
+        for subscriber_id, bitmap in db.session.query(SeenJokes.subscriber_id, SeenJokes.bitmap).filter(
+            SeenJokes.subscriber_id.in_(subscriber_ids)
+        )
+    }
+    missing = subscriber_ids - set(seen)
+    if missing:
+        for subscriber_id in missing:
+            seen[subscriber_id] = JokeBitmap()
+        for subscriber_id, joke_id in db.session.query(JokeHistory.user, JokeHistory.joke_id).filter(
+            JokeHistory.user.in_(missing)
+        ).distinct():
+            seen[subscriber_id].add(joke_id)
+    return seen
+
+
+def save_seen(seen):
+    """
+    Write seen-joke bitmaps back with one upsert; the caller commits.
+
+    Args:
+        seen: Mapping of subscriber id to JokeBitmap.
+    """
+    if not seen:
+        return
+    now = datetime.utcnow()
+    statement = dialect_insert(SeenJokes).values([
+        {'subscriber_id': subscriber_id, 'bitmap': bitmap.encode(), 'updated_at': now}
+        for subscriber_id, bitmap in seen.items()
+    ])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['subscriber_id'],
+        set_={'bitmap': statement.excluded.bitmap, 'updated_at': statement.excluded.updated_at}
+    ))
@@ -2,6 +2,13 @@ document.addEventListener('DOMContentLoaded', function() {
     // Form validation
     const subscribeForm = document.getElementById('subscribeForm');
     if (subscribeForm) {
+        // Delivery times are local to the browser's timezone
+        const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+        if (timezone) {
+            document.getElementById('timezone').value = timezone;
+            document.getElementById('timezoneLabel').textContent = timezone;
+        }
+
         subscribeForm.addEventListener('submit', function(e) {
             const email = document.getElementById('email').value;
             if (!email || !email.includes('@')) {
@@ -28,4 +35,77 @@ document.addEventListener('DOMContentLoaded', function() {
             charCounter.textContent = `${this.value.length}/500`;
         });
     }
+
+    // Admin dashboard: keyset-paginated joke and subscriber lists
+    function pagedList(listId, buttonId, filterId, searchId, filterParam, renderItem) {
+        const list = document.getElementById(listId);
+        const button = document.getElementById(buttonId);
+        const filter = document.getElementById(filterId);
+        const search = document.getElementById(searchId);
+        if (!list || !button) return;
+
+        let cursor = null;
+        let request = 0;
+
+        function load(reset) {
+            if (reset) {
+                cursor = null;
+                list.replaceChildren();
+            }
+            const params = new URLSearchParams();
+            if (filter.value) params.set(filterParam, filter.value);
+            if (search.value) params.set('q', search.value);
+            if (cursor !== null) params.set('after', cursor);
+            const current = ++request;
+            button.disabled = true;
+            fetch(`${list.dataset.url}?${params}`)
+                .then(response => response.json())
+                .then(page => {
+                    if (current !== request) return;
+                    page.items.forEach(item => list.appendChild(renderItem(item)));
+                    cursor = page.next_cursor;
+                    button.disabled = cursor === null;
+                    button.textContent = cursor === null ? 'No more results' : 'Load more';
+                });
+        }
+
+        let debounce;
+        search.addEventListener('input', () => {
+            clearTimeout(debounce);
+            debounce = setTimeout(() => load(true), 300);
+        });
+        filter.addEventListener('change', () => load(true));
+        button.addEventListener('click', () => load(false));
+        load(true);
+    }
+
+    function listItem(title, badge, body, footer) {
+        const item = document.createElement('div');
+        item.className = 'list-group-item';
+        const header = document.createElement('div');
+        header.className = 'd-flex justify-content-between align-items-center';
+        const heading = document.createElement('h6');
+        heading.className = 'mb-1';
+        heading.textContent = title;
+        const label = document.createElement('span');
+        label.className = 'badge bg-primary';
+        label.textContent = badge;
+        header.append(heading, label);
+        const text = document.createElement('p');
+        text.className = 'mb-1';
+        text.textContent = body;
+        const small = document.createElement('small');
+        small.className = 'text-muted';
+        small.textContent = footer;
+        item.append(header, text, small);
+        return item;
+    }
+
+    pagedList('jokeList', 'jokeLoadMore', 'jokeCategoryFilter', 'jokeSearch', 'category_id', joke =>
+        listItem(joke.category, `${joke.rating.toFixed(1)} ⭐ (${joke.rating_count} ratings)`,
+                 joke.content, `Added: ${joke.created_at.slice(0, 10)}`));
+
+    pagedList('subscriberList', 'subscriberLoadMore', 'subscriberCategoryFilter', 'subscriberSearch', 'category', subscriber =>
+        listItem(subscriber.email, `${subscriber.delivery_time} ${subscriber.timezone}`,
+                 subscriber.categories.join(', '), `Subscribed: ${(subscriber.subscribed_at || '').slice(0, 10)}`));
 });
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The web app on a fresh SQLite database, with mail suppressed, inside an app context."""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('RATING_SPOOL_DIR', str(tmp_path / 'rating-spool'))
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path / 'metrics'))
+    monkeypatch.setenv('BULK_SPOOL_DIR', str(tmp_path / 'bulk-spool'))
+
+    from app import create_app, db, mail
+    from category_cache import category_cache
+    from page_cache import page_cache
+
+    # Process-wide caches outlive the previous test's database
+    category_cache.invalidate()
+    page_cache.invalidate()
+    app = create_app()
+    app.config.update(
+        TESTING=True,
+        SERVER_NAME='example.com',
+        PREFERRED_URL_SCHEME='http',
+        MAIL_SUPPRESS_SEND=True,
+        MAIL_DEFAULT_SENDER='jokes@example.com',
+    )
+    # Flask-Mail reads MAIL_SUPPRESS_SEND when it is initialised
+    mail.init_app(app)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+    category_cache.invalidate()
+    page_cache.invalidate()
+
+
+@pytest.fixture
+def count_queries(app):
+    """
+    Record the SQL statements, and their parameters, run inside a block.
+
+    Usage:
+        with count_queries() as queries:
+            ...
+        assert queries.count == 3
+    """
+    from app import db
+
+    class Queries:
+        def __init__(self):
+            self.statements = []
+            self.parameters = []
+
+        @property
+        def count(self):
+            return len(self.statements)
+
+    @contextmanager
+    def counting():
+        queries = Queries()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            queries.statements.append(statement)
+            queries.parameters.append(parameters)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    return counting
+
+
+@pytest.fixture
+def add_category(app):
+    """Create an active category with ``jokes`` jokes; returns the Category."""
+    from app import db
+    from models import Category, Joke
+
+    def add(name, jokes=0, **fields):
+        category = Category(name=name, description=f'{name} jokes', is_active=True)
+        db.session.add(category)
+        db.session.flush()
+        db.session.add_all(
+            Joke(content=f'{name} joke {index}', category_id=category.id, **fields)
+            for index in range(jokes)
+        )
+        db.session.commit()
+        return category
+
+    return add
+
+
+@pytest.fixture
+def add_subscribers(app):
+    """Create ``count`` active subscribers wanting ``categories``; returns them in id order."""
+    from app import db
+    from models import Subscriber
+
+    def add(count, categories, prefix='user', **fields):
+        subscribers = [
+            Subscriber(email=f'{prefix}{index}@example.com', preferences={'categories': list(categories)}, **fields)
+            for index in range(count)
+        ]
+        db.session.add_all(subscribers)
+        db.session.commit()
+        return subscribers
+
+    return add
@@ -0,0 +1,100 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from openai import AsyncOpenAI
+from tenacity import wait_none
+
+from utils import ai_utils
+from utils.ai_utils import JokeRequest, generate_jokes_batch
+
+
+class ChatCompletionsHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/chat/completions like the OpenAI API, or with a queued status code."""
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        category = body['messages'][1]['content'].split('"')[1]
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Authorization'), body))
+            statuses = server.statuses.get(category)
+            status = statuses.pop(0) if statuses else 200
+
+        if status == 200:
+            content = json.dumps([f'{category} joke {index}' for index in range(2)])
+            payload = {
+                'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                'choices': [{
+                    'index': 0, 'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': content},
+                }],
+            }
+        else:
+            payload = {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': None}}
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def openai_server(monkeypatch):
+    """A local OpenAI-compatible server, with generation pointed at it."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ChatCompletionsHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.statuses = {}
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    monkeypatch.setattr(ai_utils, 'wait_random_exponential', lambda **options: wait_none())
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('OPENAI_BASE_URL', f'http://127.0.0.1:{server.server_port}/v1')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_jokes_are_generated_over_http(openai_server):
+    requests = [JokeRequest(f'category{index}', 'jokes', 2, key=index) for index in range(5)]
+
+    results = generate_jokes_batch(requests, max_concurrency=2, requests_per_minute=6000)
+
+    assert sorted(request.key for request, _ in results) == [0, 1, 2, 3, 4]
+    assert all(jokes == [f'{request.category} joke 0', f'{request.category} joke 1'] for request, jokes in results)
+    path, authorization, body = openai_server.requests[0]
+    assert path == '/v1/chat/completions'
+    assert authorization == 'Bearer sk-test'
+    assert body['model'] == ai_utils.COMPLETION_OPTIONS['model']
+
+
+def test_http_429_is_retried_by_the_batch_only(openai_server):
+    openai_server.statuses['category0'] = [429, 429]
+    openai_server.statuses['category1'] = [429, 429, 429]
+
+    results = dict(generate_jokes_batch(
+        [JokeRequest('category0', 'jokes', 2), JokeRequest('category1', 'jokes', 2)],
+        max_attempts=3, requests_per_minute=6000
+    ))
+
+    assert [jokes for request, jokes in sorted(results.items())] == [['category0 joke 0', 'category0 joke 1'], []]
+    # Retries belong to the batch's backoff; the client does not add its own
+    assert len(openai_server.requests) == 6
+
+
+def test_injected_client_is_used(openai_server):
+    client = AsyncOpenAI(api_key='sk-injected', base_url=f'http://127.0.0.1:{openai_server.server_port}/v1', max_retries=0)
+    ai_utils.set_async_client(client)
+    try:
+        [(request, jokes)] = generate_jokes_batch([JokeRequest('puns', 'jokes', 2)])
+    finally:
+        ai_utils.set_async_client(None)
+
+    assert jokes == ['puns joke 0', 'puns joke 1']
+    assert openai_server.requests[0][1] == 'Bearer sk-injected'
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from openai import AuthenticationError, RateLimitError
+from tenacity import wait_none
+
+from utils import ai_utils
+from utils.ai_utils import JokeRequest, TokenBucket, generate_jokes_batch
+
+
+def _error(cls, message):
+    # Built without the HTTP response the client would attach
+    error = cls.__new__(cls)
+    Exception.__init__(error, message)
+    return error
+
+
+class FakeAsyncClient:
+    """
+    Stands in for AsyncOpenAI: answers chat completions after ``delay`` seconds,
+    raising the queued errors for a category first, and records what it saw.
+    """
+
+    def __init__(self, delay=0.0, errors=None):
+        self.delay = delay
+        self.errors = errors or {}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, **options):
+        category = messages[1]['content'].split('"')[1]
+        self.calls.append((category, time.monotonic()))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.errors.get(category):
+                raise self.errors[category].pop(0)
+        finally:
+            self.in_flight -= 1
+        content = json.dumps([f'{category} joke {index}' for index in range(2)])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """Install a FakeAsyncClient and retry without backoff delays."""
+    monkeypatch.setattr(ai_utils, 'wait_random_exponential', lambda **options: wait_none())
+
+    def install(**options):
+        client = FakeAsyncClient(**options)
+        ai_utils.set_async_client(client)
+        return client
+
+    yield install
+    ai_utils.set_async_client(None)
+
+
+def _requests(count):
+    return [JokeRequest(f'category{index}', 'jokes', 2, key=index) for index in range(count)]
+
+
+def test_rate_limited_requests_are_retried(fake_client):
+    client = fake_client(errors={
+        'category0': [_error(RateLimitError, '429 Too Many Requests')] * 2,
+        'category1': [_error(RateLimitError, '429 Too Many Requests')] * 3,
+    })
+
+    results = dict(
+        (request.key, jokes)
+        for request, jokes in generate_jokes_batch(_requests(2), max_attempts=3, requests_per_minute=6000)
+    )
+
+    assert results[0] == ['category0 joke 0', 'category0 joke 1']
+    # Out of attempts: the request fails on its own without failing the batch
+    assert results[1] == []
+    assert [category for category, _ in client.calls].count('category0') == 3
+    assert [category for category, _ in client.calls].count('category1') == 3
+
+
+def test_other_errors_are_not_retried(fake_client):
+    client = fake_client(errors={'category0': [_error(AuthenticationError, '401 Unauthorized')]})
+
+    [(request, jokes)] = generate_jokes_batch(_requests(1), max_attempts=5, requests_per_minute=6000)
+
+    assert jokes == []
+    assert len(client.calls) == 1
+
+
+def test_concurrency_is_capped(fake_client):
+    client = fake_client(delay=0.02)
+
+    results = generate_jokes_batch(_requests(10), max_concurrency=3, requests_per_minute=60000)
+
+    assert len(results) == 10
+    assert all(jokes for _, jokes in results)
+    assert client.max_in_flight == 3
+
+
+def test_calls_are_paced_by_the_token_bucket(fake_client):
+    client = fake_client()
+
+    # A burst of max_concurrency calls, then one every 1/20 s
+    generate_jokes_batch(_requests(6), max_concurrency=2, requests_per_minute=1200)
+
+    started = [called_at for _, called_at in client.calls]
+    assert len(started) == 6
+    assert started[-1] - started[0] >= 4 / 20 * 0.9
+
+
+def test_token_bucket_allows_a_burst_then_the_average_rate():
+    async def acquire_times(bucket, count):
+        times = []
+        for _ in range(count):
+            await bucket.acquire()
+            times.append(time.monotonic())
+        return times
+
+    times = asyncio.run(acquire_times(TokenBucket(rate=50, capacity=3), 8))
+
+    assert times[2] - times[0] < 0.01
+    assert times[-1] - times[2] >= 5 / 50 * 0.9
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+from analytics import compute_snapshot, load_analytics, refresh_rollup
+from app import db
+from dedup import insert_jokes
+from models import AnalyticsChange, AnalyticsRollup
+
+
+def _totals(row):
+    return {key: getattr(row, key) for key in compute_snapshot()}
+
+
+def _no_recount():
+    raise AssertionError('full aggregates ran')
+
+
+def test_refresh_folds_in_changes_without_recounting(app, add_category, add_subscribers, monkeypatch):
+    app.config['RATING_INGEST_MODE'] = 'direct'
+    puns = add_category('puns', jokes=3)
+    add_subscribers(3, ['puns'])
+    now = datetime.utcnow()
+    refresh_rollup(now)
+
+    client = app.test_client()
+    client.post('/subscribe', data={'email': 'new@example.com', 'categories': ['puns', 'dad'], 'delivery_time': '08:00'})
+    client.get('/unsubscribe/user0@example.com')
+    client.get('/unsubscribe/user1@example.com')
+    client.post('/subscribe', data={'email': 'user1@example.com', 'categories': ['dad'], 'delivery_time': '08:00'})
+    client.get(f'/rate/{puns.jokes[0].id}/5')
+    client.get(f'/rate/{puns.jokes[0].id}/2')
+    client.get(f'/rate/{puns.jokes[1].id}/1')
+    insert_jokes(puns.id, ['An entirely new joke about a very tired skeleton'])
+    db.session.commit()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(analytics, 'compute_snapshot', _no_recount)
+        refresh_rollup(now + timedelta(minutes=10))
+
+    row = db.session.get(AnalyticsRollup, now.date())
+    snapshot = compute_snapshot()
+    assert _totals(row) == dict(snapshot, rating_total=pytest.approx(snapshot['rating_total']))
+    assert row.category_preferences == {'dad': 2, 'puns': 2}
+    assert row.average_rating == pytest.approx((3.5 + 1) / 4)
+    assert AnalyticsChange.query.count() == 0
+
+
+def test_page_only_folds_in_changes_when_the_rollup_is_stale(app, add_category, add_subscribers, monkeypatch):
+    add_category('puns', jokes=2)
+    add_subscribers(2, ['puns'])
+    now = datetime.utcnow()
+    refresh_rollup(now)
+    app.test_client().get('/unsubscribe/user0@example.com')
+
+    monkeypatch.setattr(analytics, 'compute_snapshot', _no_recount)
+    # Fresh enough: served from the rollup as it is
+    assert load_analytics(now + timedelta(minutes=10))['active_subscribers'] == 2
+    # Stale, e.g. the scheduler stopped: queued changes are folded in, even on a new day
+    assert load_analytics(now + timedelta(days=1))['active_subscribers'] == 1
+
+
+def test_changes_queued_after_the_totals_were_read_wait_for_the_next_refresh(app, add_category, add_subscribers, monkeypatch):
+    add_category('puns', jokes=2)
+    add_subscribers(2, ['puns'])
+    now = datetime.utcnow()
+    compute = analytics.compute_snapshot
+
+    def subscribe_meanwhile(session=None):
+        snapshot = compute(session)
+        # Another request commits while the recount is running
+        with db.engine.begin() as connection:
+            connection.execute(AnalyticsChange.__table__.insert().values(
+                subscribers=1, active_subscribers=1, jokes=0, rating_total=0.0, recount=False
+            ))
+        return snapshot
+
+    with monkeypatch.context() as patch:
+        patch.setattr(analytics, 'compute_snapshot', subscribe_meanwhile)
+        refresh_rollup(now)
+
+    assert db.session.get(AnalyticsRollup, now.date()).total_subscribers == 2
+    assert AnalyticsChange.query.count() == 1
+    refresh_rollup(now + timedelta(minutes=10))
+    db.session.expire_all()
+    assert db.session.get(AnalyticsRollup, now.date()).total_subscribers == 3
+    assert AnalyticsChange.query.count() == 0
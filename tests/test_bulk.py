@@ -0,0 +1,57 @@
+import io
+import os
+import time
+
+from app import db
+from bulk import import_subscribers
+from models import ImportJob, Subscriber
+
+SUBSCRIBERS_CSV = (
+    'email,categories,delivery_time,timezone\n'
+    'ana@example.com,puns,09:00,Europe/Lisbon\n'
+    'bo@example.com,puns,09:00,Mars/Olympus_Mons\n'
+    'cy@example.com,puns,09:00,\n'
+)
+
+
+def test_unknown_timezones_reject_the_record(app):
+    summary = import_subscribers(io.StringIO(SUBSCRIBERS_CSV), 'csv')
+
+    assert (summary['read'], summary['imported'], summary['skipped']) == (3, 2, 1)
+    assert summary['errors'] == ["record 2: unknown timezone: 'Mars/Olympus_Mons'"]
+    assert dict(db.session.query(Subscriber.email, Subscriber.timezone)) == {
+        'ana@example.com': 'Europe/Lisbon', 'cy@example.com': 'UTC',
+    }
+
+
+def _upload(client, body, name='subscribers.csv'):
+    return client.post('/admin/import/subscribers', data={'file': (io.BytesIO(body), name)})
+
+
+def test_uploads_are_imported_in_the_background(app):
+    app.config.update(LOGIN_DISABLED=True, BULK_CHUNK_SIZE=1)
+    client = app.test_client()
+
+    response = _upload(client, SUBSCRIBERS_CSV.encode())
+
+    assert response.status_code == 202
+    job = response.get_json()['job']
+    assert job['status'] in (ImportJob.QUEUED, ImportJob.RUNNING, ImportJob.DONE)
+    deadline = time.monotonic() + 10
+    while job['status'] not in (ImportJob.DONE, ImportJob.FAILED) and time.monotonic() < deadline:
+        time.sleep(0.05)
+        job = client.get(f"/admin/import/jobs/{job['id']}").get_json()
+    assert job['status'] == ImportJob.DONE
+    assert (job['read'], job['imported'], job['skipped']) == (3, 2, 1)
+    assert os.listdir(app.config['BULK_SPOOL_DIR']) == []
+
+
+def test_oversized_uploads_are_refused(app):
+    app.config.update(LOGIN_DISABLED=True, MAX_CONTENT_LENGTH=64)
+    client = app.test_client()
+
+    response = _upload(client, SUBSCRIBERS_CSV.encode())
+
+    assert response.status_code == 413
+    assert ImportJob.query.count() == 0
+    assert client.get('/admin/import/jobs/1').status_code == 404
@@ -0,0 +1,36 @@
+from app import db
+from category_cache import category_cache
+from models import CacheVersion, Category
+
+
+def test_a_toggled_category_is_dropped_at_once(app, add_category):
+    app.config['LOGIN_DISABLED'] = True
+    puns = add_category('puns')
+    add_category('limericks')
+    assert [category.name for category in category_cache.active()] == ['puns', 'limericks']
+
+    response = app.test_client().post(f'/admin/categories/{puns.id}')
+
+    assert response.get_json() == {'status': 'success', 'is_active': False}
+    assert [category.name for category in category_cache.active()] == ['limericks']
+    assert category_cache.get('puns').is_active is False
+
+
+def test_changes_made_by_another_process_are_picked_up_by_the_version_check(app, add_category):
+    app.config['CATEGORY_CACHE_CHECK_INTERVAL'] = 3600
+    add_category('puns')
+    assert category_cache.get('limericks') is None
+
+    # Another worker adds a category and bumps the shared version, without
+    # touching this process's cache
+    db.session.add(Category(name='limericks', description='limericks jokes', is_active=True))
+    CacheVersion.bump(category_cache.VERSION_KEY)
+    db.session.commit()
+    reloads = category_cache.reloads
+
+    # Between version checks the cache is served as loaded
+    assert category_cache.get('limericks') is None
+    app.config['CATEGORY_CACHE_CHECK_INTERVAL'] = 0
+    assert category_cache.get('limericks').name == 'limericks'
+    assert category_cache.reloads == reloads + 1
+    assert category_cache.version()[0] == CacheVersion.current(category_cache.VERSION_KEY)
@@ -0,0 +1,45 @@
+from app import db
+from dedup import EMPTY_HASH, INDEX_VERSION_KEY, _int64, fingerprint, insert_jokes, normalize, reindex_stale
+from models import CacheVersion, Joke, JokeFingerprint
+
+
+def test_normalize_keeps_every_script():
+    assert normalize('  Café, CAFÉ!  ') == 'cafe cafe'
+    assert normalize('Почему программисты путают Хэллоуин и Рождество?') == 'почему программисты путают хэллоуин и рождество'
+    assert normalize('Γιατί ο σκελετός δεν πήγε στο πάρτι;') == 'γιατι ο σκελετοσ δεν πηγε στο παρτι'
+    assert normalize('为什么程序员分不清万圣节和圣诞节') == '为什么程序员分不清万圣节和圣诞节'
+    assert normalize('STRASSE') == normalize('straße')
+    assert normalize('🦴💀🎉') == ''
+
+
+def test_jokes_in_other_scripts_are_not_duplicates_of_each_other(app, add_category):
+    puns = add_category('puns')
+    contents = [
+        'Почему программисты путают Хэллоуин и Рождество? Потому что 31 Oct = 25 Dec.',
+        'Γιατί ο σκελετός δεν πήγε στο πάρτι; Δεν είχε κανέναν να πάει μαζί.',
+        '为什么程序员分不清万圣节和圣诞节？因为 Oct 31 等于 Dec 25。',
+        '🦴💀🎉',
+        '🥁🥁🥁',
+    ]
+
+    ids, duplicates = insert_jokes(puns.id, contents)
+    db.session.commit()
+    repeat_ids, repeats = insert_jokes(puns.id, contents)
+
+    assert len(ids) == 5 and duplicates == {}
+    # Real text is still caught; emoji-only jokes have nothing to compare
+    assert sorted(repeats) == [0, 1, 2]
+    assert len(repeat_ids) == 2
+
+
+def test_fingerprints_from_the_old_normalization_are_recomputed_once(app, add_category):
+    puns = add_category('puns')
+    joke = Joke(content='Почему скелет не пошёл на вечеринку?', category_id=puns.id, content_hash=_int64(b''))
+    db.session.add(joke)
+    db.session.query(CacheVersion).filter_by(name=INDEX_VERSION_KEY).delete()
+    db.session.commit()
+
+    assert reindex_stale() == 1
+    assert reindex_stale() == 0
+    assert db.session.get(Joke, joke.id).content_hash == fingerprint(joke.content).content_hash != EMPTY_HASH
+    assert JokeFingerprint.query.filter_by(joke_id=joke.id).count() > 0
@@ -0,0 +1,67 @@
+import smtplib
+import time
+from datetime import date
+
+import delivery
+from app import db
+from delivery import _send_batch, claim_deliveries, enqueue_deliveries
+from email_service import DailyJokeRenderer, PooledConnection
+from joke_selection import JokeSampler
+from metrics import TickSpans
+from models import Delivery, Joke, SeenJokes
+from seen_jokes import load_seen
+
+
+def test_jokes_are_only_marked_sent_for_emails_that_went_out(app, add_category, add_subscribers, monkeypatch):
+    app.config['SCHEDULER_MAX_ATTEMPTS'] = 1
+    add_category('puns', jokes=20)
+    subscribers = add_subscribers(3, ['puns'])
+    failing = subscribers[0].id
+    enqueue_deliveries(9 * 60, date.today())
+
+    batch = claim_deliveries(10)
+
+    # Claiming reserves jokes on the ledger only
+    assert len(batch) == 3
+    assert SeenJokes.query.count() == 0
+    assert Joke.query.filter(Joke.times_sent > 0).count() == 0
+
+    def send(connection, message):
+        if message.recipients == ['user0@example.com']:
+            raise smtplib.SMTPRecipientsRefused({'user0@example.com': (550, b'No such user')})
+    monkeypatch.setattr(PooledConnection, 'send', send)
+
+    sent = _send_batch(app, batch, time.monotonic() + 60, DailyJokeRenderer(), TickSpans())
+
+    db.session.expire_all()
+    assert sent == 2
+    reserved = {subscriber_id: joke_ids for _, subscriber_id, joke_ids in batch}
+    seen = load_seen(reserved)
+    assert Delivery.query.filter_by(subscriber_id=failing).one().status == Delivery.FAILED
+    assert not any(joke_id in seen[failing] for joke_id in reserved[failing])
+    delivered = [
+        joke_id for subscriber_id, joke_ids in reserved.items() if subscriber_id != failing for joke_id in joke_ids
+    ]
+    for subscriber_id, joke_ids in reserved.items():
+        if subscriber_id != failing:
+            assert all(joke_id in seen[subscriber_id] for joke_id in joke_ids)
+    assert db.session.query(db.func.sum(Joke.times_sent)).scalar() == len(delivered)
+    assert {joke.id for joke in Joke.query.filter(Joke.last_sent != None)} == set(delivered)
+
+
+def test_replicas_do_not_reserve_the_same_jokes(app, add_category, add_subscribers, monkeypatch):
+    add_category('puns', jokes=30)
+    add_subscribers(12, ['puns'])
+    enqueue_deliveries(9 * 60, date.today())
+    first, second = JokeSampler(), JokeSampler()
+
+    monkeypatch.setattr(delivery, 'WORKER_ID', 'replica-a')
+    batches = [claim_deliveries(4, sampler=first)]
+    monkeypatch.setattr(delivery, 'WORKER_ID', 'replica-b')
+    batches.append(claim_deliveries(4, sampler=second))
+    monkeypatch.setattr(delivery, 'WORKER_ID', 'replica-a')
+    batches.append(claim_deliveries(4, sampler=first))
+
+    reserved = [joke_id for batch in batches for _, _, joke_ids in batch for joke_id in joke_ids]
+    assert len(reserved) == 12
+    assert len(set(reserved)) == 12
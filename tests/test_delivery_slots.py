@@ -0,0 +1,64 @@
+from datetime import datetime, time
+
+from app import db
+from delivery_slots import rebalance_send_slots, recompute_delivery_slots
+from models import Subscriber
+
+
+def _send_slots():
+    db.session.expire_all()
+    return [subscriber.send_slot for subscriber in Subscriber.query.order_by(Subscriber.id)]
+
+
+def test_moves_that_would_skip_todays_delivery_wait_for_a_later_run(app, add_subscribers):
+    app.config.update(DELIVERY_SLOT_CAPACITY=1, DELIVERY_SPREAD_TOLERANCE=1)
+    # Everyone wants 10:00 UTC; one stays, one moves to 10:01 and one to 09:59
+    add_subscribers(3, ['puns'], delivery_slot=600, send_slot=600)
+
+    # At 09:59 the 10:00 send has not happened yet and 09:59 is going by now
+    assert rebalance_send_slots(datetime(2026, 3, 1, 9, 59)) == 1
+    assert _send_slots() == [600, 601, 600]
+
+    # After 10:00 has been enqueued the move costs nothing
+    assert rebalance_send_slots(datetime(2026, 3, 1, 10, 15)) == 1
+    assert _send_slots() == [600, 601, 599]
+
+
+def test_restoring_a_slot_that_already_went_by_waits_for_a_later_run(app, add_subscribers):
+    app.config.update(DELIVERY_SLOT_CAPACITY=10, DELIVERY_SPREAD_TOLERANCE=1)
+    add_subscribers(1, ['puns'], delivery_slot=600, send_slot=602)
+
+    assert rebalance_send_slots(datetime(2026, 3, 1, 10, 1)) == 0
+    assert _send_slots() == [602]
+    assert rebalance_send_slots(datetime(2026, 3, 1, 10, 3)) == 1
+    assert _send_slots() == [600]
+
+
+def _london_at_half_past_midnight(add_subscribers, slot):
+    add_subscribers(1, ['puns'], timezone='Europe/London', delivery_time=time(0, 30))
+    # Slots as last computed, whatever the offset is as the test runs
+    db.session.execute(db.update(Subscriber).values(delivery_slot=slot, send_slot=slot))
+    db.session.commit()
+
+
+def test_dst_moves_back_across_midnight_wait_for_the_current_slot(app, add_subscribers):
+    # 00:30 GMT; from 29 March 00:30 BST is 23:30 UTC the day before
+    _london_at_half_past_midnight(add_subscribers, 30)
+
+    # At 00:10 UTC today's 00:30 send is still to come and 23:30 has gone by
+    assert recompute_delivery_slots(datetime(2026, 3, 30, 0, 10)) == 1
+    db.session.expire_all()
+    subscriber = Subscriber.query.one()
+    assert (subscriber.delivery_slot, subscriber.send_slot) == (1410, 30)
+
+    assert rebalance_send_slots(datetime(2026, 3, 30, 0, 40)) == 1
+    assert _send_slots() == [1410]
+
+
+def test_dst_moves_forward_across_midnight_apply_at_once(app, add_subscribers):
+    # 00:30 BST is 23:30 UTC; from 25 October 00:30 GMT is 00:30 UTC
+    _london_at_half_past_midnight(add_subscribers, 1410)
+
+    # Moving to 00:30 tomorrow only delays the 23:30 send by an hour
+    assert recompute_delivery_slots(datetime(2026, 10, 25, 23, 0)) == 1
+    assert _send_slots() == [30]
@@ -0,0 +1,131 @@
+import smtplib
+import time
+from email.utils import formatdate
+
+import flask_mail
+import pytest
+from flask_mail import Message
+
+from app import mail
+from email_service import DailyJokeRenderer, SMTPConnectionPool, send_messages
+from models import Joke
+
+
+class StubSMTP:
+    """Stands in for smtplib.SMTP: records sessions and messages, and can drop the connection once."""
+
+    sessions = []
+    drop_next_send = False
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.messages = []
+        self.closed = False
+        StubSMTP.sessions.append(self)
+
+    def set_debuglevel(self, level):
+        pass
+
+    def sendmail(self, sender, recipients, message, mail_options=(), rcpt_options=()):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected('session already closed')
+        if StubSMTP.drop_next_send:
+            StubSMTP.drop_next_send = False
+            self.closed = True
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.messages.append((sender, recipients, message))
+
+    def quit(self):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self.closed = True
+
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    """Deliver through StubSMTP instead of suppressing mail."""
+    app.config.update(MAIL_SUPPRESS_SEND=False, MAIL_USE_TLS=False, MAIL_USERNAME=None, MAIL_PASSWORD=None)
+    mail.init_app(app)
+    StubSMTP.sessions = []
+    StubSMTP.drop_next_send = False
+    monkeypatch.setattr(flask_mail.smtplib, 'SMTP', StubSMTP)
+    return StubSMTP
+
+
+def _messages(count):
+    return [Message('Test', recipients=[f'user{index}@example.com'], body='hi') for index in range(count)]
+
+
+def test_connection_is_reused_across_batches(smtp):
+    pool = SMTPConnectionPool(size=1, max_messages=100, idle_timeout=60)
+
+    with pool.connection() as connection:
+        first = send_messages(_messages(5), connection)
+    with pool.connection() as connection:
+        second = send_messages(_messages(5), connection)
+
+    assert first['sent'] == second['sent'] == 5
+    assert first['rate'] > 0
+    assert len(smtp.sessions) == 1
+    assert len(smtp.sessions[0].messages) == 10
+    assert not smtp.sessions[0].closed
+
+
+def test_session_is_recycled_after_the_message_cap(smtp):
+    pool = SMTPConnectionPool(size=1, max_messages=3, idle_timeout=60)
+
+    with pool.connection() as connection:
+        send_messages(_messages(7), connection)
+
+    assert [len(session.messages) for session in smtp.sessions] == [3, 3, 1]
+    assert [session.closed for session in smtp.sessions] == [True, True, False]
+
+
+def test_idle_session_is_reopened(smtp):
+    pool = SMTPConnectionPool(size=1, max_messages=100, idle_timeout=0.05)
+
+    with pool.connection() as connection:
+        send_messages(_messages(2), connection)
+    time.sleep(0.1)
+    with pool.connection() as connection:
+        send_messages(_messages(2), connection)
+
+    assert [len(session.messages) for session in smtp.sessions] == [2, 2]
+    assert smtp.sessions[0].closed
+
+
+def test_dropped_session_is_reopened_and_the_message_resent(smtp):
+    pool = SMTPConnectionPool(size=1, max_messages=100, idle_timeout=60)
+
+    with pool.connection() as connection:
+        send_messages(_messages(2), connection)
+        smtp.drop_next_send = True
+        result = send_messages(_messages(2), connection)
+
+    assert (result['sent'], result['failed']) == (2, 0)
+    assert [len(session.messages) for session in smtp.sessions] == [2, 2]
+
+
+def test_close_ends_idle_sessions(smtp):
+    pool = SMTPConnectionPool(size=2, max_messages=100, idle_timeout=60)
+
+    with pool.connection() as connection:
+        send_messages(_messages(1), connection)
+    pool.close()
+
+    assert smtp.sessions[0].closed
+
+
+def test_broadcast_messages_carry_their_own_date(app, add_category):
+    add_category('puns', jokes=1)
+    envelope = DailyJokeRenderer().envelope(Joke.query.all())
+    first, second = envelope.message('user0@example.com'), envelope.message('user1@example.com')
+
+    # Left for the connection to stamp at send time, as for any other Message
+    assert first.date is None and second.date is None
+    first.date, second.date = 1_800_000_000.0, 1_800_003_600.0
+
+    assert f"Date: {formatdate(first.date, localtime=True)}".encode() in first.as_bytes()
+    assert f"Date: {formatdate(second.date, localtime=True)}".encode() in second.as_bytes()
+    assert b'user1@example.com' in second.as_bytes()
@@ -0,0 +1,71 @@
+from datetime import date, datetime
+
+from app import db
+from delivery import enqueue_deliveries
+from delivery_slots import rebalance_send_slots
+from joke_selection import JokeSampler
+from models import JokeHistory
+from seen_jokes import load_seen
+
+
+def _plans(queries, table):
+    """EXPLAIN QUERY PLAN every recorded statement that reads ``table``, with its original parameters."""
+    connection = db.session.connection()
+    plans = []
+    for statement, parameters in zip(queries.statements, queries.parameters):
+        if f'FROM {table}' not in statement:
+            continue
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+        plans.append(' | '.join(row[-1] for row in rows))
+    assert plans, f'no statement read {table}'
+    return plans
+
+
+def _uses(plan, index):
+    return f'USING INDEX {index}' in plan or f'USING COVERING INDEX {index}' in plan
+
+
+def test_due_subscribers_are_found_through_the_send_slot_index(add_category, add_subscribers, count_queries):
+    add_category('puns', jokes=1)
+    add_subscribers(3, ['puns'])
+
+    with count_queries() as queries:
+        enqueue_deliveries(9 * 60, date(2026, 1, 1))
+
+    for plan in _plans(queries, 'subscriber'):
+        assert _uses(plan, 'ix_subscriber_active_send_slot'), plan
+
+
+def test_slot_rebalancing_counts_through_the_delivery_slot_index(add_category, add_subscribers, count_queries):
+    add_category('puns', jokes=1)
+    add_subscribers(3, ['puns'])
+
+    with count_queries() as queries:
+        rebalance_send_slots()
+
+    plan = _plans(queries, 'subscriber')[0]
+    assert _uses(plan, 'ix_subscriber_active_delivery_slot'), plan
+
+
+def test_joke_candidates_are_read_by_category_index(add_category, count_queries):
+    puns = add_category('puns', jokes=5)
+
+    with count_queries() as queries:
+        JokeSampler().prepare([puns.id])
+
+    for plan in _plans(queries, 'joke'):
+        assert _uses(plan, 'ix_joke_category_last_sent') or _uses(plan, 'ix_joke_category_id'), plan
+
+
+def test_history_is_read_by_subscriber_index(add_category, add_subscribers, count_queries):
+    puns = add_category('puns', jokes=2)
+    subscriber, = add_subscribers(1, ['puns'])
+    db.session.add(JokeHistory(joke_id=puns.jokes[0].id, user=subscriber.id, sent_at=datetime(2026, 1, 1)))
+    db.session.commit()
+
+    with count_queries() as queries:
+        seen = load_seen([subscriber.id])
+
+    assert puns.jokes[0].id in seen[subscriber.id]
+    for plan in _plans(queries, 'joke_history'):
+        assert _uses(plan, 'ix_joke_history_user_sent_at'), plan
@@ -0,0 +1,100 @@
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from openai import AuthenticationError
+from tenacity import wait_none
+
+from app import db
+from dedup import insert_jokes
+from inventory import plan_refills, run_generation_jobs
+from models import GenerationJob, Joke
+from utils import ai_utils
+
+
+class CannedAsyncClient:
+    """Stands in for AsyncOpenAI: answers each category with its canned jokes, or raises its error."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, **options):
+        category = messages[1]['content'].split('"')[1]
+        self.calls.append(category)
+        answer = self.answers[category]
+        if isinstance(answer, Exception):
+            raise answer
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(answer)))])
+
+
+@pytest.fixture
+def canned_client(monkeypatch):
+    monkeypatch.setattr(ai_utils, 'wait_random_exponential', lambda **options: wait_none())
+
+    def install(answers):
+        client = CannedAsyncClient(answers)
+        ai_utils.set_async_client(client)
+        return client
+
+    yield install
+    ai_utils.set_async_client(None)
+
+
+def _unauthorized():
+    # Built without the HTTP response the client would attach
+    error = AuthenticationError.__new__(AuthenticationError)
+    Exception.__init__(error, '401 Unauthorized')
+    return error
+
+
+def test_refills_are_planned_for_low_categories_once(app, add_category, add_subscribers):
+    app.config.update(JOKE_INVENTORY_LOW_WATERMARK=5, JOKE_REFILL_BATCH=10, JOKE_REFILL_MAX_JOBS=3)
+    low = add_category('puns', jokes=2)
+    add_category('dad', jokes=30)
+    busy = add_category('tech', jokes=30)
+    # 26 subscribers due at 09:00 UTC raise tech's watermark to 31; dad has no demand
+    add_subscribers(26, ['tech'])
+    now = datetime(2026, 3, 1, 8, 30)
+
+    assert plan_refills(now) == 2
+    queued = GenerationJob.query.order_by(GenerationJob.id).all()
+    assert [(job.category_id, job.count, job.source) for job in queued] == [
+        (low.id, 10, 'refill'), (busy.id, 10, 'refill'),
+    ]
+    # Categories with a queued job are not queued again
+    assert plan_refills(now) == 0
+    assert GenerationJob.query.count() == 2
+
+
+def test_generation_jobs_insert_new_jokes_and_record_the_outcome(app, add_category, canned_client):
+    puns = add_category('puns')
+    dad = add_category('dad')
+    tech = add_category('tech')
+    existing = 'Why do programmers prefer dark mode? Because light attracts bugs.'
+    insert_jokes(puns.id, [existing])
+    client = canned_client({
+        'puns': [existing, 'A brand new pun about keyboards and their many keys'],
+        'dad': ['I used to hate facial hair, but then it grew on me.'],
+        'tech': _unauthorized(),
+    })
+    jobs = [GenerationJob(category_id=category.id, count=2) for category in (puns, dad, tech)]
+    db.session.add_all(jobs)
+    db.session.commit()
+
+    assert run_generation_jobs() == 2
+
+    db.session.expire_all()
+    by_category = {job.category_id: job for job in GenerationJob.query}
+    assert (by_category[puns.id].status, by_category[puns.id].inserted) == (GenerationJob.DONE, 1)
+    assert by_category[puns.id].error == '1 duplicate joke(s) skipped'
+    assert (by_category[dad.id].status, by_category[dad.id].inserted) == (GenerationJob.DONE, 1)
+    assert (by_category[tech.id].status, by_category[tech.id].inserted) == (GenerationJob.FAILED, 0)
+    assert all(job.finished_at is not None for job in by_category.values())
+    assert Joke.query.filter_by(category_id=puns.id).count() == 2
+    assert Joke.query.filter_by(category_id=tech.id).count() == 0
+    assert sorted(client.calls) == ['dad', 'puns', 'tech']
+    # Nothing left to run
+    assert run_generation_jobs() == 0
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+
+from app import db
+from category_cache import category_cache
+from joke_selection import JokeSampler, select_jokes_for_subscribers
+from models import Joke, Subscriber
+from seen_jokes import JokeBitmap, load_seen
+
+
+def _select(subscriber_ids):
+    subscribers = Subscriber.query.filter(Subscriber.id.in_(subscriber_ids)).all()
+    seen = load_seen(subscriber.id for subscriber in subscribers)
+    return select_jokes_for_subscribers(subscribers, seen, JokeSampler())
+
+
+def test_selection_query_count_does_not_grow_with_the_batch(app, add_category, add_subscribers, count_queries):
+    app.config['CATEGORY_CACHE_CHECK_INTERVAL'] = 3600
+    add_category('puns', jokes=60)
+    add_category('dad', jokes=60)
+    add_category('tech', jokes=60)
+    small = [subscriber.id for subscriber in add_subscribers(5, ['puns', 'dad'], prefix='small')]
+    large = [subscriber.id for subscriber in add_subscribers(50, ['puns', 'dad', 'tech', 'missing'], prefix='large')]
+    db.session.expunge_all()
+    # Category lookups are served from the in-process cache once it is warm
+    category_cache.active()
+
+    with count_queries() as small_batch:
+        selected_small = _select(small)
+    with count_queries() as large_batch:
+        selected_large = _select(large)
+
+    assert len(selected_small) == 5
+    assert len(selected_large) == 50
+    assert all(len(joke_ids) == 3 for _, joke_ids in selected_large)
+    # Subscribers, seen bitmaps (and history for subscribers without one),
+    # candidates: the same handful of statements for 5 or 50 subscribers
+    assert large_batch.count == small_batch.count
+    assert large_batch.count <= 6, large_batch.statements
+
+
+
+def test_jokes_sent_within_the_cooldown_are_not_eligible(app, add_category, add_subscribers):
+    puns = add_category('puns', jokes=4)
+    recent = datetime.utcnow() - timedelta(days=1)
+    fresh = Joke.query.filter_by(category_id=puns.id).order_by(Joke.id).first()
+    Joke.query.filter(Joke.category_id == puns.id, Joke.id != fresh.id).update({'last_sent': recent})
+    subscribers = add_subscribers(1, ['puns'])
+
+    selected = _select([subscriber.id for subscriber in subscribers])
+
+    assert [joke_ids for _, joke_ids in selected] == [[fresh.id]]
+
+
+def test_jokes_sent_within_the_cooldown_are_not_eligible_for_anyone_else(app, add_category, add_subscribers):
+    puns = add_category('puns', jokes=4)
+    recent = datetime.utcnow() - timedelta(days=1)
+    fresh = Joke.query.filter_by(category_id=puns.id).order_by(Joke.id).first()
+    Joke.query.filter(Joke.category_id == puns.id, Joke.id != fresh.id).update({'last_sent': recent})
+    subscribers = add_subscribers(2, ['puns'])
+
+    selected = _select([subscriber.id for subscriber in subscribers])
+
+    # The fresh joke is reserved by the first subscriber; the second has nothing left
+    assert [(subscriber.id, joke_ids) for subscriber, joke_ids in selected] == [(subscribers[0].id, [fresh.id])]
+
+
+def test_a_tick_never_gives_two_subscribers_the_same_joke(app, add_category, add_subscribers):
+    add_category('puns', jokes=40)
+    subscribers = add_subscribers(20, ['puns'])
+    ids = [subscriber.id for subscriber in subscribers]
+    sampler = JokeSampler()
+
+    # Two batches of one tick, sharing the sampler like dispatch_deliveries does
+    picks = [
+        joke_id
+        for batch in (ids[:10], ids[10:])
+        for _, joke_ids in select_jokes_for_subscribers(
+            Subscriber.query.filter(Subscriber.id.in_(batch)).all(), sampler=sampler
+        )
+        for joke_id in joke_ids
+    ]
+
+    assert len(picks) == 20
+    assert len(set(picks)) == 20
+
+
+def test_broadcast_groups_share_a_set_none_of_them_has_seen(app, add_category, add_subscribers):
+    add_category('puns', jokes=20)
+    add_category('dad', jokes=20)
+    joke_ids = [joke.id for joke in Joke.query.order_by(Joke.id)]
+    subscribers = add_subscribers(10, ['puns', 'dad'])
+    # Everyone has seen a different pun and dad joke
+    seen = {subscriber.id: JokeBitmap() for subscriber in subscribers}
+    for index, subscriber in enumerate(subscribers):
+        seen[subscriber.id].add(joke_ids[index])
+        seen[subscriber.id].add(joke_ids[20 + index])
+
+    selected = select_jokes_for_subscribers(subscribers, seen, JokeSampler(broadcast=True))
+
+    assert len(selected) == 10
+    assert len({tuple(joke_ids) for _, joke_ids in selected}) == 1
+    assert not any(joke_id in seen[subscriber.id] for subscriber, picked in selected for joke_id in picked)
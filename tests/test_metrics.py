@@ -0,0 +1,42 @@
+import os
+
+from metrics import Counter, Histogram, Registry
+
+
+def test_metrics_are_closed_without_a_token(app):
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 404
+
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert '# TYPE dailyjokes_emails_total counter' in response.get_data(as_text=True)
+
+
+def test_any_worker_reports_the_totals_of_every_process(tmp_path):
+    registry = Registry()
+    sends = registry.add(Counter('sends_total', 'Sends.', labels=('result',)))
+    latency = registry.add(Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0)))
+    sends.inc(result='sent')
+    registry.share(str(tmp_path), interval=3600)
+
+    pid = os.fork()
+    if pid == 0:
+        # A gunicorn worker forked from the preloaded app
+        sends.inc(2, result='sent')
+        latency.observe(0.5)
+        registry.write()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    sends.inc(4, result='sent')
+    latency.observe(0.05)
+
+    lines = registry.render().splitlines()
+
+    # 1 + 4 here and 2 in the worker, which dropped the 1 it inherited
+    assert 'sends_total{result="sent"} 7' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_count 2' in lines
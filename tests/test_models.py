@@ -0,0 +1,37 @@
+import threading
+
+from app import db
+from models import Joke
+
+
+def test_concurrent_ratings_are_all_counted(app, add_category):
+    puns = add_category('puns', jokes=1)
+    joke_id = puns.jokes[0].id
+    raters, clicks = 8, 25
+    start = threading.Barrier(raters)
+    errors = []
+
+    def rate(stars):
+        with app.app_context():
+            try:
+                start.wait()
+                for _ in range(clicks):
+                    Joke.add_ratings(joke_id, stars)
+                    db.session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=rate, args=(1 + index % 5,)) for index in range(raters)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    db.session.expire_all()
+    joke = db.session.get(Joke, joke_id)
+    expected = clicks * sum(1 + index % 5 for index in range(raters))
+    assert (joke.rating_sum, joke.rating_count) == (expected, raters * clicks)
+    assert joke.rating == expected / (raters * clicks)
@@ -0,0 +1,96 @@
+import smtplib
+from collections import Counter
+from datetime import datetime, timedelta
+
+import outbox
+from app import db
+from models import OutboxMessage
+from outbox import _send_claimed, claim_messages, enqueue_welcome
+
+
+class RecordingConnection:
+    """Stands in for a pooled SMTP connection; refuses the addresses in ``failing``."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.sent = []
+
+    def send(self, message):
+        recipient = message.recipients[0]
+        if recipient in self.failing:
+            raise smtplib.SMTPRecipientsRefused({recipient: (450, b'Mailbox busy')})
+        self.sent.append(recipient)
+
+
+def _enqueue(*emails):
+    for email in emails:
+        enqueue_welcome(email)
+    db.session.commit()
+
+
+def test_two_claimers_never_send_a_message_twice(app, monkeypatch):
+    emails = [f'user{index}@example.com' for index in range(5)]
+    _enqueue(*emails)
+    now = datetime.utcnow()
+    connection = RecordingConnection()
+
+    monkeypatch.setattr(outbox, 'WORKER_ID', 'replica-a')
+    first = claim_messages(3, now=now)
+    monkeypatch.setattr(outbox, 'WORKER_ID', 'replica-b')
+    second = claim_messages(3, now=now)
+
+    assert len(first) == 3 and len(second) == 2
+    assert not {row[0] for row in first} & {row[0] for row in second}
+    assert _send_claimed(second, connection) == 2
+    monkeypatch.setattr(outbox, 'WORKER_ID', 'replica-a')
+    assert _send_claimed(first, connection) == 3
+
+    # Once the lease is up nothing sent is claimed again
+    assert claim_messages(10, now=now + timedelta(hours=1)) == []
+    assert Counter(connection.sent) == Counter(emails)
+
+
+def test_failed_messages_are_retried_with_backoff(app):
+    app.config.update(OUTBOX_RETRY_DELAY=60, OUTBOX_MAX_ATTEMPTS=5)
+    _enqueue('busy@example.com')
+    started = datetime.utcnow()
+
+    batch = claim_messages(10)
+    assert _send_claimed(batch, RecordingConnection(failing={'busy@example.com'})) == 0
+    message = OutboxMessage.query.one()
+    assert message.status == OutboxMessage.PENDING
+    assert message.claimed_by is None
+    first_retry = message.retry_at
+    assert first_retry >= started + timedelta(seconds=60)
+
+    # Not before the retry time, and the delay doubles after the next failure
+    assert claim_messages(10, now=first_retry - timedelta(seconds=1)) == []
+    batch = claim_messages(10, now=first_retry)
+    assert [row[3] for row in batch] == [2]
+    failed_at = datetime.utcnow()
+    _send_claimed(batch, RecordingConnection(failing={'busy@example.com'}))
+    db.session.expire_all()
+    assert message.retry_at >= failed_at + timedelta(seconds=120)
+
+    connection = RecordingConnection()
+    assert _send_claimed(claim_messages(10, now=message.retry_at), connection) == 1
+    db.session.expire_all()
+    assert connection.sent == ['busy@example.com']
+    assert message.status == OutboxMessage.SENT
+    assert message.retry_at is None
+
+
+def test_messages_give_up_after_max_attempts(app):
+    app.config.update(OUTBOX_RETRY_DELAY=0, OUTBOX_MAX_ATTEMPTS=2)
+    _enqueue('gone@example.com')
+    connection = RecordingConnection(failing={'gone@example.com'})
+    later = datetime.utcnow() + timedelta(minutes=1)
+
+    _send_claimed(claim_messages(10), connection)
+    _send_claimed(claim_messages(10, now=later), connection)
+
+    message = OutboxMessage.query.one()
+    assert message.status == OutboxMessage.FAILED
+    assert message.attempts == 2
+    assert 'Mailbox busy' in message.error
+    assert claim_messages(10, now=later + timedelta(days=1)) == []
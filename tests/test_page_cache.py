@@ -0,0 +1,57 @@
+from app import db
+from category_cache import categories_changed
+from models import Category
+from page_cache import page_cache
+
+
+def _counters():
+    counters = page_cache.stats().get('index', {})
+    return {outcome: counters.get(outcome, 0) for outcome in ('hits', 'misses', 'not_modified')}
+
+
+def test_index_answers_matching_conditional_requests_with_304(app, add_category):
+    add_category('puns')
+    client = app.test_client()
+    before = _counters()
+
+    first = client.get('/')
+    again = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200 and first.headers['ETag']
+    assert again.status_code == 304
+    assert again.data == b''
+    assert _counters()['not_modified'] == before['not_modified'] + 1
+
+
+def test_a_category_change_drops_cached_pages(app, add_category):
+    add_category('puns')
+    client = app.test_client()
+    etag = client.get('/').headers['ETag']
+
+    db.session.add(Category(name='limericks', description='limericks jokes', is_active=True))
+    categories_changed()
+    db.session.commit()
+    response = client.get('/', headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert b'Limericks' in response.data
+    assert response.headers['ETag'] != etag
+
+
+def test_pages_with_flash_messages_are_never_cached(app):
+    flashed, other = app.test_client(), app.test_client()
+    flashed.post('/subscribe', data={})
+    before = _counters()
+
+    own = flashed.get('/')
+    shared = other.get('/')
+
+    assert b'Email is required!' in own.data
+    assert 'no-store' in own.headers['Cache-Control']
+    assert 'ETag' not in own.headers
+    assert b'Email is required!' not in shared.data
+    # Nor is the flashed page served once the message has been shown
+    assert b'Email is required!' not in flashed.get('/').data
+    after = _counters()
+    assert after['misses'] - before['misses'] == 2
+    assert after['hits'] - before['hits'] == 1
@@ -0,0 +1,64 @@
+import pytest
+
+from app import db
+from models import Joke
+
+
+def _walk(client, url, **params):
+    """Follow next_cursor from the first page to the last; returns the pages' ids."""
+    pages = []
+    while True:
+        data = client.get(url, query_string=params).get_json()
+        pages.append([item['id'] for item in data['items']])
+        if data['next_cursor'] is None:
+            return pages
+        params['after'] = data['next_cursor']
+
+
+def test_joke_pages_are_newest_first_without_gaps_or_repeats(app, add_category):
+    app.config['LOGIN_DISABLED'] = True
+    puns = add_category('puns', jokes=7)
+    add_category('limericks', jokes=2)
+    ids = sorted((joke.id for joke in puns.jokes), reverse=True)
+
+    pages = _walk(app.test_client(), '/admin/api/jokes', limit=3, category_id=puns.id)
+
+    assert pages == [ids[0:3], ids[3:6], ids[6:]]
+
+
+def test_rows_added_while_paging_do_not_shift_later_pages(app, add_category):
+    app.config['LOGIN_DISABLED'] = True
+    puns = add_category('puns', jokes=6)
+    ids = sorted((joke.id for joke in puns.jokes), reverse=True)
+    client = app.test_client()
+
+    first = client.get('/admin/api/jokes', query_string={'limit': 3}).get_json()
+    db.session.add(Joke(content='a newer pun', category_id=puns.id))
+    db.session.commit()
+    second = client.get('/admin/api/jokes', query_string={'limit': 3, 'after': first['next_cursor']}).get_json()
+
+    assert [item['id'] for item in first['items']] == ids[:3]
+    assert [item['id'] for item in second['items']] == ids[3:]
+    assert second['next_cursor'] is None
+
+
+def test_subscriber_pages_follow_the_filters(app, add_subscribers):
+    app.config['LOGIN_DISABLED'] = True
+    wanted = add_subscribers(5, ['puns'], prefix='pun')
+    add_subscribers(3, ['limericks'], prefix='verse')
+    ids = sorted((subscriber.id for subscriber in wanted), reverse=True)
+
+    pages = _walk(app.test_client(), '/admin/api/subscribers', limit=2, category='puns')
+
+    assert pages == [ids[0:2], ids[2:4], ids[4:]]
+
+
+@pytest.mark.parametrize('cursor', ['abc', '0', '-3', ''])
+def test_malformed_cursors_are_rejected(app, add_category, cursor):
+    app.config['LOGIN_DISABLED'] = True
+    add_category('puns', jokes=3)
+
+    response = app.test_client().get('/admin/api/jokes', query_string={'after': cursor})
+
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Invalid cursor'
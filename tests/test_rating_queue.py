@@ -0,0 +1,65 @@
+import os
+
+import routes
+from app import db
+from models import Joke, JokeRating, RatingBatch
+from rating_queue import RatingSpool
+
+
+def _spool(app):
+    return RatingSpool(app, app.config['RATING_SPOOL_DIR'], 3600)
+
+
+def _ratings(joke_id):
+    db.session.expire_all()
+    joke = db.session.get(Joke, joke_id)
+    return joke.rating_sum, joke.rating_count, JokeRating.query.filter_by(joke_id=joke_id).count()
+
+
+def test_clicks_spooled_by_a_crashed_worker_are_applied_by_another(app, add_category):
+    puns = add_category('puns', jokes=1)
+    joke_id = puns.jokes[0].id
+
+    pid = os.fork()
+    if pid == 0:
+        # A worker that queues two clicks and dies before flushing
+        spool = _spool(app)
+        spool.append(joke_id, 5)
+        spool.append(joke_id, 3)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert _spool(app).flush() == 2
+    assert _ratings(joke_id) == (8, 2, 2)
+    assert RatingBatch.query.count() == 1
+    assert os.listdir(app.config['RATING_SPOOL_DIR']) == []
+
+
+def test_a_batch_replayed_after_a_crash_is_applied_once(app, add_category):
+    puns = add_category('puns', jokes=1)
+    joke_id = puns.jokes[0].id
+    spool = _spool(app)
+    batch = os.path.join(spool.directory, f"{spool.prefix}{spool.pid}-1000-1.batch")
+
+    for _ in range(2):
+        # Written again as if the process died between the commit and removing the file
+        with open(batch, 'w') as handle:
+            handle.write(f"{joke_id} 4 1700000000.000\n{joke_id} 2 1700000001.000\n{joke_id} 5")
+        spool.flush()
+
+    # The torn last line is dropped and the replay changes nothing
+    assert _ratings(joke_id) == (6, 2, 2)
+    assert os.listdir(spool.directory) == []
+
+
+def test_queued_ratings_of_unknown_jokes_are_refused(app, monkeypatch):
+    app.config['RATING_INGEST_MODE'] = 'queue'
+
+    def no_spool(app=None):
+        raise AssertionError('spooled a rating for a joke that does not exist')
+    monkeypatch.setattr(routes, 'get_rating_spool', no_spool)
+
+    response = app.test_client().get('/rate/12345/5')
+
+    assert response.status_code == 200
+    assert JokeRating.query.count() == 0
@@ -0,0 +1,58 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from app import create_worker_app
+from email_service import build_daily_joke
+from models import Joke, Subscriber
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_worker_app_renders_the_same_email_links_as_the_web_app(app, add_category, add_subscribers):
+    add_category('puns', jokes=2)
+    add_subscribers(1, ['puns'])
+
+    def render():
+        subscriber = Subscriber.query.one()
+        return build_daily_joke(subscriber, Joke.query.order_by(Joke.id).all()).html
+
+    web = render()
+    worker = create_worker_app()
+    worker.config.update(SERVER_NAME='example.com', PREFERRED_URL_SCHEME='http')
+    with worker.app_context():
+        html = render()
+        joke_id = Joke.query.order_by(Joke.id).first().id
+
+    assert html == web
+    assert f'http://example.com/rate/{joke_id}/5' in html
+    assert 'http://example.com/unsubscribe/user0@example.com' in html
+
+
+def test_sigterm_shuts_the_scheduler_down_cleanly(app):
+    env = dict(os.environ, SCHEDULER_METRICS_PORT='0', PYTHONUNBUFFERED='1')
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import scheduler; scheduler.main()'],
+        cwd=ROOT, env=env, stderr=subprocess.PIPE, text=True,
+    )
+    try:
+        log = []
+        for line in process.stderr:
+            log.append(line)
+            if 'Scheduler started' in line:
+                break
+        process.send_signal(signal.SIGTERM)
+        started = time.monotonic()
+        log.extend(process.stderr)
+        assert process.wait(timeout=30) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+    output = ''.join(log)
+    assert 'Received SIGTERM, shutting down' in output
+    assert 'Scheduler stopped' in output
+    assert time.monotonic() - started < 10
@@ -1,7 +1,13 @@
 import os
 import logging
 import json
-from openai import OpenAI, OpenAIError, APIError, AuthenticationError, RateLimitError, APIConnectionError
+import time
+import asyncio
+from collections import namedtuple
+from openai import (
+    AsyncOpenAI, OpenAIError, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+)
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,10 +28,6 @@ def validate_api_key():
     return True
 
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-
-
 def sanitize_and_parse_response(response_text):
     """
     Sanitize and parse JSON text from the response.
@@ -72,91 +74,216 @@ def sanitize_and_parse_response(response_text):
     return []
 
 
-def generate_bulk_jokes(category,category_description, count=10):
+# Model settings for every generation request
+COMPLETION_OPTIONS = {
+    "model": "gpt-3.5-turbo",
+    "max_tokens": 2000,  # Adjust token usage to fit the jokes
+    "temperature": 0.7,
+    "presence_penalty": 0.6,
+    "frequency_penalty": 0.5,
+}
+
+
+def build_messages(category, category_description, count):
     """
-    Generate multiple jokes in one API call.
+    Build the chat messages asking for a batch of jokes in one category.
 
     Args:
         category (str): The category of jokes to generate.
+        category_description (str): Description used to tailor the jokes.
         count (int): The number of jokes to generate.
 
     Returns:
-        list: A list of jokes.
+        list: Chat messages for the completions API.
+    """
+    # Create a single prompt to generate multiple jokes
+    system_prompt = """
+    You are an offensive comedian specializing in dark humor, catering to adults with a taste for edgy and sarcastic jokes. Stay within the bounds of dark comedy, avoiding content that promotes hate speech or illegal themes.
+    """
+
+    user_prompt = f"""
+    Generate {count} unique, edgy, and dark humor jokes in the "{category}" category. 
+    The category description is: "{category_description}". Use this description to tailor the jokes specifically to the context provided.
+
+    Additional guidelines:
+    - Ensure the jokes are concise, witty, and formatted as a JSON list of strings.
+    - Avoid generic or unrelated content and stick closely to the category description.
+    - Ensure the jokes remain in good taste for adults with a dark sense of humor, aligned with the provided category description.
+
+    Return the output strictly as valid JSON. Example:
+    [
+        "Why does Zoro never get lost? Because he doesn't even know where he's supposed to be!",
+        "Luffy walked into a bar. The bartender said, 'Stretch yourself to another place!'"
+    ]
+    """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def parse_completion(response):
+    """
+    Extract the list of jokes from a chat completion response.
+
+    Returns:
+        list: A list of jokes, empty if the response held none.
+    """
+    if response and response.choices:
+        response_text = response.choices[0].message.content.strip()
+        logger.debug(f"Raw response from OpenAI: {response_text}")
+
+        # Parse the sanitized response
+        jokes = sanitize_and_parse_response(response_text)
+        if jokes:
+            logger.info(f"Successfully generated {len(jokes)} jokes")
+            return jokes
+    else:
+        logger.error("Invalid response format or no jokes generated")
+    return []
+
+
+# One category's worth of jokes to generate; ``key`` is returned untouched so
+# callers can match results (which arrive in completion order) to their work
+JokeRequest = namedtuple('JokeRequest', 'category description count key', defaults=(None,))
+
+# Errors worth retrying with backoff; anything else fails the request at once
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# AsyncOpenAI client override; by default each batch opens and closes its own
+# client, since its connections belong to the event loop that created them
+_async_client = None
+
+
+def set_async_client(client):
+    """
+    Use a fixed AsyncOpenAI client, e.g. one pointed at a local mock server.
+
+    Args:
+        client: An AsyncOpenAI-compatible client, or None to go back to a
+            client per batch.
     """
+    global _async_client
+    _async_client = client
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: allows bursts of up to ``capacity`` calls and
+    ``rate`` calls per second on average.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def _generate_one(client, request, semaphore, bucket, max_attempts):
+    async with semaphore:
+        try:
+            async for attempt in AsyncRetrying(
+                retry=retry_if_exception_type(RETRYABLE_ERRORS),
+                wait=wait_random_exponential(multiplier=1, max=30),
+                stop=stop_after_attempt(max_attempts),
+                reraise=True,
+            ):
+                with attempt:
+                    await bucket.acquire()
+                    logger.info(f"Attempting to generate {request.count} jokes in the {request.category} category")
+                    response = await client.chat.completions.create(
+                        messages=build_messages(request.category, request.description, request.count),
+                        **COMPLETION_OPTIONS
+                    )
+            return request, parse_completion(response)
+        except OpenAIError as e:
+            logger.error(f"Generation failed for {request.category}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error generating {request.category}: {str(e)}")
+        return request, []
+
+
+async def generate_jokes_concurrently(requests, max_concurrency=4, requests_per_minute=60, max_attempts=5):
+    """
+    Generate jokes for many categories at once, yielding each result as soon as it is ready.
+
+    Args:
+        requests: An iterable of JokeRequest tuples.
+        max_concurrency (int): Maximum number of API calls in flight.
+        requests_per_minute (int): Average API call rate allowed by the token bucket.
+        max_attempts (int): Attempts per request for rate-limit, timeout and server errors.
+
+    Yields:
+        tuple: (JokeRequest, list of jokes) in completion order; the list is
+        empty when the request failed.
+    """
+    requests = list(requests)
+    if not requests:
+        return
+    if _async_client is None and not validate_api_key():
+        logger.error("Invalid or missing API key")
+        for request in requests:
+            yield request, []
+        return
+
+    owned = _async_client is None
+    # Retries are tenacity's job; the client's own would multiply max_attempts
+    client = AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=0) if owned else _async_client
+    semaphore = asyncio.Semaphore(max_concurrency)
+    bucket = TokenBucket(rate=requests_per_minute / 60, capacity=max_concurrency)
+    tasks = [
+        asyncio.ensure_future(_generate_one(client, request, semaphore, bucket, max_attempts))
+        for request in requests
+    ]
     try:
-        # Validate API key
-        if not validate_api_key():
-            logger.error("Invalid or missing API key")
-            return []
-        logger.info(f"Attempting to generate {count} jokes in the {category} category")
-
-        # Create a single prompt to generate multiple jokes
-        system_prompt = """
-        You are an offensive comedian specializing in dark humor, catering to adults with a taste for edgy and sarcastic jokes. Stay within the bounds of dark comedy, avoiding content that promotes hate speech or illegal themes.
-        """
-
-        user_prompt = f"""
-        Generate {count} unique, edgy, and dark humor jokes in the "{category}" category. 
-        The category description is: "{category_description}". Use this description to tailor the jokes specifically to the context provided.
-
-        Additional guidelines:
-        - Ensure the jokes are concise, witty, and formatted as a JSON list of strings.
-        - Avoid generic or unrelated content and stick closely to the category description.
-        - Ensure the jokes remain in good taste for adults with a dark sense of humor, aligned with the provided category description.
-
-        Return the output strictly as valid JSON. Example:
-        [
-            "Why does Zoro never get lost? Because he doesn't even know where he's supposed to be!",
-            "Luffy walked into a bar. The bartender said, 'Stretch yourself to another place!'"
-        ]
-        """
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=2000,  # Adjust token usage to fit the jokes
-            temperature=0.7,
-            presence_penalty=0.6,
-            frequency_penalty=0.5
-        )
-
-        if response and response.choices:
-            response_text = response.choices[0].message.content.strip()
-            logger.debug(f"Raw response from OpenAI: {response_text}")
-
-            # Parse the sanitized response
-            jokes = sanitize_and_parse_response(response_text)
-            if jokes:
-                logger.info(f"Successfully generated {len(jokes)} jokes")
-                return jokes
-        else:
-            logger.error("Invalid response format or no jokes generated")
-        return []
-    except AuthenticationError as e:
-        logger.error(f"Authentication error: {str(e)}")
-        return []
-    except RateLimitError as e:
-        logger.error(f"Rate limit exceeded: {str(e)}")
-        return []
-    except APIConnectionError as e:
-        logger.error(f"API connection error: {str(e)}")
-        return []
-    except APIError as e:
-        logger.error(f"API error: {str(e)}")
-        return []
-    except OpenAIError as e:
-        logger.error(f"OpenAI error: {str(e)}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        return []
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+        if owned:
+            await client.close()
+
+
+def generate_jokes_batch(requests, on_result=None, **options):
+    """
+    Synchronous wrapper around generate_jokes_concurrently.
+
+    Args:
+        requests: An iterable of JokeRequest tuples.
+        on_result: Optional callback invoked with (request, jokes) as each
+            category finishes.
+        **options: Passed on to generate_jokes_concurrently.
+
+    Returns:
+        list: (JokeRequest, list of jokes) tuples in completion order.
+    """
+    async def collect():
+        results = []
+        async for request, jokes in generate_jokes_concurrently(requests, **options):
+            if on_result:
+                on_result(request, jokes)
+            results.append((request, jokes))
+        return results
+
+    return asyncio.run(collect())
 
 
 if __name__ == "__main__":
-    category = "dark humor"
-    jokes = generate_bulk_jokes(category, count=10)
+    [(request, jokes)] = generate_jokes_batch([JokeRequest("dark humor", "Jokes about death and misfortune", 10)])
     if jokes:
         print("Generated Jokes:")
         for idx, joke in enumerate(jokes, start=1):
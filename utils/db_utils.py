@@ -0,0 +1,54 @@
+from sqlalchemy import update, values, column
+from app import db
+
+
+def is_postgres():
+    """Whether the configured database is PostgreSQL."""
+    return db.engine.dialect.name == 'postgresql'
+
+
+def dialect_insert(model):
+    """
+    Return an INSERT construct for the current dialect.
+
+    PostgreSQL and SQLite inserts support ``on_conflict_do_nothing`` and
+    ``on_conflict_do_update``; other dialects get the generic construct.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy import insert
+    return insert(model)
+
+
+def update_from_values(model, rows, key='id'):
+    """
+    Apply per-row values to many rows of a table in one statement.
+
+    On PostgreSQL this is a single ``UPDATE ... FROM (VALUES ...)`` joined on
+    ``key``; elsewhere it falls back to an executemany UPDATE by primary key.
+
+    Args:
+        model: The mapped class to update.
+        rows: A list of dicts, each holding ``key`` and the columns to set.
+        key: Name of the column the rows are matched on.
+    """
+    if not rows:
+        return
+    if not is_postgres():
+        db.session.execute(update(model), rows)
+        return
+
+    table = model.__table__
+    names = list(rows[0])
+    data = values(*[column(name, table.c[name].type) for name in names], name='v').data(
+        [tuple(row[name] for name in names) for row in rows]
+    )
+    db.session.execute(
+        update(table)
+        .where(table.c[key] == data.c[key])
+        .values({name: data.c[name] for name in names if name != key})
+    )